@@ -0,0 +1,394 @@
+'''
+Aplicación ASGI para los endpoints de solo lectura de los agentes.
+
+Django 1.8 no soporta ASGI, por lo que /version/, /version/eventos/ y
+/descarga/ se sirven con corrutinas que solo leen el archivo de version y los
+snapshots publicados en MEDIA_ROOT. Un único proceso puede así mantener
+decenas de miles de conexiones en espera (long poll o Server-Sent Events) o
+lentas sin ocupar un hilo por conexión. Cada firmas.TTL_VERSION segundos se
+consulta en el pool de hilos la version vigente en la base de datos, para
+publicar las que registran otros servidores (ver revisar_base).
+
+Los demás pedidos, y las descargas que necesitan la base de datos (deltas,
+descargas normalizadas o versiones sin snapshot), se delegan a la aplicación
+WSGI de Django en un pool de hilos. Los pedidos que atienden las corrutinas no
+pasan por los middlewares de Django, pero se registran en el modulo metricas.
+'''
+import asyncio
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.urlresolvers import Resolver404, resolve
+from django.http import QueryDict
+from django.utils.http import http_date, parse_etags, quote_etag
+from . import firmas, metricas, notificaciones, views
+
+# hilos para los pedidos que se delegan a la aplicacion WSGI
+HILOS_WSGI = 20
+# tamaño de los bloques en que se envian las descargas
+TAMANIO_BLOQUE = 64 * 1024
+
+CACHE_CONTROL = 'public, no-cache'
+# clave del scope que indica que el pedido lo atendio la aplicacion WSGI
+DELEGADO = 'netcop.delegado'
+
+
+class Pedido(object):
+    '''
+    Datos de un pedido ASGI con los atributos GET y META que usan las
+    funciones de negociacion de views.
+    '''
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        query = scope.get('query_string', b'').decode('latin-1')
+        self.GET = QueryDict(query)
+        self.META = {'QUERY_STRING': query}
+        for nombre, valor in scope.get('headers', ()):
+            clave = 'HTTP_' + (nombre.decode('latin-1')
+                                     .upper()
+                                     .replace('-', '_'))
+            valor = valor.decode('latin-1')
+            if clave in self.META:
+                valor = self.META[clave] + ',' + valor
+            self.META[clave] = valor
+
+
+async def responder(send, pedido, estado, encabezados, cuerpo=b''):
+    await send({
+        'type': 'http.response.start',
+        'status': estado,
+        'headers': [(nombre.lower().encode('latin-1'),
+                     str(valor).encode('latin-1'))
+                    for nombre, valor in encabezados],
+    })
+    if pedido.method == 'HEAD':
+        cuerpo = b''
+    for inicio in range(0, max(len(cuerpo), 1), TAMANIO_BLOQUE):
+        fin = inicio + TAMANIO_BLOQUE
+        await send({
+            'type': 'http.response.body',
+            'body': cuerpo[inicio:fin],
+            'more_body': fin < len(cuerpo),
+        })
+
+
+def no_modificado(pedido, etag):
+    etags = parse_etags(pedido.META.get('HTTP_IF_NONE_MATCH', ''))
+    return etag in etags or '*' in etags
+
+
+def encabezados_version(pedido, version, fecha, variantes=True):
+    encabezados = [('ETag', quote_etag(views.etag(pedido, version,
+                                                  variantes))),
+                   ('Cache-Control', CACHE_CONTROL)]
+    if fecha is not None:
+        encabezados.append(('Last-Modified', http_date(fecha.timestamp())))
+    return encabezados
+
+
+class Aplicacion(object):
+    '''
+    Aplicacion ASGI 3 que resuelve las rutas con la configuracion de urls de
+    Django y atiende las de los agentes con corrutinas.
+    '''
+
+    def __init__(self, wsgi):
+        self.wsgi = wsgi
+        self.hilos = ThreadPoolExecutor(HILOS_WSGI)
+        # descargas de la version publicada por (formato, codificacion)
+        self.version_descargas = None
+        self.descargas = dict()
+        # ultima consulta de la version vigente en la base de datos
+        self.revision = None
+        self.proxima_revision = 0
+        self.vistas = {
+            'version': self.version,
+            'version_eventos': self.eventos,
+            'json': self.descarga,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.ciclo_de_vida(receive, send)
+        vista = ruta = None
+        if scope['method'] in ('GET', 'HEAD'):
+            try:
+                ruta = resolve(scope['path'])
+            except Resolver404:
+                pass
+            else:
+                vista = self.vistas.get(ruta.url_name)
+        if vista is None:
+            return await self.delegar(scope, receive, send)
+        inicio = time.perf_counter()
+        respuesta = {'estado': None, 'duracion': 0, 'largo': 0}
+
+        async def enviar(mensaje):
+            if mensaje['type'] == 'http.response.start':
+                respuesta['estado'] = mensaje['status']
+                respuesta['duracion'] = time.perf_counter() - inicio
+            else:
+                respuesta['largo'] += len(mensaje.get('body', b''))
+            await send(mensaje)
+
+        await vista(Pedido(scope), scope, receive, enviar)
+        # los pedidos delegados los registra MetricasMiddleware
+        if respuesta['estado'] is not None and not scope.get(DELEGADO):
+            metricas.registrar(ruta.view_name, scope['method'],
+                               respuesta['estado'], respuesta['duracion'],
+                               largo=respuesta['largo'])
+
+    async def ciclo_de_vida(self, receive, send):
+        while True:
+            mensaje = await receive()
+            if mensaje['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensaje['type'] == 'lifespan.shutdown':
+                self.hilos.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def revisar_base(self):
+        '''
+        Ejecuta notificaciones.revisar_base en el pool de hilos a lo sumo una
+        vez cada firmas.TTL_VERSION segundos. Los pedidos que llegan mientras
+        se consulta la base de datos esperan su resultado.
+        '''
+        ahora = time.monotonic()
+        if self.revision is None or (self.revision.done() and
+                                     ahora >= self.proxima_revision):
+            self.proxima_revision = ahora + firmas.TTL_VERSION
+            loop = asyncio.get_event_loop()
+            self.revision = loop.run_in_executor(self.hilos,
+                                                 notificaciones.revisar_base)
+        if not self.revision.done():
+            # la desconexion de un pedido no cancela la consulta de los demas
+            await asyncio.shield(self.revision)
+
+    async def version(self, pedido, scope, receive, send):
+        '''
+        Equivalente a views.VersionView, incluida la espera con `esperar`.
+        '''
+        await self.revisar_base()
+        version, fecha = notificaciones.estado_actual(revisar=False)
+        esperar = pedido.GET.get('esperar')
+        if esperar is not None:
+            vista = views.VersionView()
+            vista.request = pedido
+            loop = asyncio.get_event_loop()
+            limite = loop.time() + vista.get_timeout()
+            while version == esperar and loop.time() < limite:
+                await asyncio.sleep(min(notificaciones.INTERVALO,
+                                        limite - loop.time()))
+                await self.revisar_base()
+                version, fecha = notificaciones.estado_actual(revisar=False)
+        if not version:
+            return await self.delegar(scope, receive, send)
+        encabezados = encabezados_version(pedido, version, fecha,
+                                          variantes=False)
+        if no_modificado(pedido, version):
+            return await responder(send, pedido, 304, encabezados)
+        cuerpo = json.dumps({'version': version}).encode()
+        encabezados += [('Content-Type', 'application/json'),
+                        ('Content-Length', len(cuerpo))]
+        await responder(send, pedido, 200, encabezados, cuerpo)
+
+    async def eventos(self, pedido, scope, receive, send):
+        '''
+        Equivalente a views.VersionEventos.
+        '''
+        desconexion = asyncio.ensure_future(self.esperar_desconexion(receive))
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'),
+                        (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')],
+        })
+        loop = asyncio.get_event_loop()
+        limite = loop.time() + views.VersionEventos.DURACION_MAXIMA
+        ultima = pedido.META.get('HTTP_LAST_EVENT_ID')
+        proximo_ping = loop.time()
+        mensaje = "retry: %d\n\n" % views.VersionEventos.RECONEXION
+        try:
+            while loop.time() < limite and not desconexion.done():
+                await self.revisar_base()
+                version = notificaciones.estado_actual(revisar=False)[0]
+                if version != ultima:
+                    ultima = version
+                    if version:
+                        mensaje += "id: %s\nevent: version\ndata: %s\n\n" % (
+                            version, json.dumps({'version': version}))
+                if loop.time() >= proximo_ping:
+                    mensaje += ": ping\n\n"
+                    proximo_ping = (loop.time() +
+                                    views.VersionEventos.INTERVALO_PING)
+                if mensaje:
+                    await send({'type': 'http.response.body',
+                                'body': mensaje.encode(), 'more_body': True})
+                    mensaje = ''
+                await asyncio.sleep(min(notificaciones.INTERVALO,
+                                        max(0, limite - loop.time())))
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            desconexion.cancel()
+
+    async def esperar_desconexion(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def descarga(self, pedido, scope, receive, send):
+        '''
+        Sirve la descarga completa desde el snapshot publicado. Los deltas y
+        las descargas normalizadas se delegan a views.ClaseJson.
+        '''
+        await self.revisar_base()
+        version, fecha = notificaciones.estado_actual(revisar=False)
+        if not version or 'desde' in pedido.GET or 'normalizar' in pedido.GET:
+            return await self.delegar(scope, receive, send)
+        formato = views.formato_pedido(pedido)
+        codificacion = views.codificacion_pedida(pedido)
+        encabezados = encabezados_version(pedido, version, fecha)
+        encabezados.append(('Vary', 'Accept, Accept-Encoding'))
+        if no_modificado(pedido, views.etag(pedido, version)):
+            return await responder(send, pedido, 304, encabezados)
+        datos = await self.leer_descarga(version, formato, codificacion)
+        if datos is None:
+            return await self.delegar(scope, receive, send)
+        encabezados += [
+            ('Content-Type', views.ClaseJson.CONTENT_TYPES[formato]),
+            ('Content-Length', len(datos)),
+        ]
+        if codificacion:
+            encabezados.append(('Content-Encoding', codificacion))
+        await responder(send, pedido, 200, encabezados, datos)
+
+    async def leer_descarga(self, version, formato, codificacion):
+        '''
+        Devuelve el snapshot de la version, leyendolo en un hilo la primera
+        vez, o None si no existe.
+        '''
+        if version != self.version_descargas:
+            self.version_descargas = version
+            self.descargas = dict()
+        datos = self.descargas.get((formato, codificacion))
+        if datos is None:
+            path = firmas.ruta_snapshot(version, formato, codificacion)
+            loop = asyncio.get_event_loop()
+            try:
+                datos = await loop.run_in_executor(self.hilos, leer_archivo,
+                                                   path)
+            except FileNotFoundError:
+                return None
+            if version == self.version_descargas:
+                self.descargas[formato, codificacion] = datos
+        return datos
+
+    async def delegar(self, scope, receive, send):
+        '''
+        Atiende el pedido con la aplicacion WSGI en el pool de hilos. El
+        cuerpo de la respuesta se envia a medida que la aplicacion lo genera,
+        sin juntarlo en memoria.
+        '''
+        scope[DELEGADO] = True
+        cuerpo = b''
+        while True:
+            mensaje = await receive()
+            if mensaje['type'] == 'http.disconnect':
+                return
+            cuerpo += mensaje.get('body', b'')
+            if not mensaje.get('more_body'):
+                break
+        loop = asyncio.get_event_loop()
+
+        def enviar(mensaje):
+            # espera a que se envie cada bloque antes de generar el siguiente
+            asyncio.run_coroutine_threadsafe(send(mensaje), loop).result()
+
+        await loop.run_in_executor(self.hilos, ejecutar_wsgi, self.wsgi,
+                                   entorno_wsgi(scope, cuerpo), enviar)
+
+
+def leer_archivo(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def entorno_wsgi(scope, cuerpo):
+    '''
+    Arma el environ WSGI de un pedido ASGI.
+    '''
+    servidor = scope.get('server') or ('localhost', 80)
+    entorno = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': servidor[0],
+        'SERVER_PORT': str(servidor[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(cuerpo),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for nombre, valor in scope.get('headers', ()):
+        nombre = nombre.decode('latin-1').upper().replace('-', '_')
+        valor = valor.decode('latin-1')
+        if nombre not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            nombre = 'HTTP_' + nombre
+        if nombre in entorno:
+            valor = entorno[nombre] + ',' + valor
+        entorno[nombre] = valor
+    return entorno
+
+
+def ejecutar_wsgi(aplicacion, entorno, enviar):
+    '''
+    Ejecuta la aplicacion WSGI y pasa a `enviar` los mensajes ASGI de la
+    respuesta: el inicio y un mensaje por cada bloque del cuerpo. Todo el
+    cuerpo se recorre en el mismo hilo, que es el que tiene las conexiones a
+    la base de datos de la aplicacion.
+    '''
+    respuesta = dict()
+
+    def start_response(estado, encabezados, exc_info=None):
+        respuesta['estado'] = int(estado.split(' ', 1)[0])
+        respuesta['encabezados'] = encabezados
+
+    def iniciar():
+        enviar({
+            'type': 'http.response.start',
+            'status': respuesta['estado'],
+            'headers': [(nombre.lower().encode('latin-1'),
+                         valor.encode('latin-1'))
+                        for nombre, valor in respuesta['encabezados']],
+        })
+
+    resultado = aplicacion(entorno, start_response)
+    try:
+        anterior = None
+        for bloque in resultado:
+            if not bloque:
+                continue
+            if anterior is None:
+                iniciar()
+            else:
+                enviar({'type': 'http.response.body', 'body': anterior,
+                        'more_body': True})
+            anterior = bloque
+        if anterior is None:
+            iniciar()
+        enviar({'type': 'http.response.body', 'body': anterior or b''})
+    finally:
+        if hasattr(resultado, 'close'):
+            resultado.close()
@@ -0,0 +1,187 @@
+'''
+Formato binario compacto de la base de firmas para los agentes.
+
+Todos los enteros se guardan en orden de red (big endian).
+
+Encabezado::
+
+    magic         4 bytes   b'NCOP'
+    formato       uint16    version del formato (3)
+    largo_version uint16    largo de la version en bytes
+    cantidad      uint32    cantidad de clases
+    largo_cuerpo  uint32    largo del cuerpo en bytes
+    crc32         uint32    CRC32 de la version y el cuerpo
+    version       largo_version bytes en ascii
+
+Cuerpo, una entrada por clase ordenadas por id::
+
+    id            uint32
+    activa        uint8
+    nombre        uint16 largo + utf-8
+    descripcion   uint16 largo + utf-8
+    y para cada grupo, primero outside y luego inside:
+        cantidad de redes       uint32
+        redes                   pares uint32 (red, mascara) ordenados
+        cantidad de redes IPv6  uint32
+        redes IPv6              16 bytes red, uint8 prefijo, ordenadas
+        cantidad de puertos     uint32
+        puertos                 uint16 desde, uint16 hasta, uint8 protocolo
+                                ordenados
+
+La version 2 del formato, anterior a IPv6, no tiene las redes IPv6. La
+version 1, anterior a los rangos de puertos, guarda ademas cada puerto como
+uint16 puerto, uint8 protocolo. El lector acepta las tres.
+'''
+import bisect
+import struct
+import zlib
+from . import models
+
+MAGIC = b'NCOP'
+FORMATO = 3
+FORMATOS_SOPORTADOS = (1, 2, 3)
+CONTENT_TYPE = 'application/x-netcop-firmas'
+
+ENCABEZADO = struct.Struct('!4sHHIII')
+CLASE = struct.Struct('!IB')
+LARGO = struct.Struct('!H')
+CANTIDAD = struct.Struct('!I')
+PUERTO = struct.Struct('!HHB')
+PUERTO_V1 = struct.Struct('!HB')
+RED_IPV6 = struct.Struct('!16sB')
+
+PROTOCOLOS = {'': 0, 'tcp': 6, 'udp': 17}
+
+GRUPOS = (('subredes_outside', 'puertos_outside'),
+          ('subredes_inside', 'puertos_inside'))
+# campo en el que el lector devuelve las redes IPv6 de cada grupo
+SUBREDES_IPV6 = {'subredes_outside': 'subredes_ipv6_outside',
+                 'subredes_inside': 'subredes_ipv6_inside'}
+
+
+class ErrorFormato(ValueError):
+    pass
+
+
+def mascara(prefijo, bits=models.BITS):
+    return ((1 << bits) - 1) ^ ((1 << (bits - prefijo)) - 1)
+
+
+def puerto_a_tupla(puerto):
+    '''
+    Convierte un puerto con el formato de la descarga, por ejemplo '443/tcp'
+    o '49152-65535/udp', en la tupla (numero, hasta, protocolo).
+    '''
+    numeros, _, protocolo = puerto.partition('/')
+    numero, _, hasta = numeros.partition('-')
+    return int(numero), int(hasta or numero), PROTOCOLOS[protocolo]
+
+
+def escribir(version, clases):
+    '''
+    Serializa la version y las clases, con el formato de la descarga json,
+    en el formato binario.
+    '''
+    partes = list()
+    for clase in sorted(clases, key=lambda clase: clase['id']):
+        partes.append(CLASE.pack(clase['id'], clase['activa']))
+        for campo in ('nombre', 'descripcion'):
+            texto = clase[campo].encode('utf-8')
+            partes.append(LARGO.pack(len(texto)))
+            partes.append(texto)
+        for subredes, puertos in GRUPOS:
+            redes = sorted(
+                (models.ip_a_entero(direccion), int(prefijo))
+                for direccion, prefijo in (red.split('/')
+                                           for red in clase[subredes]))
+            # las IPv6 ordenan despues de las IPv4
+            i = bisect.bisect_left(redes, (models.IPV6, 0))
+            partes.append(CANTIDAD.pack(i))
+            partes.append(struct.pack(
+                '!%dI' % (2 * i),
+                *(n for red, prefijo in redes[:i]
+                  for n in (red, mascara(prefijo)))))
+            partes.append(CANTIDAD.pack(len(redes) - i))
+            partes.extend(
+                RED_IPV6.pack((red - models.IPV6).to_bytes(16, 'big'), prefijo)
+                for red, prefijo in redes[i:])
+            numeros = sorted(puerto_a_tupla(puerto)
+                             for puerto in clase[puertos])
+            partes.append(CANTIDAD.pack(len(numeros)))
+            partes.extend(PUERTO.pack(*puerto) for puerto in numeros)
+    cuerpo = b''.join(partes)
+    version = version.encode('ascii')
+    encabezado = ENCABEZADO.pack(MAGIC, FORMATO, len(version), len(clases),
+                                 len(cuerpo), zlib.crc32(version + cuerpo))
+    return encabezado + version + cuerpo
+
+
+def leer(datos):
+    '''
+    Lee un documento binario y devuelve un diccionario con la version y la
+    lista de clases. Las redes se devuelven como pares de enteros (red,
+    mascara), las IPv6 en los campos de SUBREDES_IPV6, y los puertos como
+    tuplas (numero, hasta, protocolo). Lanza ErrorFormato si el documento no
+    es valido.
+    '''
+    if len(datos) < ENCABEZADO.size:
+        raise ErrorFormato("Documento incompleto")
+    (magic, formato, largo_version, cantidad,
+     largo_cuerpo, crc) = ENCABEZADO.unpack_from(datos)
+    if magic != MAGIC:
+        raise ErrorFormato("No es una base de firmas")
+    if formato not in FORMATOS_SOPORTADOS:
+        raise ErrorFormato("Formato %d no soportado" % formato)
+    inicio = ENCABEZADO.size
+    fin = inicio + largo_version + largo_cuerpo
+    if len(datos) != fin:
+        raise ErrorFormato("Documento incompleto")
+    if zlib.crc32(datos[inicio:fin]) != crc:
+        raise ErrorFormato("Checksum invalido")
+    version = datos[inicio:inicio + largo_version].decode('ascii')
+    posicion = inicio + largo_version
+
+    def leer_struct(estructura):
+        nonlocal posicion
+        valores = estructura.unpack_from(datos, posicion)
+        posicion += estructura.size
+        return valores
+
+    def leer_texto():
+        nonlocal posicion
+        largo, = leer_struct(LARGO)
+        texto = datos[posicion:posicion + largo].decode('utf-8')
+        posicion += largo
+        return texto
+
+    clases = list()
+    for i in range(cantidad):
+        id, activa = leer_struct(CLASE)
+        clase = {
+            'id': id,
+            'activa': bool(activa),
+            'nombre': leer_texto(),
+            'descripcion': leer_texto(),
+        }
+        for subredes, puertos in GRUPOS:
+            n, = leer_struct(CANTIDAD)
+            valores = struct.unpack_from('!%dI' % (2 * n), datos, posicion)
+            posicion += 8 * n
+            clase[subredes] = list(zip(valores[::2], valores[1::2]))
+            clase[SUBREDES_IPV6[subredes]] = list()
+            if formato >= 3:
+                n, = leer_struct(CANTIDAD)
+                for j in range(n):
+                    red, prefijo = leer_struct(RED_IPV6)
+                    clase[SUBREDES_IPV6[subredes]].append(
+                        (int.from_bytes(red, 'big'),
+                         mascara(prefijo, models.BITS_IPV6)))
+            n, = leer_struct(CANTIDAD)
+            if formato == 1:
+                clase[puertos] = [(numero, numero, protocolo)
+                                  for numero, protocolo in
+                                  (leer_struct(PUERTO_V1) for j in range(n))]
+            else:
+                clase[puertos] = [leer_struct(PUERTO) for j in range(n)]
+        clases.append(clase)
+    return {'version': version, 'clases': clases}
@@ -0,0 +1,104 @@
+'''
+Búsqueda de clases de tráfico.
+
+La consulta se divide en términos y cada término se clasifica según su tipo
+(dirección IP, subred, puerto, número o texto) para resolverlo con una
+búsqueda indexada: las direcciones y subredes por contención sobre el rango
+de la red, los puertos por superposición de rangos y el texto con
+icontains, que en PostgreSQL usa los índices de trigramas creados por las
+migraciones. Cada término se resuelve con una subconsulta sobre los ids de
+las clases, por lo que no hace falta unir tablas ni usar distinct. Una clase
+debe coincidir con todos los términos. Los términos que no son texto también
+coinciden con las clases que contienen la palabra en el nombre o la
+descripción, por ejemplo 1.5 con "tunel 1.5".
+'''
+import re
+from django.db.models import Q
+from django.forms import ValidationError
+from . import models, parseo
+
+IP = 'ip'
+SUBRED = 'subred'
+PUERTO = 'puerto'
+NUMERO = 'numero'
+TEXTO = 'texto'
+
+# direccion incompleta, por ejemplo 10.200 o 192.168.1.
+REGEX_PARCIAL = r"^(\d{1,3})(\.\d{1,3}){0,2}\.?$"
+
+
+def parsear(q):
+    '''
+    Devuelve la lista de terminos (tipo, valor) de la consulta.
+    '''
+    terminos = list()
+    for palabra in q.split():
+        if palabra.isdigit():
+            terminos.append((NUMERO, int(palabra)))
+            continue
+        try:
+            direccion, prefijo = parseo.parsear_cidr(palabra)
+        except ValidationError:
+            pass
+        else:
+            tipo = SUBRED if '/' in palabra else IP
+            terminos.append((tipo, (direccion, prefijo)))
+            continue
+        if '/' in palabra or '-' in palabra:
+            try:
+                terminos.append((PUERTO, parseo.parsear_puerto(palabra)))
+                continue
+            except ValidationError:
+                pass
+        if re.match(REGEX_PARCIAL, palabra):
+            octetos = [int(o) for o in palabra.strip('.').split('.')]
+            if all(o <= 255 for o in octetos):
+                direccion = ".".join(str(o) for o in (octetos + [0] * 3)[:4])
+                terminos.append((SUBRED, (direccion, 8 * len(octetos))))
+                continue
+        terminos.append((TEXTO, palabra))
+    return terminos
+
+
+def clases_con_redes(redes):
+    return Q(id__in=models.ClaseCIDR.objects.filter(cidr__in=redes)
+                                            .values('clase_id'))
+
+
+def clases_con_puertos(puertos):
+    return Q(id__in=models.ClasePuerto.objects.filter(puerto__in=puertos)
+                                              .values('clase_id'))
+
+
+def texto(palabra):
+    return Q(nombre__icontains=palabra) | Q(descripcion__icontains=palabra)
+
+
+def filtro(tipo, valor, palabra):
+    '''
+    Devuelve el filtro que resuelve el termino de la palabra.
+    '''
+    if tipo == IP:
+        filtros = clases_con_redes(models.CIDR.objects.contienen(valor[0]))
+    elif tipo == SUBRED:
+        filtros = clases_con_redes(models.CIDR.objects.solapan(*valor))
+    elif tipo == PUERTO:
+        filtros = clases_con_puertos(models.Puerto.objects.solapan(*valor))
+    elif tipo == NUMERO:
+        filtros = Q(pk=valor)
+        if parseo.PUERTO_MIN <= valor <= parseo.PUERTO_MAX:
+            puertos = models.Puerto.objects.solapan(valor)
+            filtros |= clases_con_puertos(puertos)
+    else:
+        return texto(valor)
+    return filtros | texto(palabra)
+
+
+def buscar(queryset, q):
+    '''
+    Filtra el queryset de clases con los terminos de la consulta.
+    '''
+    # parsear devuelve un termino por palabra
+    for palabra, (tipo, valor) in zip(q.split(), parsear(q)):
+        queryset = queryset.filter(filtro(tipo, valor, palabra))
+    return queryset
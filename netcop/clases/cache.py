@@ -0,0 +1,102 @@
+'''
+Cache de valores que dependen de la version publicada de la base de firmas.
+
+Cada valor se guarda junto con la version para la que se calculó. Cuando la
+version cambia, un único proceso obtiene el lock de la clave y recalcula el
+valor; mientras tanto los demás siguen devolviendo el valor de la version
+anterior, o lo esperan si todavía no hay ninguno, en lugar de recalcularlo
+todos a la vez.
+
+El backend es el de la configuración FIRMAS_CACHE de settings (por defecto
+'default'), que puede ser la memoria local o cualquier backend de Django
+compartido entre procesos, como el de archivos o memcached.
+'''
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.cache import caches
+
+# segundos que se conserva un valor
+TTL = 3600
+# segundos que se conserva el lock si el proceso que recalcula muere
+TTL_LOCK = 30
+# segundos entre consultas y maximo de espera cuando no hay valor anterior
+ESPERA = 0.05
+ESPERA_MAXIMA = 5
+
+ACIERTOS = 'aciertos'
+FALLOS = 'fallos'
+ANTERIORES = 'anteriores'
+
+_contadores = Counter()
+_lock = threading.Lock()
+
+
+def obtener_cache():
+    return caches[getattr(settings, 'FIRMAS_CACHE', 'default')]
+
+
+def contar(nombre, evento):
+    with _lock:
+        _contadores[nombre, evento] += 1
+
+
+def estadisticas():
+    '''
+    Devuelve los contadores del proceso como un diccionario
+    {nombre: {evento: cantidad}}.
+    '''
+    resultado = dict()
+    with _lock:
+        for (nombre, evento), cantidad in _contadores.items():
+            resultado.setdefault(nombre, dict())[evento] = cantidad
+    return resultado
+
+
+def reiniciar_estadisticas():
+    with _lock:
+        _contadores.clear()
+
+
+def obtener(clave, version, calcular, nombre=None, ttl=TTL):
+    '''
+    Devuelve la tupla (version, valor) guardada en la clave, calculando el
+    valor con `calcular` si no esta o corresponde a otra version.
+
+    Si otro proceso ya esta recalculando la clave se devuelve el valor de la
+    version anterior, por lo que la version devuelta puede no ser la pedida.
+    '''
+    nombre = nombre or clave
+    cache = obtener_cache()
+    guardado = cache.get(clave)
+    if guardado is not None and guardado[0] == version:
+        contar(nombre, ACIERTOS)
+        return guardado
+    contar(nombre, FALLOS)
+    lock = clave + ':lock'
+    if cache.add(lock, True, TTL_LOCK):
+        try:
+            guardado = (version, calcular())
+            cache.set(clave, guardado, ttl)
+            return guardado
+        finally:
+            cache.delete(lock)
+    if guardado is not None:
+        contar(nombre, ANTERIORES)
+        return guardado
+    limite = time.time() + ESPERA_MAXIMA
+    while time.time() < limite:
+        time.sleep(ESPERA)
+        guardado = cache.get(clave)
+        if guardado is not None and guardado[0] == version:
+            return guardado
+    return version, calcular()
+
+
+def guardar(clave, version, valor, ttl=TTL):
+    obtener_cache().set(clave, (version, valor), ttl)
+
+
+def borrar(clave):
+    obtener_cache().delete(clave)
@@ -0,0 +1,280 @@
+'''
+Clasificación de direcciones IP y puertos en las clases de tráfico activas.
+
+Las subredes de cada grupo y familia (IPv4 o IPv6) se guardan en un árbol de
+prefijos comprimido (Patricia) que resuelve la coincidencia de prefijo más
+largo recorriendo a lo sumo un nodo por bit distinto. Los rangos de puertos
+se dividen en segmentos disjuntos que se buscan por bisección. El índice se
+arma en memoria y se reconstruye cuando cambia la version publicada.
+'''
+import bisect
+import ipaddress
+import threading
+from collections import Counter, defaultdict
+from . import firmas, models, parseo
+
+# protocolos aceptados en las consultas
+PROTOCOLOS = {'tcp': 6, 'udp': 17, '6': 6, '17': 17, '0': 0, '': 0}
+
+# posiciones de cada nodo del arbol
+RED, PREFIJO, VALOR, HIJOS = 0, 1, 2, 3
+
+
+class Trie(object):
+    '''
+    Arbol de prefijos comprimido de direcciones de `bits` bits. Cada nodo es
+    una lista [red, prefijo, valor, hijos] donde los hijos se indexan por el
+    bit siguiente al prefijo.
+    '''
+
+    def __init__(self, bits=models.BITS):
+        self.bits = bits
+        self.raiz = [0, 0, None, [None, None]]
+
+    def mascara(self, prefijo):
+        return ((1 << prefijo) - 1) << (self.bits - prefijo)
+
+    def insertar(self, red, prefijo, valor):
+        '''
+        Asocia el valor a la red red/prefijo, donde red es un entero.
+        '''
+        bits = self.bits
+        red &= self.mascara(prefijo)
+        nodo = self.raiz
+        while True:
+            if nodo[PREFIJO] == prefijo:
+                nodo[VALOR] = valor
+                return
+            bit = (red >> (bits - 1 - nodo[PREFIJO])) & 1
+            hijo = nodo[HIJOS][bit]
+            if hijo is None:
+                nodo[HIJOS][bit] = [red, prefijo, valor, [None, None]]
+                return
+            comun = min(hijo[PREFIJO], prefijo,
+                        bits - (hijo[RED] ^ red).bit_length())
+            if comun == hijo[PREFIJO]:
+                nodo = hijo
+                continue
+            # divido la rama en el primer bit en que difieren
+            interno = [red & self.mascara(comun), comun, None, [None, None]]
+            interno[HIJOS][(hijo[RED] >> (bits - 1 - comun)) & 1] = hijo
+            if comun == prefijo:
+                interno[VALOR] = valor
+            else:
+                interno[HIJOS][(red >> (bits - 1 - comun)) & 1] = \
+                    [red, prefijo, valor, [None, None]]
+            nodo[HIJOS][bit] = interno
+            return
+
+    def buscar(self, ip):
+        '''
+        Devuelve el nodo con el prefijo mas largo que contiene a la ip o None
+        si ninguna red la contiene.
+        '''
+        nodos = self.coincidencias(ip)
+        return nodos[0] if nodos else None
+
+    def coincidencias(self, ip):
+        '''
+        Devuelve los nodos de las redes que contienen a la ip, del prefijo mas
+        largo al mas corto.
+        '''
+        bits = self.bits
+        nodo = self.raiz
+        nodos = [nodo] if nodo[VALOR] is not None else []
+        prefijo = 0
+        while prefijo < bits:
+            nodo = nodo[HIJOS][(ip >> (bits - 1 - prefijo)) & 1]
+            if nodo is None:
+                break
+            prefijo = nodo[PREFIJO]
+            if (ip ^ nodo[RED]) >> (bits - prefijo):
+                break
+            if nodo[VALOR] is not None:
+                nodos.append(nodo)
+        nodos.reverse()
+        return nodos
+
+
+class Rangos(object):
+    '''
+    Rangos de puertos divididos en segmentos disjuntos. Cada segmento tiene,
+    por protocolo, las clases de los rangos que lo cubren.
+    '''
+
+    def __init__(self, rangos=()):
+        eventos = defaultdict(list)
+        for numero, hasta, protocolo, clase in rangos:
+            eventos[numero].append((1, protocolo, clase))
+            eventos[hasta + 1].append((-1, protocolo, clase))
+        self.puntos = sorted(eventos)
+        self.segmentos = list()
+        activos = Counter()
+        for punto in self.puntos:
+            for signo, protocolo, clase in eventos[punto]:
+                activos[protocolo, clase] += signo
+            segmento = defaultdict(set)
+            for (protocolo, clase), cantidad in activos.items():
+                if cantidad:
+                    segmento[protocolo].add(clase)
+            self.segmentos.append(dict(segmento))
+
+    def buscar(self, puerto):
+        '''
+        Devuelve un diccionario protocolo -> clases de los rangos que
+        contienen al puerto.
+        '''
+        i = bisect.bisect_right(self.puntos, puerto) - 1
+        if i < 0:
+            return {}
+        return self.segmentos[i]
+
+
+class Indice(object):
+    '''
+    Indice en memoria de las subredes y puertos de las clases activas, por
+    grupo.
+    '''
+
+    def __init__(self, version=''):
+        self.version = version
+        # un arbol por grupo y familia, indexado por la primera direccion de
+        # la familia. Las redes se guardan relativas a esa direccion.
+        self.redes = {grupo: {0: Trie(models.BITS),
+                              models.IPV6: Trie(models.BITS_IPV6)}
+                      for grupo in (models.INSIDE, models.OUTSIDE)}
+        # rangos de puertos con los ids de sus clases, por grupo
+        self.puertos = {grupo: Rangos() for grupo in (models.INSIDE,
+                                                      models.OUTSIDE)}
+        # clases que tienen al menos un puerto en el grupo
+        self.con_puertos = {grupo: set() for grupo in (models.INSIDE,
+                                                       models.OUTSIDE)}
+
+    @classmethod
+    def construir(cls, version=''):
+        indice = cls(version)
+        redes = defaultdict(set)
+        consulta = (models.ClaseCIDR.objects
+                                    .filter(clase__activa=True)
+                                    .values_list('clase_id', 'grupo',
+                                                 'cidr__inicio',
+                                                 'cidr__prefijo'))
+        for clase, grupo, inicio, prefijo in consulta:
+            redes[grupo, inicio, prefijo].add(clase)
+        for (grupo, inicio, prefijo), clases in redes.items():
+            primera = models.familia(inicio)[1]
+            indice.redes[grupo][primera].insertar(inicio - primera, prefijo,
+                                                  sorted(clases))
+
+        consulta = (models.ClasePuerto.objects
+                                      .filter(clase__activa=True)
+                                      .values_list('clase_id', 'grupo',
+                                                   'puerto__numero',
+                                                   'puerto__hasta',
+                                                   'puerto__protocolo'))
+        rangos = defaultdict(list)
+        for clase, grupo, numero, hasta, protocolo in consulta:
+            rangos[grupo].append((numero, hasta, protocolo, clase))
+            indice.con_puertos[grupo].add(clase)
+        for grupo, lista in rangos.items():
+            indice.puertos[grupo] = Rangos(lista)
+        return indice
+
+    def clasificar(self, ip=None, puerto=None, protocolo=None):
+        '''
+        Clasifica una ip y/o un puerto. Para cada grupo devuelve la subred
+        mas especifica que contiene a la ip y tiene clases que coinciden, y
+        esas clases. Si ninguna subred tiene clases que coincidan se devuelve
+        la mas especifica sin clases.
+
+        Una clase coincide si tiene la subred y, cuando se indica un puerto,
+        si tiene ese puerto o no tiene puertos en el grupo. Si no se indica
+        ip coinciden las clases que tienen el puerto. Un puerto sin protocolo
+        coincide con cualquier protocolo y viceversa.
+        '''
+        resultado = dict()
+        for grupo, nombre in ((models.INSIDE, 'inside'),
+                              (models.OUTSIDE, 'outside')):
+            por_puerto = None
+            if puerto is not None:
+                puertos = self.puertos[grupo].buscar(puerto)
+                if protocolo:
+                    por_puerto = (puertos.get(protocolo, set()) |
+                                  puertos.get(0, set()))
+                else:
+                    por_puerto = set().union(*puertos.values())
+            subred = None
+            if ip is not None:
+                primera = models.familia(ip)[1]
+                clases = list()
+                for nodo in self.redes[grupo][primera].coincidencias(
+                        ip - primera):
+                    coinciden = [clase for clase in nodo[VALOR]
+                                 if por_puerto is None or
+                                 clase in por_puerto or
+                                 clase not in self.con_puertos[grupo]]
+                    if subred is None or coinciden:
+                        red = models.entero_a_ip(primera + nodo[RED])
+                        subred = "%s/%d" % (red, nodo[PREFIJO])
+                        clases = coinciden
+                    if coinciden:
+                        break
+            else:
+                clases = sorted(por_puerto or ())
+            resultado[nombre] = {'subred': subred, 'clases': clases}
+        return resultado
+
+
+_indice = None
+_lock = threading.Lock()
+
+
+def obtener_indice():
+    '''
+    Devuelve el indice de la version publicada, reconstruyendolo si la
+    version cambio.
+    '''
+    global _indice
+    version = firmas.leer_version()
+    indice = _indice
+    if indice is not None and indice.version == version:
+        return indice
+    with _lock:
+        if _indice is None or _indice.version != version:
+            _indice = Indice.construir(version)
+        return _indice
+
+
+def parsear_consulta(consulta):
+    '''
+    Convierte una consulta {"ip", "puerto", "protocolo"} en la tupla de
+    argumentos de Indice.clasificar. Lanza ValueError si no es valida.
+    '''
+    if not isinstance(consulta, dict):
+        raise ValueError("La consulta debe ser un objeto")
+    ip = consulta.get('ip')
+    puerto = consulta.get('puerto')
+    protocolo = consulta.get('protocolo')
+    if ip is None and puerto is None:
+        raise ValueError("La consulta debe tener ip o puerto")
+    if ip is not None:
+        try:
+            direccion = ipaddress.ip_address(ip)
+        except (TypeError, ValueError):
+            raise ValueError("%s: Direccion invalida" % (ip,))
+        ip = int(direccion)
+        if direccion.version == 6:
+            ip += models.IPV6
+    if puerto is not None:
+        try:
+            puerto = int(puerto)
+        except (TypeError, ValueError):
+            raise ValueError("%s: Puerto invalido" % (puerto,))
+        if not parseo.PUERTO_MIN <= puerto <= parseo.PUERTO_MAX:
+            raise ValueError("%s: Puerto invalido" % puerto)
+    if protocolo is not None:
+        protocolo = PROTOCOLOS.get(str(protocolo).lower())
+        if protocolo is None:
+            raise ValueError("%s: Protocolo desconocido"
+                             % consulta['protocolo'])
+    return ip, puerto, protocolo
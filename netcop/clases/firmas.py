@@ -0,0 +1,706 @@
+'''
+Generación y publicación de la base de firmas que descargan los agentes.
+
+Cada vez que cambian las clases de tráfico se genera una nueva version y se
+serializa el conjunto completo de clases en un archivo inmutable dentro de
+MEDIA_ROOT, de modo que las descargas no necesiten consultar la base de datos.
+
+La version es un hash del contenido publicado. Cada clase guarda la huella
+(sha256) de su contenido y la version se obtiene combinando las huellas de
+todas las clases con una suma módulo 2^256, de modo que al modificar una
+clase solo se recalcula su huella y una modificación que no cambia el
+contenido no genera una nueva version. La base de datos es la fuente de
+verdad: la última fila de Version es la version vigente y el archivo de
+version en MEDIA_ROOT es su copia local para responder sin consultas. Cada
+vez que vence la version guardada en la cache se compara el archivo con la
+base de datos, de modo que los servidores publican las versiones que
+registran los demás.
+
+Junto con la huella se guarda en ClasePublicada una copia desnormalizada de
+la clase con sus listas ya formateadas, de la que se arman la descarga
+completa y los deltas con una unica consulta sin joins. Ambas se actualizan
+en la misma transaccion que registra la version, y los formularios y la
+importacion en lote la ejecutan en la misma transaccion que modifica la
+clase.
+
+Con FIRMAS_STREAMING en settings la descarga completa en json se entrega de a
+bloques (ver descarga_continua): se lee del snapshot o, si no existe, se
+genera recorriendo las clases publicadas por lotes, sin cargar el documento
+entero en memoria.
+
+La version publicada y las descargas se guardan en la cache (ver el módulo
+cache), que se actualiza al publicar una nueva version.
+
+Dentro de las vistas que leen de replicas (ver el módulo replicas) el
+contenido de una version solo se lee de la replica si ya tiene registrada esa
+version; la publicación siempre usa la base principal.
+'''
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import zlib
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Q, Value, When
+from django.dispatch import Signal
+from . import binario, cache, models, normalizacion, replicas
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# cantidad de snapshots que se conservan en disco
+SNAPSHOTS_A_CONSERVAR = 5
+# cantidad de versiones hacia atras para las que se puede pedir un delta
+DELTA_MAX_VERSIONES = 100
+
+# segundos que se usa la version guardada en la cache sin volver a leer el
+# archivo de version
+TTL_VERSION = 5
+CLAVE_VERSION = 'firmas:version'
+
+# se envia cuando este proceso escribe una nueva version en MEDIA_ROOT
+version_publicada = Signal(providing_args=['version'])
+
+JSON = 'json'
+BINARIO = 'bin'
+FORMATOS = (JSON, BINARIO)
+
+# campos de cada clase en la descarga
+CAMPOS = ('id', 'nombre', 'descripcion', 'activa')
+LISTAS = ('subredes_outside', 'subredes_inside', 'puertos_outside',
+          'puertos_inside')
+# columnas de ClasePublicada con los CAMPOS y las LISTAS
+COLUMNAS = ('clase', 'nombre', 'descripcion', 'activa') + LISTAS
+
+
+def comprimir_gzip(datos):
+    # mtime fijo para que el mismo contenido genere siempre el mismo archivo
+    salida = io.BytesIO()
+    with gzip.GzipFile(fileobj=salida, mode='wb', mtime=0) as f:
+        f.write(datos)
+    return salida.getvalue()
+
+
+class CompresorBrotli(object):
+    '''
+    Compresor brotli de a bloques con la interfaz de zlib.compressobj.
+    '''
+
+    def __init__(self):
+        self.compresor = brotli.Compressor()
+
+    def compress(self, datos):
+        return self.compresor.process(datos)
+
+    def flush(self):
+        return self.compresor.finish()
+
+
+# codificaciones de Content-Encoding soportadas, en orden de preferencia, con
+# la extension de su snapshot, la funcion que comprime y la que crea un
+# compresor de a bloques
+COMPRESORES = OrderedDict()
+if brotli is not None:
+    COMPRESORES['br'] = ('br', brotli.compress, CompresorBrotli)
+if zstandard is not None:
+    COMPRESORES['zstd'] = ('zst',
+                           lambda datos: zstandard.ZstdCompressor().compress(
+                               datos),
+                           lambda: zstandard.ZstdCompressor().compressobj())
+COMPRESORES['gzip'] = ('gz', comprimir_gzip,
+                       lambda: zlib.compressobj(wbits=16 + zlib.MAX_WBITS))
+COMPRESORES['deflate'] = ('zz', zlib.compress, zlib.compressobj)
+
+# bytes que se leen de un snapshot por cada bloque de una descarga continua
+TAMANIO_BLOQUE = 64 * 1024
+
+# permisos de los archivos publicados, los mismos que tendria un archivo
+# creado con open segun la umask del proceso. La umask solo puede leerse
+# cambiandola, por eso se lee una vez al importar el modulo.
+_umask = os.umask(0)
+os.umask(_umask)
+PERMISOS = 0o666 & ~_umask
+
+
+def obtener_clases(clases=None):
+    '''
+    Arma la lista de clases con una cantidad fija de consultas: una para las
+    clases, una para las subredes y otra para los puertos. Las colecciones se
+    agrupan en memoria por clase y grupo.
+
+    Si se pasa un queryset de clases solo se incluyen esas.
+    '''
+    consulta_redes = (models.ClaseCIDR.objects
+                                      .order_by('id')
+                                      .select_related('cidr'))
+    consulta_puertos = (models.ClasePuerto.objects
+                                          .order_by('id')
+                                          .select_related('puerto'))
+    if clases is None:
+        clases = models.ClaseTrafico.objects.all()
+    else:
+        consulta_redes = consulta_redes.filter(clase__in=clases)
+        consulta_puertos = consulta_puertos.filter(clase__in=clases)
+
+    redes = defaultdict(list)
+    for item in consulta_redes:
+        redes[item.clase_id, item.grupo].append(str(item.cidr))
+
+    puertos = defaultdict(list)
+    for item in consulta_puertos:
+        puertos[item.clase_id, item.grupo].append(str(item.puerto))
+
+    lista = list()
+    for clase in clases.order_by('id'):
+        r = dict()
+        r['id'] = clase.id
+        r['nombre'] = clase.nombre
+        r['descripcion'] = clase.descripcion
+        r['activa'] = clase.activa
+        r['subredes_outside'] = redes[clase.id, models.OUTSIDE]
+        r['subredes_inside'] = redes[clase.id, models.INSIDE]
+        r['puertos_outside'] = puertos[clase.id, models.OUTSIDE]
+        r['puertos_inside'] = puertos[clase.id, models.INSIDE]
+        lista.append(r)
+    return lista
+
+
+def publicada(clase):
+    '''
+    Devuelve la copia publicada de una clase con el formato de
+    obtener_clases.
+    '''
+    return models.ClasePublicada(
+        clase_id=clase['id'],
+        nombre=clase['nombre'],
+        descripcion=clase['descripcion'],
+        activa=clase['activa'],
+        **{campo: '\n'.join(clase[campo]) for campo in LISTAS}
+    )
+
+
+def clase_publicada(fila):
+    '''
+    Convierte una fila con las COLUMNAS de ClasePublicada en una clase con el
+    formato de obtener_clases.
+    '''
+    r = dict(zip(CAMPOS, fila[:len(CAMPOS)]))
+    for campo, texto in zip(LISTAS, fila[len(CAMPOS):]):
+        r[campo] = texto.split('\n') if texto else []
+    return r
+
+
+def clases_publicadas(clases=None):
+    '''
+    Arma la lista de clases con el formato de obtener_clases a partir de su
+    copia publicada, con una unica consulta y sin formatear subredes ni
+    puertos.
+
+    Si se pasa un queryset de clases solo se incluyen esas.
+    '''
+    consulta = models.ClasePublicada.objects.order_by('clase')
+    if clases is not None:
+        consulta = consulta.filter(clase__in=clases)
+    return [clase_publicada(fila)
+            for fila in consulta.values_list(*COLUMNAS)]
+
+
+def lotes_publicados(using=None, tamanio=models.TAMANIO_LOTE):
+    '''
+    Recorre las clases publicadas en el mismo orden que clases_publicadas en
+    listas de a lo sumo `tamanio` clases. Cada lote se lee a continuacion del
+    id de la ultima clase del anterior, para no tener todas las clases en
+    memoria.
+    '''
+    consulta = (models.ClasePublicada.objects.using(using)
+                                             .order_by('clase')
+                                             .values_list(*COLUMNAS))
+    ultima = 0
+    while True:
+        lote = list(consulta.filter(clase__gt=ultima)[:tamanio])
+        if lote:
+            yield [clase_publicada(fila) for fila in lote]
+        if len(lote) < tamanio:
+            return
+        ultima = lote[-1][0]
+
+
+def iterar_json(version, using=None):
+    '''
+    Genera de a bloques el documento completo en json, con los mismos bytes
+    que serializar(documento(version)). Si se publica otra version mientras
+    se recorre, los lotes siguientes pueden tener el contenido nuevo.
+    '''
+    prefijo = '{"version": %s, "clases": [' % json.dumps(version)
+    separador = ''
+    for clases in lotes_publicados(using):
+        bloque = ', '.join(json.dumps(clase) for clase in clases)
+        yield (prefijo + separador + bloque).encode('utf-8')
+        prefijo, separador = '', ', '
+    yield (prefijo + ']}').encode('utf-8')
+
+
+def documento(version):
+    '''
+    Devuelve el documento completo que se entrega a los agentes.
+    '''
+    return {'version': version, 'clases': clases_publicadas()}
+
+
+@contextmanager
+def lectura_al_dia(version):
+    '''
+    Lee el contenido de la version de la replica del pedido si ya tiene
+    registrada la version o, si esta atrasada, de la base principal.
+    '''
+    alias = replicas.replica_actual()
+    if (alias and version and
+            not models.Version.objects.using(alias)
+                                      .filter(numero=version).exists()):
+        with replicas.principal():
+            yield
+    else:
+        yield
+
+
+def obtener_delta(desde):
+    '''
+    Devuelve un documento con las clases agregadas, modificadas o
+    desactivadas despues de la version `desde`.
+
+    Devuelve None si la version es desconocida, es demasiado vieja o alguna
+    version posterior no tiene registrados sus cambios. En ese caso el agente
+    debe descargar la base completa.
+    '''
+    try:
+        base = models.Version.objects.get(numero=desde)
+    except models.Version.DoesNotExist:
+        return None
+    posteriores = models.Version.objects.filter(id__gt=base.id)
+    if (posteriores.count() > DELTA_MAX_VERSIONES or
+            posteriores.filter(completa=True).exists()):
+        return None
+    actual = posteriores.order_by('id').last() or base
+    cambios = models.Cambio.objects.filter(version__id__gt=base.id)
+    clases = models.ClaseTrafico.objects.filter(
+        id__in=cambios.values('clase_id'))
+    return {
+        'version': actual.numero,
+        'desde': base.numero,
+        'clases': clases_publicadas(clases),
+    }
+
+
+def ruta_version():
+    return os.path.join(settings.MEDIA_ROOT, 'version')
+
+
+def ruta_snapshot(version, formato=JSON, codificacion=None):
+    nombre = '%s.%s' % (version, formato)
+    if codificacion:
+        nombre += '.' + COMPRESORES[codificacion][0]
+    return os.path.join(settings.MEDIA_ROOT, 'firmas', nombre)
+
+
+def leer_snapshot(version):
+    '''
+    Devuelve el documento publicado para la version o None si no existe su
+    snapshot.
+    '''
+    try:
+        with open(ruta_snapshot(version), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def leer_archivo_version():
+    '''
+    Devuelve la version del archivo de version o una cadena vacia si todavia
+    no se publico ninguna. Si el archivo no existe o no tiene la version
+    vigente en la base de datos, por ejemplo en un servidor nuevo o porque
+    otro servidor publico una version, se materializa la version registrada
+    en la base de datos. Si hay clases pero ninguna version registrada, como
+    al actualizar desde una instalacion sin historial de versiones, se
+    publica la version del contenido actual.
+    '''
+    try:
+        with open(ruta_version(), 'r') as f:
+            local = f.read()
+    except FileNotFoundError:
+        local = None
+    with replicas.principal():
+        vigente = ultima_version()
+        if not vigente and models.ClaseTrafico.objects.exists():
+            return publicar()
+    if local is None or local != vigente:
+        return sincronizar()
+    return local
+
+
+def estado_publicado():
+    '''
+    Devuelve la tupla (version, fecha de publicacion) de la version
+    publicada, usando la cache para no leer el archivo ni consultar la base
+    de datos en cada consulta.
+    '''
+    valor = cache.obtener_cache().get(CLAVE_VERSION)
+    if valor is not None:
+        cache.contar('version', cache.ACIERTOS)
+        return valor
+    cache.contar('version', cache.FALLOS)
+    return guardar_estado(leer_archivo_version())
+
+
+def guardar_estado(version):
+    try:
+        mtime = os.path.getmtime(ruta_version())
+    except FileNotFoundError:
+        fecha = None
+    else:
+        fecha = datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+    valor = (version, fecha)
+    cache.obtener_cache().set(CLAVE_VERSION, valor, TTL_VERSION)
+    return valor
+
+
+def leer_version():
+    '''
+    Devuelve la version publicada o una cadena vacia si todavia no se publico
+    ninguna.
+    '''
+    return estado_publicado()[0]
+
+
+def ultima_version():
+    '''
+    Devuelve la version vigente registrada en la base de datos o una cadena
+    vacia si no hay ninguna.
+    '''
+    return (models.Version.objects.order_by('-id')
+                                  .values_list('numero', flat=True)
+                                  .first() or '')
+
+
+def fecha_version():
+    '''
+    Devuelve la fecha en que se publico la version actual o None si todavia
+    no se publico ninguna.
+    '''
+    return estado_publicado()[1]
+
+
+def descarga(formato=JSON, codificacion=None):
+    '''
+    Devuelve la tupla (version, datos) con la descarga completa de la version
+    publicada en el formato y la codificacion indicados. Los datos se leen del
+    snapshot, o se generan si no existe, y se guardan en la cache.
+    '''
+    version = leer_version()
+
+    def calcular():
+        if version:
+            try:
+                with open(ruta_snapshot(version, formato, codificacion),
+                          'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+        with lectura_al_dia(version):
+            contenido = documento(version)
+        return comprimir(serializar(contenido, formato), codificacion)
+
+    clave = 'firmas:descarga:%s:%s' % (formato, codificacion or '')
+    return cache.obtener(clave, version, calcular, nombre='descarga')
+
+
+def descarga_continua(codificacion=None):
+    '''
+    Devuelve la tupla (version, bloques, largo) con la descarga completa en
+    json de la version publicada como un iterador de bloques de bytes. Los
+    bloques se leen del snapshot o, si no existe, se generan con iterar_json
+    y se comprimen a medida que se envian; en ese caso el largo es None.
+
+    La base de la que se leen las clases se elige al llamarla, porque los
+    bloques se generan despues de que termina la vista.
+    '''
+    version = leer_version()
+    if version:
+        try:
+            f = open(ruta_snapshot(version, JSON, codificacion), 'rb')
+        except FileNotFoundError:
+            pass
+        else:
+            return version, leer_bloques(f), os.fstat(f.fileno()).st_size
+    with lectura_al_dia(version):
+        using = models.ClasePublicada.objects.all().db
+    bloques = iterar_json(version, using)
+    if codificacion:
+        bloques = comprimir_bloques(bloques, codificacion)
+    return version, bloques, None
+
+
+def leer_bloques(f):
+    with f:
+        for bloque in iter(lambda: f.read(TAMANIO_BLOQUE), b''):
+            yield bloque
+
+
+def comprimir_bloques(bloques, codificacion):
+    compresor = COMPRESORES[codificacion][2]()
+    for bloque in bloques:
+        datos = compresor.compress(bloque)
+        if datos:
+            yield datos
+    yield compresor.flush()
+
+
+def descarga_delta(desde, codificacion=None):
+    '''
+    Devuelve la tupla (version, datos) con el delta en json desde la version
+    `desde`, o datos None si no se puede calcular el delta.
+    '''
+    def calcular():
+        with lectura_al_dia(version):
+            documento = obtener_delta(desde)
+        if documento is None:
+            return None
+        return comprimir(serializar(documento), codificacion)
+
+    version = leer_version()
+    clave = 'firmas:delta:%s:%s' % (
+        hashlib.sha1(desde.encode('utf-8')).hexdigest(), codificacion or '')
+    return cache.obtener(clave, version, calcular, nombre='delta')
+
+
+def descarga_normalizada(formato=JSON, codificacion=None):
+    '''
+    Devuelve la tupla (version, (datos, resumen)) con la descarga normalizada
+    de la version publicada, calculada a partir de su snapshot, y el resumen
+    de entradas eliminadas.
+    '''
+    version = leer_version()
+
+    def calcular():
+        contenido = leer_snapshot(version) if version else None
+        if contenido is None:
+            with lectura_al_dia(version):
+                contenido = documento(version)
+        contenido = normalizacion.normalizar(contenido)
+        datos = comprimir(serializar(contenido, formato), codificacion)
+        return datos, contenido['normalizacion']
+
+    clave = 'firmas:normalizado:%s:%s' % (formato, codificacion or '')
+    return cache.obtener(clave, version, calcular, nombre='normalizado')
+
+
+def serializar(documento, formato=JSON):
+    '''
+    Devuelve el documento serializado en el formato indicado.
+    '''
+    if formato == BINARIO:
+        return binario.escribir(documento['version'], documento['clases'])
+    return json.dumps(documento).encode('utf-8')
+
+
+def comprimir(datos, codificacion=None):
+    if codificacion is None:
+        return datos
+    return COMPRESORES[codificacion][1](datos)
+
+
+def escribir_archivo(path, datos):
+    '''
+    Escribe los datos en un temporal y lo renombra para que nunca se sirva
+    un archivo a medio escribir.
+    '''
+    directorio = os.path.dirname(path)
+    os.makedirs(directorio, exist_ok=True)
+    fd, temporal = tempfile.mkstemp(dir=directorio, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # mkstemp crea el archivo legible solo por el dueño
+            os.fchmod(f.fileno(), PERMISOS)
+            f.write(datos)
+        os.replace(temporal, path)
+    except BaseException:
+        # tambien ante KeyboardInterrupt o SystemExit se borra el temporal
+        os.unlink(temporal)
+        raise
+
+
+def escribir_snapshot(version):
+    '''
+    Serializa las clases en los archivos json y binario correspondientes a la
+    version, junto con sus variantes comprimidas, para no tener que
+    comprimirlos en cada descarga.
+    '''
+    contenido = documento(version)
+    for formato in FORMATOS:
+        datos = serializar(contenido, formato)
+        escribir_archivo(ruta_snapshot(version, formato), datos)
+        for codificacion in COMPRESORES:
+            escribir_archivo(ruta_snapshot(version, formato, codificacion),
+                             comprimir(datos, codificacion))
+    return ruta_snapshot(version)
+
+
+def limpiar_snapshots():
+    '''
+    Borra los snapshots viejos conservando los de las versiones mas recientes.
+    '''
+    directorio = os.path.join(settings.MEDIA_ROOT, 'firmas')
+    versiones = defaultdict(list)
+    for nombre in os.listdir(directorio):
+        if nombre.endswith('.tmp'):
+            continue
+        version = nombre.split('.')[0]
+        versiones[version].append(os.path.join(directorio, nombre))
+    ordenadas = sorted(versiones.values(),
+                       key=lambda archivos: max(map(os.path.getmtime,
+                                                    archivos)),
+                       reverse=True)
+    for archivos in ordenadas[SNAPSHOTS_A_CONSERVAR:]:
+        for path in archivos:
+            os.unlink(path)
+
+
+def huella(clase):
+    '''
+    Devuelve el sha256 de la representacion canonica de una clase con el
+    formato de la descarga: claves ordenadas y listas ordenadas.
+    '''
+    canonica = {campo: sorted(valor) if isinstance(valor, list) else valor
+                for campo, valor in clase.items()}
+    contenido = json.dumps(canonica, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+
+
+def actualizar_huellas(clases=None):
+    '''
+    Recalcula las huellas y las copias publicadas de las clases indicadas por
+    id, o de todas si no se indican, y de las que todavia no tienen huella o
+    copia publicada.
+    '''
+    consulta = models.ClaseTrafico.objects.all()
+    if clases is not None:
+        consulta = consulta.filter(Q(id__in=list(clases)) | Q(huella='') |
+                                   Q(publicada__isnull=True))
+    ids = list(consulta.order_by('id').values_list('id', flat=True))
+    for lote in models.en_lotes(ids):
+        contenido = obtener_clases(
+            models.ClaseTrafico.objects.filter(id__in=lote))
+        huellas = {clase['id']: huella(clase) for clase in contenido}
+        models.ClaseTrafico.objects.filter(id__in=lote).update(huella=Case(
+            *[When(id=id, then=Value(valor)) for id, valor in huellas.items()]
+        ))
+        models.ClasePublicada.objects.filter(clase_id__in=lote).delete()
+        models.ClasePublicada.objects.bulk_create(
+            publicada(clase) for clase in contenido)
+
+
+def calcular_version():
+    '''
+    Combina las huellas guardadas de todas las clases en el numero de
+    version. Como la suma no depende del orden no hace falta ordenar las
+    clases ni volver a serializarlas.
+    '''
+    suma = 0
+    for valor in models.ClaseTrafico.objects.values_list('huella', flat=True):
+        suma += int(valor, 16)
+    suma %= 1 << 256
+    return hashlib.sha256(suma.to_bytes(32, 'big')).hexdigest()
+
+
+def registrar_version(version, clases=None):
+    '''
+    Registra la version en el historial junto con las clases que cambiaron.
+    Si no se indican las clases la version se marca como completa.
+    Las versiones que ya no sirven para calcular deltas se eliminan.
+
+    Si el contenido vuelve a ser el de una version anterior, esa version se
+    reemplaza por la nueva para que quede como la ultima. La nueva conserva
+    los cambios de la reemplazada, que siguen haciendo falta para los deltas
+    desde las versiones anteriores a ella.
+    '''
+    completa = clases is None
+    cambios = set(clases or ())
+    anterior = models.Version.objects.filter(numero=version).first()
+    if anterior is not None:
+        completa = completa or anterior.completa
+        cambios.update(anterior.cambios.values_list('clase_id', flat=True))
+        anterior.delete()
+    registro = models.Version.objects.create(numero=version,
+                                             completa=completa)
+    models.Cambio.objects.bulk_create(
+        models.Cambio(version=registro, clase_id=clase_id)
+        for clase_id in cambios
+    )
+    vigentes = models.Version.objects.order_by('-id')[:DELTA_MAX_VERSIONES + 1]
+    models.Version.objects.filter(id__lt=min(v.id for v in vigentes)).delete()
+
+
+def sincronizar():
+    '''
+    Escribe el snapshot y el archivo de version de la version vigente en la
+    base de datos si la copia local no esta al dia. Devuelve la version.
+    '''
+    with replicas.principal():
+        version = ultima_version()
+        if not version:
+            return ''
+        try:
+            with open(ruta_version(), 'r') as f:
+                local = f.read()
+        except FileNotFoundError:
+            local = ''
+        if local != version or not os.path.exists(ruta_snapshot(version)):
+            escribir_snapshot(version)
+            escribir_archivo(ruta_version(), version.encode('ascii'))
+            limpiar_snapshots()
+            guardar_estado(version)
+            version_publicada.send(sender=None, version=version)
+        return version
+
+
+def registrar_cambios(clases=None):
+    '''
+    Actualiza las huellas y las copias publicadas de las clases modificadas,
+    calcula la version del contenido y, si cambio, la registra. Devuelve la
+    version.
+
+    `clases` son los ids de las clases modificadas: solo se recalculan sus
+    huellas y con ellas se arma el delta para los agentes que tienen la
+    version anterior. Si no se indican se recalculan todas.
+    '''
+    with transaction.atomic():
+        actualizar_huellas(clases)
+        version = calcular_version()
+        if version != ultima_version():
+            registrar_version(version, clases)
+    return version
+
+
+def publicar(clases=None):
+    '''
+    Registra la version del contenido actual con registrar_cambios, escribe
+    su snapshot y recien entonces la publica en el archivo de version. El
+    archivo de version se reemplaza atomicamente, por lo que nunca se lee a
+    medio escribir.
+    '''
+    version = registrar_cambios(clases)
+    sincronizar()
+    return version
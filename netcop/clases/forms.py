@@ -1,20 +1,6 @@
-import re
-import os
-import uuid
-from . import models
+from . import models, firmas, parseo
 from django import forms
-from django.conf import settings
-
-
-REGEX_CIDR = ("^\s*(?P<ip>((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}"
-              "(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?))"
-              "(/(?P<prefijo>\d+))?\s*$")
-REGEX_PUERTO = "^\s*(?P<numero>\d+)(/(?P<protocolo>(tcp|udp)))?\s*$"
-
-PUERTO_MIN = 1
-PUERTO_MAX = 65535
-PREFIJO_MIN = 0
-PREFIJO_MAX = 32
+from django.db import transaction
 
 
 class ClaseForm(forms.ModelForm):
@@ -31,9 +17,9 @@ class ClaseForm(forms.ModelForm):
         required=False,
         help_text="""Lista de redes en Internet (separadas por nueva linea) con
         el formato <strong>direccion/prefijo</strong> donde la direccion es el
-        identificador de red y el prefijo es la cantidad de bits que contiene
-        la máscara de subred. Si no se ingresa un prefijo, se entiende que se
-        trata de una dirección de host.""",
+        identificador de red, IPv4 o IPv6, y el prefijo es la cantidad de bits
+        que contiene la máscara de subred. Si no se ingresa un prefijo, se
+        entiende que se trata de una dirección de host.""",
     )
     puertos_outside = forms.CharField(
         widget=forms.Textarea,
@@ -42,16 +28,17 @@ class ClaseForm(forms.ModelForm):
         con el formato <strong>numero/protocolo</strong> donde el numero es el
         identificador del puerto y el protocolo puede ser 'tcp' o 'udp'. Si no
         se especifica protocolo, se asume que el puerto puede pertenecer a
-        cualquiera de ellos.""",
+        cualquiera de ellos. Un rango de puertos se indica con el formato
+        <strong>desde-hasta/protocolo</strong>.""",
     )
     subredes_inside = forms.CharField(
         widget=forms.Textarea,
         required=False,
         help_text="""Lista de redes en la red local (separadas por nueva linea)
         con el formato <strong>direccion/prefijo</strong> donde la direccion es
-        el identificador de red y el prefijo es la cantidad de bits que
-        contiene la máscara de subred. Si no se ingresa un prefijo, se entiende
-        que se trata de una dirección de host.""",
+        el identificador de red, IPv4 o IPv6, y el prefijo es la cantidad de
+        bits que contiene la máscara de subred. Si no se ingresa un prefijo,
+        se entiende que se trata de una dirección de host.""",
     )
     puertos_inside = forms.CharField(
         widget=forms.Textarea,
@@ -60,24 +47,27 @@ class ClaseForm(forms.ModelForm):
         linea) con el formato <strong>numero/protocolo</strong> donde el numero
         es el identificador del puerto y el protocolo puede ser 'tcp' o 'udp'.
         Si no se especifica protocolo, se asume que el puerto puede pertenecer
-        a cualquiera de ellos.""",
+        a cualquiera de ellos. Un rango de puertos se indica con el formato
+        <strong>desde-hasta/protocolo</strong>.""",
     )
 
     def __init__(self, *args, **kwargs):
         r = super().__init__(*args, **kwargs)
+        # listas ya parseadas por campo: (texto, lista)
+        self.listas = dict()
         if kwargs.get('instance'):
             instance = kwargs.get('instance')
             redes_outside = [
                 str(item.cidr)
                 for item in instance.redes
                                     .filter(grupo=models.OUTSIDE)
-                                    .order_by('cidr__direccion')
+                                    .order_by('cidr__inicio')
             ]
             redes_inside = [
                 str(item.cidr)
                 for item in instance.redes
                                     .filter(grupo=models.INSIDE)
-                                    .order_by('cidr__direccion')
+                                    .order_by('cidr__inicio')
             ]
             puertos_outside = [
                 str(item.puerto)
@@ -98,153 +88,93 @@ class ClaseForm(forms.ModelForm):
         return r
 
     def save(self, *args, **kwargs):
-        clase = super().save(*args, **kwargs)
-        self.actualizar_colecciones(clase, self.cleaned_data)
-        self.calcular_version()
+        with transaction.atomic():
+            clase = super().save(*args, **kwargs)
+            self.actualizar_colecciones(clase, self.cleaned_data)
+            self.calcular_version()
+        firmas.sincronizar()
         return clase
 
     def actualizar_colecciones(self, clase, campos):
         '''
         Actualiza las listas de subredes y puertos de la clase de trafico.
+
+        Se obtienen o crean en lote las subredes y puertos ingresados y solo se
+        borran o insertan las relaciones que cambiaron.
         '''
         redes = (('subredes_outside', models.OUTSIDE),
                  ('subredes_inside', models.INSIDE))
         puertos = (('puertos_outside', models.OUTSIDE),
                    ('puertos_inside', models.INSIDE))
 
-        # borro antiguas relaciones
-        models.ClaseCIDR.objects.filter(clase=clase).delete()
-        models.ClasePuerto.objects.filter(clase=clase).delete()
-
-        # creo las nuevas relaciones
+        items = list()
         for nombre, grupo in redes:
-            string = campos.get(nombre, "")
-            for cidr in self.obtener_cidr(string):
-                clase.redes.get_or_create(clase=clase, cidr=cidr, grupo=grupo)
+            lista = self.obtener_lista(nombre, campos, parseo.subredes)
+            items.extend((red, grupo) for red in lista)
+        ids = models.CIDR.objects.obtener_ids(red for red, grupo in items)
+        models.ClaseCIDR.objects.sincronizar(
+            clase, ((ids[red], grupo) for red, grupo in items))
 
+        items = list()
         for nombre, grupo in puertos:
-            string = campos.get(nombre, "")
-            for puerto in self.obtener_puertos(string):
-                clase.puertos.get_or_create(clase=clase, puerto=puerto,
-                                            grupo=grupo)
-
-    def obtener_cidr(self, string):
-        '''
-        Parsea y devuelve las cidr que contenga el string pasado por parametro.
-        '''
-        p = re.compile(REGEX_CIDR, flags=re.M)
-        for m in p.finditer(string):
-            direccion = m.groupdict().get('ip')
-            prefijo = m.groupdict().get('prefijo') or 32
-            yield models.CIDR.objects.get_or_create(
-                direccion=direccion, prefijo=int(prefijo))[0]
-
-    def obtener_puertos(self, string):
-        '''
-        Parsea y devuelve los puertos que contenga el string pasado por
-        parametro.
-        '''
-        p = re.compile(REGEX_PUERTO, flags=re.I | re.M)
-        for m in p.finditer(string):
-            numero = m.groupdict().get('numero')
-            protocolo = m.groupdict().get('protocolo') or ''
-            protocolo = self.obtener_numero(protocolo)
-            yield models.Puerto.objects.get_or_create(
-                numero=int(numero), protocolo=protocolo)[0]
-
-    def obtener_numero(self, string):
-        '''
-        Obtiene el numero de protocolo en base a una cadena de caracteres.
-        Retornos
-        ---------------
-          * 6 - TCP | tcp
-          * 17 - UDP | udp
-          * 0 en cualquier otro caso.
-        '''
-        if string.lower() == 'tcp':
-            return 6
-        elif string.lower() == 'udp':
-            return 17
-        return 0
+            lista = self.obtener_lista(nombre, campos, parseo.puertos)
+            items.extend((puerto, grupo) for puerto in lista)
+        ids = models.Puerto.objects.obtener_ids(
+            puerto for puerto, grupo in items)
+        models.ClasePuerto.objects.sincronizar(
+            clase, ((ids[puerto], grupo) for puerto, grupo in items))
+
+    def obtener_lista(self, nombre, campos, parsear):
+        '''
+        Devuelve la lista parseada del campo, reutilizando la de la validacion
+        si el texto no cambio.
+        '''
+        texto = campos.get(nombre, "")
+        texto_validado, lista = self.listas.get(nombre, (None, None))
+        if texto_validado != texto:
+            lista = parsear(texto)
+            lista.validar()
+        return lista
 
     def clean_subredes_outside(self):
         '''
         Metodo ejecutado al validar el campo subredes_outside.
         '''
-        data = self.cleaned_data["subredes_outside"]
-        if data:
-            self.validar_subredes(data)
-        return data
+        return self.validar_lista('subredes_outside', parseo.subredes)
 
     def clean_subredes_inside(self):
         '''
         Metodo ejecutado al validar el campo subredes_inside.
         '''
-        data = self.cleaned_data["subredes_inside"]
-        if data:
-            self.validar_subredes(data)
-        return data
+        return self.validar_lista('subredes_inside', parseo.subredes)
 
     def clean_puertos_outside(self):
         '''
         Metodo ejecutado al validar el campo puertos_outside.
         '''
-        data = self.cleaned_data["puertos_outside"]
-        if data:
-            self.validar_puertos(data)
-        return data
+        return self.validar_lista('puertos_outside', parseo.puertos)
 
     def clean_puertos_inside(self):
         '''
         Metodo ejecutado al validar el campo puertos_inside.
         '''
-        data = self.cleaned_data["puertos_inside"]
-        if data:
-            self.validar_puertos(data)
-        return data
+        return self.validar_lista('puertos_inside', parseo.puertos)
 
-    def validar_subredes(self, string):
-        '''
-        Valida que cada subred ingresada sea correcta.
-        '''
-        p = re.compile(REGEX_CIDR)
-        for line in string.splitlines():
-            line = line.strip()
-            if line:
-                m = p.match(line)
-                if m is None:
-                    raise forms.ValidationError("%s: Error de sintaxis" % line)
-                direccion = m.groupdict().get('ip')
-                prefijo = m.groupdict().get('prefijo') or 32
-                if not PREFIJO_MIN <= int(prefijo) <= PREFIJO_MAX:
-                    raise forms.ValidationError(
-                        "%s: El prefijo debe ser entre %d y %d" %
-                        (direccion, PREFIJO_MIN, PREFIJO_MAX)
-                    )
-
-    def validar_puertos(self, string):
-        '''
-        Valida que cada puerto ingresado sea correcto.
-        '''
-        p = re.compile(REGEX_PUERTO, flags=re.I)
-        for line in string.splitlines():
-            line = line.strip()
-            if line:
-                m = p.match(line)
-                if m is None:
-                    raise forms.ValidationError("%s: Error de sintaxis" % line)
-                numero = m.groupdict().get('numero')
-                if not PUERTO_MIN <= int(numero) <= PUERTO_MAX:
-                    raise forms.ValidationError(
-                        "%s: el número de puerto debe ser entre %d y %d" %
-                        (numero, PUERTO_MIN, PUERTO_MAX)
-                    )
+    def validar_lista(self, nombre, parsear):
+        '''
+        Parsea la lista del campo una unica vez, informando todos los errores
+        con su numero de linea, y la guarda para el guardado en lote.
+        '''
+        data = self.cleaned_data[nombre]
+        lista = parsear(data)
+        lista.validar()
+        self.listas[nombre] = (data, lista)
+        return data
 
     def calcular_version(self):
         '''
-        Calcula el nuevo numero de version y lo guarda en un archivo para
-        proximas consultas.
+        Actualiza la huella y la copia publicada de la clase y, si cambio el
+        contenido, registra la nueva version. Se ejecuta en la transaccion que
+        guarda la clase; el snapshot se publica al terminar.
         '''
-        path = os.path.join(settings.MEDIA_ROOT, 'version')
-        with open(path, 'w') as f:
-            f.write(uuid.uuid4().hex)
+        firmas.registrar_cambios(clases=[self.instance.id])
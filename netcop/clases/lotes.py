@@ -0,0 +1,267 @@
+'''
+Importación y exportación de clases de tráfico en formato JSON Lines o CSV.
+
+Los archivos se procesan en lotes de tamaño acotado, de modo que el uso de
+memoria no depende del tamaño del archivo.
+
+JSON Lines
+    Una clase por linea con los mismos campos que la descarga de los agentes
+    (id, nombre, descripcion, activa, subredes_outside, subredes_inside,
+    puertos_outside y puertos_inside). Todos los campos son opcionales salvo
+    el id o el nombre, y una misma clase puede aparecer en varias lineas.
+
+CSV
+    Una subred o puerto por fila con las columnas id, nombre, tipo ('subred'
+    o 'puerto'), grupo ('outside' o 'inside') y valor.
+'''
+import csv
+import json
+from collections import OrderedDict
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from . import firmas, models, normalizacion, parseo
+
+JSONL = 'jsonl'
+CSV = 'csv'
+FORMATOS = (JSONL, CSV)
+
+SUBRED = 'subred'
+PUERTO = 'puerto'
+GRUPOS = OrderedDict((
+    ('outside', models.OUTSIDE),
+    ('inside', models.INSIDE),
+))
+COLUMNAS_CSV = ('id', 'nombre', 'tipo', 'grupo', 'valor')
+# campos de la descarga con el tipo y el grupo de sus elementos
+CAMPOS = (
+    ('subredes_outside', SUBRED, 'outside'),
+    ('subredes_inside', SUBRED, 'inside'),
+    ('puertos_outside', PUERTO, 'outside'),
+    ('puertos_inside', PUERTO, 'inside'),
+)
+
+# tipos de los atributos de la clase en los registros
+TIPOS = (
+    ('nombre', str),
+    ('descripcion', str),
+    ('activa', bool),
+)
+
+# cantidad de subredes y puertos que se acumulan antes de guardarlos
+ENTRADAS_POR_LOTE = 5000
+# cantidad de clases que se leen por consulta al exportar
+CLASES_POR_LOTE = 500
+
+
+def leer_jsonl(archivo):
+    '''
+    Devuelve tuplas (numero de linea, registro) con los registros del archivo.
+    '''
+    for numero, linea in enumerate(archivo, 1):
+        if not linea.strip():
+            continue
+        try:
+            dato = json.loads(linea)
+        except ValueError as e:
+            raise ValueError("linea %d: %s" % (numero, e))
+        if not isinstance(dato, dict):
+            raise ValueError("linea %d: La clase debe ser un objeto" % numero)
+        for campo, tipo, grupo in CAMPOS:
+            if not isinstance(dato.get(campo, []), list):
+                raise ValueError("linea %d: %s: Debe ser una lista" %
+                                 (numero, campo))
+        registro = {
+            'clase': {campo: dato[campo]
+                      for campo in ('id', 'nombre', 'descripcion', 'activa')
+                      if campo in dato},
+            'entradas': [(tipo, grupo, valor)
+                         for campo, tipo, grupo in CAMPOS
+                         for valor in dato.get(campo, ())],
+        }
+        yield numero, registro
+
+
+def leer_csv(archivo):
+    '''
+    Devuelve tuplas (numero de linea, registro) con los registros del archivo.
+    '''
+    lector = csv.DictReader(archivo)
+    for fila in lector:
+        clase = {campo: fila[campo]
+                 for campo in ('id', 'nombre') if fila.get(campo)}
+        registro = {
+            'clase': clase,
+            'entradas': [(fila.get('tipo'), fila.get('grupo'),
+                          fila.get('valor') or '')],
+        }
+        yield lector.line_num, registro
+
+
+LECTORES = {
+    JSONL: leer_jsonl,
+    CSV: leer_csv,
+}
+
+
+class Importacion(object):
+    '''
+    Acumula las subredes y puertos leidos y los guarda en lotes reutilizando
+    las subredes y puertos existentes.
+    '''
+
+    def __init__(self, reemplazar=False):
+        self.reemplazar = reemplazar
+        self.clases = dict()
+        self.modificadas = set()
+        self.redes = list()
+        self.puertos = list()
+
+    def agregar(self, registro):
+        clase = self.obtener_clase(registro['clase'])
+        for tipo, grupo, valor in registro['entradas']:
+            if not isinstance(valor, str):
+                raise ValidationError("%s: Debe ser una cadena" %
+                                      json.dumps(valor))
+            if grupo not in GRUPOS:
+                raise ValidationError("%s: Grupo desconocido" % grupo)
+            if tipo == SUBRED:
+                red = parseo.parsear_subred(valor)
+                self.redes.append((clase.id, red, GRUPOS[grupo]))
+            elif tipo == PUERTO:
+                puerto = parseo.parsear_puerto(valor)
+                self.puertos.append((clase.id, puerto, GRUPOS[grupo]))
+            else:
+                raise ValidationError("%s: Tipo desconocido" % tipo)
+        if len(self.redes) + len(self.puertos) >= ENTRADAS_POR_LOTE:
+            self.guardar_lote()
+
+    def obtener_clase(self, datos):
+        '''
+        Busca la clase por id o por nombre, creandola si no existe, y
+        actualiza los atributos indicados en el registro.
+        '''
+        for campo, tipo in TIPOS:
+            if campo in datos and not isinstance(datos[campo], tipo):
+                raise ValidationError("%s: Tipo invalido" % campo)
+        if datos.get('id'):
+            try:
+                clave = ('id', int(datos['id']))
+            except (TypeError, ValueError):
+                raise ValidationError("%s: Id invalido" % datos['id'])
+        elif datos.get('nombre'):
+            clave = ('nombre', datos['nombre'])
+        else:
+            raise ValidationError("La clase no tiene id ni nombre")
+        clase = self.clases.get(clave)
+        if clase is None:
+            clase = self.buscar_clase(datos)
+            self.clases[clave] = clase
+        atributos = {campo: datos[campo]
+                     for campo in ('nombre', 'descripcion', 'activa')
+                     if campo in datos}
+        if clase.id is None or any(getattr(clase, campo) != valor
+                                   for campo, valor in atributos.items()):
+            for campo, valor in atributos.items():
+                setattr(clase, campo, valor)
+            clase.save()
+        self.modificadas.add(clase.id)
+        return clase
+
+    def buscar_clase(self, datos):
+        clases = models.ClaseTrafico.objects.order_by('id')
+        clase = None
+        if datos.get('id'):
+            clase = clases.filter(id=datos['id']).first()
+        if clase is None and datos.get('nombre'):
+            clase = clases.filter(nombre=datos['nombre']).first()
+        if clase is None:
+            if not datos.get('nombre'):
+                raise ValidationError("%s: La clase no existe" % datos['id'])
+            return models.ClaseTrafico(nombre=datos['nombre'])
+        if self.reemplazar:
+            models.ClaseCIDR.objects.filter(clase=clase).delete()
+            models.ClasePuerto.objects.filter(clase=clase).delete()
+        return clase
+
+    def guardar_lote(self):
+        ids = models.CIDR.objects.obtener_ids(red for _, red, _ in self.redes)
+        models.ClaseCIDR.objects.agregar(
+            (clase, ids[red], grupo) for clase, red, grupo in self.redes)
+        ids = models.Puerto.objects.obtener_ids(
+            puerto for _, puerto, _ in self.puertos)
+        models.ClasePuerto.objects.agregar(
+            (clase, ids[puerto], grupo)
+            for clase, puerto, grupo in self.puertos)
+        self.redes = list()
+        self.puertos = list()
+
+
+def importar(archivo, formato=JSONL, reemplazar=False):
+    '''
+    Importa las clases del archivo en una unica transaccion y publica una
+    sola version al terminar. Con `reemplazar` las subredes y puertos de las
+    clases existentes que aparecen en el archivo se reemplazan por las del
+    archivo, en lugar de agregarse.
+
+    Devuelve la cantidad de clases importadas.
+    '''
+    importacion = Importacion(reemplazar=reemplazar)
+    with transaction.atomic():
+        for numero, registro in LECTORES[formato](archivo):
+            try:
+                importacion.agregar(registro)
+            except (ValidationError, ValueError) as e:
+                mensajes = getattr(e, 'messages', [str(e)])
+                raise ValueError("linea %d: %s" % (numero,
+                                                   "; ".join(mensajes)))
+        importacion.guardar_lote()
+        if importacion.modificadas:
+            firmas.registrar_cambios(clases=importacion.modificadas)
+    if importacion.modificadas:
+        firmas.sincronizar()
+    return len(importacion.modificadas)
+
+
+def iterar_clases():
+    '''
+    Devuelve las clases en el formato de la descarga, consultandolas de a
+    lotes para no cargarlas todas en memoria.
+    '''
+    ultimo = 0
+    while True:
+        consulta = (models.ClaseTrafico.objects.filter(id__gt=ultimo)
+                                               .order_by('id')
+                                               .values_list('id', flat=True))
+        ids = list(consulta[:CLASES_POR_LOTE])
+        if not ids:
+            break
+        clases = models.ClaseTrafico.objects.filter(id__in=ids)
+        for clase in firmas.obtener_clases(clases):
+            yield clase
+        ultimo = ids[-1]
+
+
+def exportar(salida, formato=JSONL, resumen=None):
+    '''
+    Escribe todas las clases en el archivo de salida. Devuelve la cantidad de
+    clases exportadas.
+
+    Si se pasa un normalizacion.Resumen las subredes y puertos de cada clase
+    se normalizan y se cuentan en el resumen las entradas eliminadas.
+    '''
+    cantidad = 0
+    if formato == CSV:
+        escritor = csv.writer(salida)
+        escritor.writerow(COLUMNAS_CSV)
+    for clase in iterar_clases():
+        if resumen is not None:
+            clase = normalizacion.normalizar_clase(clase, resumen)
+        if formato == CSV:
+            for campo, tipo, grupo in CAMPOS:
+                for valor in clase[campo]:
+                    escritor.writerow((clase['id'], clase['nombre'], tipo,
+                                       grupo, valor))
+        else:
+            salida.write(json.dumps(clase) + "\n")
+        cantidad += 1
+    return cantidad
@@ -0,0 +1,33 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from clases import lotes, normalizacion
+
+
+class Command(BaseCommand):
+    help = 'Exporta las clases de trafico en formato JSON Lines o CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--formato', choices=lotes.FORMATOS, default=lotes.JSONL)
+        parser.add_argument(
+            '--salida',
+            help="Archivo de salida. Por defecto se usa la salida estandar.")
+        parser.add_argument(
+            '--normalizar', action='store_true', default=False,
+            help="Reduce las subredes y puertos de cada clase al conjunto "
+                 "minimo equivalente.")
+
+    def handle(self, *args, **options):
+        resumen = normalizacion.Resumen() if options['normalizar'] else None
+        if options['salida']:
+            with open(options['salida'], 'w', newline='',
+                      encoding='utf-8') as f:
+                cantidad = lotes.exportar(f, options['formato'], resumen)
+            self.stdout.write("Clases exportadas: %d" % cantidad)
+        else:
+            lotes.exportar(sys.stdout, options['formato'], resumen)
+        if resumen is not None:
+            self.stderr.write("Subredes eliminadas: %d, puertos eliminados: %d"
+                              % (resumen.subredes, resumen.puertos))
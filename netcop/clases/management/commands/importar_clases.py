@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from clases import lotes
+
+
+class Command(BaseCommand):
+    help = ('Importa clases de trafico desde un archivo JSON Lines o CSV y '
+            'publica una nueva version de la base de firmas.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('archivo')
+        parser.add_argument(
+            '--formato', choices=lotes.FORMATOS,
+            help="Formato del archivo. Por defecto se deduce de la extension.")
+        parser.add_argument(
+            '--reemplazar', action='store_true', default=False,
+            help="Reemplaza las subredes y puertos de las clases existentes "
+                 "en lugar de agregarlos.")
+
+    def handle(self, *args, **options):
+        formato = options['formato']
+        if formato is None:
+            formato = (lotes.CSV if options['archivo'].endswith('.csv')
+                       else lotes.JSONL)
+        with open(options['archivo'], newline='', encoding='utf-8') as f:
+            try:
+                cantidad = lotes.importar(f, formato, options['reemplazar'])
+            except ValueError as e:
+                raise CommandError(str(e))
+        self.stdout.write("Clases importadas: %d" % cantidad)
@@ -0,0 +1,63 @@
+import json
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+
+from clases import rendimiento
+
+
+def escala(valor):
+    m = re.match(r"^(\d+)x(\d+)x(\d+)$", valor)
+    if m is None:
+        raise ValueError(valor)
+    return tuple(int(numero) for numero in m.groups())
+
+
+class Command(BaseCommand):
+    help = ('Mide tiempos, consultas y memoria de la API de los agentes con '
+            'datos generados, en una base de datos de prueba, y escribe los '
+            'resultados en json.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--escala', type=escala, action='append', dest='escalas',
+            help="Clases, subredes y puertos por clase con el formato NxMxK. "
+                 "Se puede repetir. Por defecto: %s." % ", ".join(
+                     "%dx%dx%d" % e for e in rendimiento.ESCALAS))
+        parser.add_argument(
+            '--repeticiones', type=int, default=rendimiento.REPETICIONES)
+        parser.add_argument(
+            '--inside', type=float, default=rendimiento.PROPORCION_INSIDE,
+            help="Proporcion de subredes y puertos en el grupo inside.")
+        parser.add_argument(
+            '--salida',
+            help="Archivo de salida. Por defecto se usa la salida estandar.")
+        parser.add_argument(
+            '--comparar',
+            help="Resultados anteriores con los que comparar. Termina con "
+                 "error si alguna metrica empeoro mas que la tolerancia.")
+        parser.add_argument(
+            '--tolerancia', type=float, default=rendimiento.TOLERANCIA)
+
+    def handle(self, *args, **options):
+        anterior = None
+        if options['comparar']:
+            with open(options['comparar'], encoding='utf-8') as f:
+                anterior = json.load(f)
+        with rendimiento.aislado():
+            resultado = rendimiento.medir_escalas(
+                options['escalas'] or rendimiento.ESCALAS,
+                options['repeticiones'], options['inside'])
+        contenido = json.dumps(resultado, indent=2, sort_keys=True)
+        if options['salida']:
+            with open(options['salida'], 'w', encoding='utf-8') as f:
+                f.write(contenido)
+        else:
+            self.stdout.write(contenido)
+        if anterior is not None:
+            regresiones = rendimiento.comparar(anterior, resultado,
+                                               options['tolerancia'])
+            for regresion in regresiones:
+                self.stderr.write("%s %s %s: %s -> %s" % regresion)
+            if regresiones:
+                raise CommandError("%d metricas empeoraron" % len(regresiones))
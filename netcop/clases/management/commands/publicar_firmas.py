@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from clases import firmas
+
+
+class Command(BaseCommand):
+    help = ('Recalcula la version de la base de firmas y, si cambio, publica '
+            'su snapshot para la descarga de los agentes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sincronizar', action='store_true', default=False,
+            help="Solo escribe en MEDIA_ROOT el snapshot de la version "
+                 "registrada en la base de datos, sin recalcularla.")
+
+    def handle(self, *args, **options):
+        if options['sincronizar']:
+            version = firmas.sincronizar()
+        else:
+            version = firmas.publicar()
+        self.stdout.write("Version publicada: %s" % version)
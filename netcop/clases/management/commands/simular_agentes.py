@@ -0,0 +1,40 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from clases import rendimiento
+
+
+class Command(BaseCommand):
+    help = ('Simula agentes que consultan la version y descargan las firmas '
+            'de un servidor en marcha y escribe las estadisticas en json.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'url', help="URL base del servidor, por ejemplo "
+                        "http://localhost:8000/")
+        parser.add_argument('--agentes', type=int, default=100)
+        parser.add_argument(
+            '--duracion', type=float, default=30,
+            help="Segundos que dura la simulacion.")
+        parser.add_argument(
+            '--intervalo', type=float, default=5,
+            help="Segundos entre consultas de la version de cada agente.")
+        parser.add_argument(
+            '--esperar', action='store_true', default=False,
+            help="Espera las nuevas versiones con long poll en lugar de "
+                 "consultar cada intervalo.")
+        parser.add_argument(
+            '--salida',
+            help="Archivo de salida. Por defecto se usa la salida estandar.")
+
+    def handle(self, *args, **options):
+        resultado = rendimiento.simular_agentes(
+            options['url'], options['agentes'], options['duracion'],
+            options['intervalo'], options['esperar'])
+        contenido = json.dumps(resultado, indent=2, sort_keys=True)
+        if options['salida']:
+            with open(options['salida'], 'w', encoding='utf-8') as f:
+                f.write(contenido)
+        else:
+            self.stdout.write(contenido)
@@ -0,0 +1,214 @@
+'''
+Métricas de los pedidos en formato de texto de Prometheus.
+
+MetricasMiddleware registra por vista la latencia en un histograma, la
+cantidad de pedidos por metodo y estado, las consultas a la base de datos y
+su tiempo, y los bytes de las respuestas. Las consultas se obtienen del
+registro de consultas de cada conexion, que se activa durante el pedido
+aunque DEBUG sea False. La latencia de las respuestas en streaming es la de
+los encabezados.
+
+La vista /metrics/ exporta estas metricas y los aciertos y fallos de la cache
+de las firmas. Cada proceso tiene sus propias metricas, por lo que Prometheus
+debe consultar cada worker. Solo pueden leerlas los pedidos desde las redes de
+METRICAS_REDES en settings o los usuarios staff (ver acceso_permitido).
+
+Con METRICAS_PEDIDO_LENTO en settings, los pedidos que tardan mas de esos
+segundos se registran con sus consultas en el log `clases.metricas`.
+'''
+import bisect
+import ipaddress
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.db import connections
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+# limites de los buckets del histograma de latencia, en segundos
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# vista de los pedidos que no corresponden a ninguna url
+SIN_RUTA = 'sin_ruta'
+
+
+class Histograma(object):
+
+    def __init__(self):
+        self.cantidades = [0] * (len(BUCKETS) + 1)
+        self.suma = 0
+        self.cantidad = 0
+
+    def observar(self, valor):
+        self.cantidades[bisect.bisect_left(BUCKETS, valor)] += 1
+        self.suma += valor
+        self.cantidad += 1
+
+    def acumulados(self):
+        '''
+        Devuelve tuplas (limite, cantidad de observaciones menores o iguales)
+        con el ultimo limite '+Inf'.
+        '''
+        total = 0
+        for limite, cantidad in zip(BUCKETS + ('+Inf',), self.cantidades):
+            total += cantidad
+            yield limite, total
+
+
+_lock = threading.Lock()
+_latencias = defaultdict(Histograma)
+_pedidos = Counter()
+_consultas = Counter()
+_tiempo_consultas = Counter()
+_bytes = Counter()
+
+
+def registrar(vista, metodo, estado, duracion, consultas=0,
+              tiempo_consultas=0, largo=0):
+    with _lock:
+        _latencias[vista].observar(duracion)
+        _pedidos[vista, metodo, estado] += 1
+        _consultas[vista] += consultas
+        _tiempo_consultas[vista] += tiempo_consultas
+        _bytes[vista] += largo
+
+
+def reiniciar():
+    with _lock:
+        for registro in (_latencias, _pedidos, _consultas, _tiempo_consultas,
+                         _bytes):
+            registro.clear()
+
+
+def etiquetas(**valores):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (nombre, escapar(valor))
+        for nombre, valor in sorted(valores.items()))
+
+
+def escapar(valor):
+    return (str(valor).replace('\\', r'\\')
+                      .replace('"', r'\"')
+                      .replace('\n', r'\n'))
+
+
+def acceso_permitido(request):
+    '''
+    Indica si el pedido puede leer las metricas: si viene de una de las redes
+    de METRICAS_REDES o de un usuario staff. Detras de un proxy REMOTE_ADDR es
+    la direccion del proxy, que solo debe reenviar /metrics/ desde la red de
+    Prometheus.
+    '''
+    usuario = getattr(request, 'user', None)
+    if usuario is not None and usuario.is_staff:
+        return True
+    try:
+        direccion = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(direccion in ipaddress.ip_network(red, strict=False)
+               for red in settings.METRICAS_REDES)
+
+
+def exportar():
+    '''
+    Devuelve las metricas del proceso en el formato de texto de Prometheus.
+    '''
+    lineas = list()
+
+    def metrica(nombre, tipo, ayuda, valores):
+        lineas.append('# HELP %s %s' % (nombre, ayuda))
+        lineas.append('# TYPE %s %s' % (nombre, tipo))
+        for sufijo, etiqueta, valor in valores:
+            lineas.append('%s%s%s %s' % (nombre, sufijo, etiqueta,
+                                         repr(float(valor))))
+
+    with _lock:
+        metrica('netcop_http_duracion_segundos', 'histogram',
+                'Latencia de los pedidos por vista.',
+                [valor
+                 for vista, histograma in sorted(_latencias.items())
+                 for valor in (
+                     [('_bucket', etiquetas(vista=vista, le=limite), total)
+                      for limite, total in histograma.acumulados()] +
+                     [('_sum', etiquetas(vista=vista), histograma.suma),
+                      ('_count', etiquetas(vista=vista), histograma.cantidad)])
+                 ])
+        metrica('netcop_http_pedidos_total', 'counter',
+                'Pedidos por vista, metodo y estado.',
+                [('', etiquetas(vista=vista, metodo=metodo, estado=estado),
+                  cantidad)
+                 for (vista, metodo, estado), cantidad
+                 in sorted(_pedidos.items())])
+        for nombre, ayuda, registro in (
+                ('netcop_db_consultas_total',
+                 'Consultas a la base de datos por vista.', _consultas),
+                ('netcop_db_duracion_segundos_total',
+                 'Tiempo de las consultas a la base de datos por vista.',
+                 _tiempo_consultas),
+                ('netcop_http_respuesta_bytes_total',
+                 'Bytes de las respuestas por vista, sin las respuestas en '
+                 'streaming.', _bytes)):
+            metrica(nombre, 'counter', ayuda,
+                    [('', etiquetas(vista=vista), valor)
+                     for vista, valor in sorted(registro.items())])
+    metrica('netcop_cache_eventos_total', 'counter',
+            'Aciertos, fallos y valores anteriores devueltos por la cache '
+            'de las firmas.',
+            [('', etiquetas(nombre=nombre, evento=evento), cantidad)
+             for nombre, eventos in sorted(cache.estadisticas().items())
+             for evento, cantidad in sorted(eventos.items())])
+    return '\n'.join(lineas) + '\n'
+
+
+def nombre_vista(request):
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        return SIN_RUTA
+    return resolver_match.view_name
+
+
+class MetricasMiddleware(object):
+    '''
+    Registra las metricas de cada pedido. Debe ser el primer middleware para
+    que la latencia incluya la de los demas.
+    '''
+
+    def process_request(self, request):
+        request.metricas = {
+            'inicio': time.perf_counter(),
+            # estado del registro de consultas de cada conexion
+            'conexiones': [(conexion, conexion.force_debug_cursor,
+                            len(conexion.queries_log))
+                           for conexion in connections.all()],
+        }
+        for conexion in connections.all():
+            conexion.force_debug_cursor = True
+
+    def process_response(self, request, response):
+        metricas = getattr(request, 'metricas', None)
+        if metricas is None:
+            return response
+        duracion = time.perf_counter() - metricas['inicio']
+        consultas = list()
+        for conexion, debug, inicio in metricas['conexiones']:
+            consultas.extend(list(conexion.queries_log)[inicio:])
+            conexion.force_debug_cursor = debug
+        tiempo_consultas = sum(float(consulta['time'])
+                               for consulta in consultas)
+        largo = 0 if response.streaming else len(response.content)
+        vista = nombre_vista(request)
+        registrar(vista, request.method, response.status_code, duracion,
+                  len(consultas), tiempo_consultas, largo)
+        limite = getattr(settings, 'METRICAS_PEDIDO_LENTO', None)
+        if limite is not None and duracion > limite:
+            logger.warning(
+                "Pedido lento: %s %s (%s) %.3fs, %d consultas en %.3fs\n%s",
+                request.method, request.get_full_path(), vista, duracion,
+                len(consultas), tiempo_consultas,
+                "\n".join("%ss %s" % (consulta['time'], consulta['sql'])
+                          for consulta in consultas))
+        return response
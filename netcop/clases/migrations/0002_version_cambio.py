@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clases', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Version',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('numero', models.CharField(max_length=64, unique=True)),
+                ('fecha', models.DateTimeField(auto_now_add=True)),
+                ('completa', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Cambio',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('clase', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cambios', to='clases.ClaseTrafico')),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cambios', to='clases.Version')),
+            ],
+        ),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import socket
+
+from django.db import migrations, models
+
+
+def completar_rangos(apps, schema_editor):
+    '''
+    Calcula el rango de cada red y unifica las redes repetidas, que antes
+    podian crearse por duplicado.
+    '''
+    CIDR = apps.get_model('clases', 'CIDR')
+    ClaseCIDR = apps.get_model('clases', 'ClaseCIDR')
+    redes = dict()
+    for cidr in CIDR.objects.order_by('id'):
+        ip = int.from_bytes(socket.inet_aton(cidr.direccion), 'big')
+        hosts = (1 << (32 - cidr.prefijo)) - 1
+        inicio = ip & ~hosts
+        clave = (inicio, cidr.prefijo)
+        if clave in redes:
+            ClaseCIDR.objects.filter(cidr=cidr).update(cidr=redes[clave])
+            cidr.delete()
+            continue
+        redes[clave] = cidr.id
+        cidr.direccion = socket.inet_ntoa(inicio.to_bytes(4, 'big'))
+        cidr.inicio = inicio
+        cidr.fin = inicio | hosts
+        cidr.save()
+    # relaciones que quedaron repetidas al unificar las redes
+    vistas = set()
+    for item in ClaseCIDR.objects.order_by('id'):
+        clave = (item.clase_id, item.cidr_id, item.grupo)
+        if clave in vistas:
+            item.delete()
+        vistas.add(clave)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clases', '0002_version_cambio'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cidr',
+            name='inicio',
+            field=models.BigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='cidr',
+            name='fin',
+            field=models.BigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(completar_rangos, migrations.RunPython.noop),
+    ]
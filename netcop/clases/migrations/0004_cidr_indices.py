@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clases', '0003_cidr_rango'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='cidr',
+            unique_together=set([('inicio', 'prefijo')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='cidr',
+            index_together=set([('inicio', 'fin')]),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+
+# indices de trigramas para las busquedas con icontains, que en PostgreSQL se
+# resuelven como UPPER(columna::text) LIKE UPPER(%s)
+INDICES_TRIGRAMAS = (
+    ('clases_clasetrafico_nombre_trgm', 'nombre'),
+    ('clases_clasetrafico_descripcion_trgm', 'descripcion'),
+)
+
+
+def crear_indices_trigramas(apps, schema_editor):
+    '''
+    Crea los indices de trigramas en PostgreSQL. Si la extension pg_trgm no
+    puede instalarse la busqueda sigue funcionando sin indices.
+    '''
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic():
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except Exception:
+        return
+    for nombre, columna in INDICES_TRIGRAMAS:
+        schema_editor.execute(
+            "CREATE INDEX %s ON clases_clasetrafico "
+            "USING gin (UPPER(%s::text) gin_trgm_ops)" % (nombre, columna))
+
+
+def borrar_indices_trigramas(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for nombre, columna in INDICES_TRIGRAMAS:
+        schema_editor.execute("DROP INDEX IF EXISTS %s" % nombre)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clases', '0004_cidr_indices'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='puerto',
+            index_together=set([('numero', 'protocolo')]),
+        ),
+        migrations.RunPython(crear_indices_trigramas,
+                             borrar_indices_trigramas),
+    ]
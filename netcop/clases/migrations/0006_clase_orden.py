@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clases', '0005_indices_busqueda'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='clasetrafico',
+            index_together=set([('activa', 'id')]),
+        ),
+    ]
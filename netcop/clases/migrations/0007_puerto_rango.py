@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def completar_rangos(apps, schema_editor):
+    '''
+    Los puertos existentes son rangos de un unico puerto.
+    '''
+    Puerto = apps.get_model('clases', 'Puerto')
+    Puerto.objects.update(hasta=models.F('numero'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clases', '0006_clase_orden'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='puerto',
+            name='hasta',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(completar_rangos, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='puerto',
+            index_together=set([('numero', 'hasta', 'protocolo')]),
+        ),
+    ]
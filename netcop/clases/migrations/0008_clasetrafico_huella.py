@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clases', '0007_puerto_rango'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clasetrafico',
+            name='huella',
+            field=models.CharField(max_length=64, default='', editable=False),
+        ),
+    ]
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import clases.models
+
+IPV6 = 1 << 128
+
+
+def copiar_rangos(apps, schema_editor):
+    '''
+    Copia el rango de cada red a las columnas con la clave binaria.
+    '''
+    CIDR = apps.get_model('clases', 'CIDR')
+    redes = CIDR.objects.using(schema_editor.connection.alias)
+    for id, inicio, fin in redes.values_list('id', 'inicio_entero',
+                                             'fin_entero'):
+        redes.filter(id=id).update(inicio=inicio, fin=fin)
+
+
+def restaurar_rangos(apps, schema_editor):
+    '''
+    Vuelve a copiar los rangos a las columnas enteras. Las redes IPv6 no
+    pueden representarse y se borran.
+    '''
+    alias = schema_editor.connection.alias
+    redes = apps.get_model('clases', 'CIDR').objects.using(alias)
+    relaciones = apps.get_model('clases', 'ClaseCIDR').objects.using(alias)
+    ipv6 = redes.filter(inicio__gte=IPV6)
+    relaciones.filter(cidr__in=ipv6).delete()
+    ipv6.delete()
+    for id, inicio, fin in redes.values_list('id', 'inicio', 'fin'):
+        redes.filter(id=id).update(inicio_entero=inicio, fin_entero=fin)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clases', '0008_clasetrafico_huella'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='cidr',
+            unique_together=set([]),
+        ),
+        migrations.AlterIndexTogether(
+            name='cidr',
+            index_together=set([]),
+        ),
+        migrations.RenameField(
+            model_name='cidr',
+            old_name='inicio',
+            new_name='inicio_entero',
+        ),
+        migrations.RenameField(
+            model_name='cidr',
+            old_name='fin',
+            new_name='fin_entero',
+        ),
+        migrations.AlterField(
+            model_name='cidr',
+            name='inicio_entero',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='cidr',
+            name='fin_entero',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cidr',
+            name='inicio',
+            field=clases.models.DireccionField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='cidr',
+            name='fin',
+            field=clases.models.DireccionField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copiar_rangos, restaurar_rangos),
+        migrations.RemoveField(
+            model_name='cidr',
+            name='inicio_entero',
+        ),
+        migrations.RemoveField(
+            model_name='cidr',
+            name='fin_entero',
+        ),
+        migrations.AlterField(
+            model_name='cidr',
+            name='direccion',
+            field=models.GenericIPAddressField(),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cidr',
+            unique_together=set([('inicio', 'prefijo')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='cidr',
+            index_together=set([('inicio', 'fin')]),
+        ),
+    ]
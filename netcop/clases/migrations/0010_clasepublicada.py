@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from django.db import migrations, models
+import clases.models
+
+
+def materializar(apps, schema_editor):
+    '''
+    Crea la copia publicada de las clases existentes con el mismo formato que
+    firmas.obtener_clases.
+    '''
+    alias = schema_editor.connection.alias
+    ClaseTrafico = apps.get_model('clases', 'ClaseTrafico')
+    ClaseCIDR = apps.get_model('clases', 'ClaseCIDR')
+    ClasePuerto = apps.get_model('clases', 'ClasePuerto')
+    ClasePublicada = apps.get_model('clases', 'ClasePublicada')
+
+    listas = defaultdict(list)
+    redes = (ClaseCIDR.objects.using(alias)
+                              .order_by('id')
+                              .values_list('clase_id', 'grupo',
+                                           'cidr__direccion', 'cidr__prefijo'))
+    for clase, grupo, direccion, prefijo in redes:
+        listas[clase, 'subredes', grupo].append(
+            '%s/%d' % (direccion, prefijo))
+    puertos = (ClasePuerto.objects.using(alias)
+                                  .order_by('id')
+                                  .values_list('clase_id', 'grupo',
+                                               'puerto__numero',
+                                               'puerto__hasta',
+                                               'puerto__protocolo'))
+    for clase, grupo, numero, hasta, protocolo in puertos:
+        listas[clase, 'puertos', grupo].append(
+            clases.models.texto_puerto(numero, hasta, protocolo))
+
+    def texto(clase, nombre, grupo):
+        return '\n'.join(listas[clase, nombre, grupo])
+
+    ClasePublicada.objects.using(alias).bulk_create(
+        ClasePublicada(
+            clase_id=id, nombre=nombre, descripcion=descripcion,
+            activa=activa,
+            subredes_outside=texto(id, 'subredes', clases.models.OUTSIDE),
+            subredes_inside=texto(id, 'subredes', clases.models.INSIDE),
+            puertos_outside=texto(id, 'puertos', clases.models.OUTSIDE),
+            puertos_inside=texto(id, 'puertos', clases.models.INSIDE),
+        )
+        for id, nombre, descripcion, activa in (
+            ClaseTrafico.objects.using(alias)
+                                .values_list('id', 'nombre', 'descripcion',
+                                             'activa'))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clases', '0009_cidr_ipv6'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClasePublicada',
+            fields=[
+                ('clase', models.OneToOneField(primary_key=True, serialize=False, related_name='publicada', to='clases.ClaseTrafico')),
+                ('nombre', models.CharField(max_length=32)),
+                ('descripcion', models.CharField(max_length=160, default='')),
+                ('activa', models.BooleanField(default=True)),
+                ('subredes_outside', models.TextField(default='')),
+                ('subredes_inside', models.TextField(default='')),
+                ('puertos_outside', models.TextField(default='')),
+                ('puertos_inside', models.TextField(default='')),
+            ],
+        ),
+        migrations.RunPython(materializar, migrations.RunPython.noop),
+    ]
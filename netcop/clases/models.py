@@ -1,5 +1,6 @@
-import ipaddress
-from django.db import models
+import socket
+from collections import OrderedDict
+from django.db import connections, models, router
 
 INSIDE = 'i'
 OUTSIDE = 'o'
@@ -9,19 +10,371 @@ grupo_choices = (
     (OUTSIDE, "En Internet"),
 )
 
+# cantidad de parametros por consulta en las operaciones en lote. sqlite no
+# admite mas de 999 parametros por consulta.
+TAMANIO_LOTE = 500
+
+
+BITS = 32
+BITS_IPV6 = 128
+# las direcciones IPv6 se representan con enteros a partir de IPV6, de modo
+# que ordenan despues de las IPv4 y ninguna red de una familia contiene
+# direcciones de la otra
+IPV6 = 1 << BITS_IPV6
+# largo de la clave binaria de una direccion en la base: un byte de familia y
+# 16 de direccion
+LARGO_CLAVE = 17
+
+
+def familia(entero):
+    '''
+    Devuelve la cantidad de bits de la familia de la direccion y el entero de
+    su primera direccion.
+    '''
+    if entero >= IPV6:
+        return BITS_IPV6, IPV6
+    return BITS, 0
+
+
+def ip_a_entero(direccion):
+    if ':' in direccion:
+        return IPV6 + int.from_bytes(
+            socket.inet_pton(socket.AF_INET6, direccion), 'big')
+    return int.from_bytes(socket.inet_aton(direccion), 'big')
+
+
+def entero_a_ip(entero):
+    if entero >= IPV6:
+        return socket.inet_ntop(socket.AF_INET6,
+                                (entero - IPV6).to_bytes(16, 'big'))
+    return socket.inet_ntoa(entero.to_bytes(4, 'big'))
+
+
+def rango(inicio, prefijo):
+    '''
+    Devuelve la primera y la ultima direccion, como enteros, de la red que
+    contiene a `inicio` con el prefijo dado.
+    '''
+    hosts = (1 << (familia(inicio)[0] - prefijo)) - 1
+    inicio &= ~hosts
+    return inicio, inicio | hosts
+
+
+def texto_puerto(numero, hasta, protocolo):
+    '''
+    Devuelve el puerto o rango de puertos con el formato numero[-hasta][/tcp
+    o /udp], por ejemplo '443/tcp' o '49152-65535/udp'.
+    '''
+    texto = str(numero) if numero == hasta else "%d-%d" % (numero, hasta)
+    if protocolo == 6:
+        texto += '/tcp'
+    elif protocolo == 17:
+        texto += '/udp'
+    return texto
+
+
+def insertar(modelo, atributos, filas, using=None):
+    '''
+    Inserta las filas, tuplas con los valores de los atributos, con un unico
+    executemany y sin crear instancias del modelo. Los valores de los campos
+    que se guardan con otro tipo, como DireccionField, se convierten con el
+    campo.
+    '''
+    filas = list(filas)
+    if not filas:
+        return
+    using = using or router.db_for_write(modelo)
+    conexion = connections[using]
+    quote = conexion.ops.quote_name
+    campos = {campo.attname: campo for campo in modelo._meta.concrete_fields}
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        quote(modelo._meta.db_table),
+        ", ".join(quote(campos[atributo].column) for atributo in atributos),
+        ", ".join(["%s"] * len(atributos)))
+    convertir = [(i, campos[atributo]) for i, atributo in enumerate(atributos)
+                 if isinstance(campos[atributo], DireccionField)]
+    if convertir:
+        filas = [list(fila) for fila in filas]
+        for fila in filas:
+            for i, campo in convertir:
+                fila[i] = campo.get_db_prep_save(fila[i], conexion)
+    with conexion.cursor() as cursor:
+        cursor.executemany(sql, filas)
+
+
+def en_lotes(items, tamanio=TAMANIO_LOTE):
+    '''
+    Divide una secuencia en listas de a lo sumo `tamanio` elementos.
+    '''
+    items = list(items)
+    for i in range(0, len(items), tamanio):
+        yield items[i:i + tamanio]
+
+
+class DireccionField(models.BinaryField):
+    '''
+    Direccion IPv4 o IPv6 como entero (ver ip_a_entero) que se guarda como una
+    clave binaria de LARGO_CLAVE bytes en orden de red. Las claves se ordenan
+    igual que los enteros, por lo que las comparaciones y los recorridos por
+    rango del indice funcionan sobre la clave.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', LARGO_CLAVE)
+        super().__init__(*args, **kwargs)
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return value
+        return int.from_bytes(bytes(value), 'big')
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            return int(value)
+        if isinstance(value, (bytes, memoryview)):
+            return int.from_bytes(bytes(value), 'big')
+        return value
+
+    def get_prep_value(self, value):
+        if isinstance(value, int):
+            return value.to_bytes(LARGO_CLAVE, 'big')
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        # sqlite3 y psycopg2 adaptan bytes a BLOB y bytea, no hace falta
+        # envolverlos con Database.Binary como BinaryField
+        if not prepared:
+            value = self.get_prep_value(value)
+        return value
+
+    def value_to_string(self, obj):
+        return str(self._get_val_from_obj(obj))
+
+
+class ClaseTraficoQuerySet(models.QuerySet):
+
+    def con_cantidades(self):
+        '''
+        Agrega a cada clase la cantidad de subredes y puertos de cada grupo
+        (redes_inside, redes_outside, puertos_inside y puertos_outside) con
+        subconsultas en la misma consulta.
+        '''
+        consulta = ("SELECT COUNT(*) FROM {tabla} "
+                    "WHERE {tabla}.clase_id = {clases}.id "
+                    "AND {tabla}.grupo = %s")
+        select = OrderedDict()
+        params = list()
+        for nombre, modelo in (('redes', ClaseCIDR),
+                               ('puertos', ClasePuerto)):
+            for grupo, sufijo in ((INSIDE, 'inside'), (OUTSIDE, 'outside')):
+                select['%s_%s' % (nombre, sufijo)] = consulta.format(
+                    tabla=modelo._meta.db_table,
+                    clases=self.model._meta.db_table,
+                )
+                params.append(grupo)
+        return self.extra(select=select, select_params=params)
+
+    def despues_de(self, activa, id):
+        '''
+        Clases que siguen a la clase (activa, id) en el orden del listado,
+        primero las activas y luego por id.
+        '''
+        return self.filter(models.Q(activa=activa, id__gt=id) |
+                           models.Q(activa__lt=activa))
+
 
 class ClaseTrafico(models.Model):
     nombre = models.CharField(max_length=32, null=False)
     descripcion = models.CharField(max_length=160, null=False, default="")
     activa = models.BooleanField(default=True)
+    # sha256 del contenido publicado de la clase, ver firmas.huella
+    huella = models.CharField(max_length=64, default="", editable=False)
+
+    objects = ClaseTraficoQuerySet.as_manager()
+
+    class Meta:
+        index_together = (('activa', 'id'),)
 
     def __str__(self):
         return self.nombre
 
 
+class ElementoQuerySet(models.QuerySet):
+    '''
+    Busqueda y creacion en lote de subredes o puertos.
+    '''
+    # campos que identifican a un elemento
+    claves = ()
+    # campos que se insertan al crear un elemento
+    campos = ()
+
+    def obtener_ids(self, elementos):
+        '''
+        Devuelve un diccionario que asocia cada elemento (una tupla con los
+        valores de `claves`) con su id. Los elementos que no existen se crean
+        con un unico executemany.
+        '''
+        elementos = set(elementos)
+        ids = self._buscar_ids(elementos)
+        faltantes = elementos - set(ids)
+        if faltantes:
+            insertar(self.model, self.campos,
+                     (self.nuevo(elemento) for elemento in faltantes),
+                     using=self._db)
+            ids.update(self._buscar_ids(faltantes))
+        return ids
+
+    def nuevo(self, elemento):
+        '''
+        Devuelve los valores de `campos` para crear el elemento.
+        '''
+        return elemento
+
+    def _buscar_ids(self, elementos):
+        primera = self.claves[0]
+        ids = dict()
+        valores = sorted({elemento[0] for elemento in elementos})
+        for lote in en_lotes(valores):
+            consulta = (self.filter(**{primera + '__in': lote})
+                            .order_by('-id')
+                            .values_list('id', *self.claves))
+            for fila in consulta:
+                elemento = tuple(fila[1:])
+                if elemento in elementos:
+                    # ante duplicados se queda con el id mas bajo
+                    ids[elemento] = fila[0]
+        return ids
+
+
+class CIDRQuerySet(ElementoQuerySet):
+    # las redes se identifican con los enteros (inicio de la red, prefijo)
+    claves = ('inicio', 'prefijo')
+    campos = ('direccion', 'prefijo', 'inicio', 'fin')
+
+    def nuevo(self, elemento):
+        inicio, fin = rango(*elemento)
+        return entero_a_ip(inicio), elemento[1], inicio, fin
+
+    def contienen(self, direccion):
+        '''
+        Redes que contienen a la direccion. Como una direccion esta contenida
+        en a lo sumo una red por prefijo, se buscan solo esas redes en el
+        indice unico (inicio, prefijo).
+        '''
+        ip = ip_a_entero(direccion)
+        bits = familia(ip)[0]
+        return self.filter(
+            inicio__in={rango(ip, prefijo)[0] for prefijo in range(bits + 1)},
+            fin__gte=ip,
+        )
+
+    def solapan(self, direccion, prefijo=None):
+        '''
+        Redes que se superponen con la red direccion/prefijo: las que la
+        contienen y las contenidas en ella, que se obtienen con un recorrido
+        por rango del indice sobre inicio. Sin prefijo se toma la direccion
+        de host.
+        '''
+        ip = ip_a_entero(direccion)
+        if prefijo is None:
+            prefijo = familia(ip)[0]
+        inicio, fin = rango(ip, prefijo)
+        return self.filter(
+            models.Q(inicio__gte=inicio, inicio__lte=fin) |
+            models.Q(id__in=self.model.objects.contienen(direccion)
+                                              .values('id'))
+        )
+
+
+class PuertoQuerySet(ElementoQuerySet):
+    claves = campos = ('numero', 'hasta', 'protocolo')
+
+    def solapan(self, numero, hasta=None, protocolo=0):
+        '''
+        Puertos cuyo rango se superpone con el rango numero-hasta. Si se
+        indica un protocolo se incluyen tambien los puertos sin protocolo.
+        '''
+        if hasta is None:
+            hasta = numero
+        consulta = self.filter(numero__lte=hasta, hasta__gte=numero)
+        if protocolo:
+            consulta = consulta.filter(protocolo__in=(protocolo, 0))
+        return consulta
+
+
+class ColeccionQuerySet(models.QuerySet):
+    '''
+    Operaciones en lote sobre las relaciones entre una clase y sus subredes o
+    puertos.
+    '''
+    # nombre de la clave foranea al elemento relacionado
+    campo = None
+
+    def sincronizar(self, clase, items):
+        '''
+        Deja la clase relacionada exactamente con los items pasados, cada uno
+        una tupla (id del elemento, grupo). Solo se borran las relaciones que
+        sobran y se insertan las que faltan.
+        '''
+        # se conserva el orden en que se ingresaron los items
+        items = OrderedDict.fromkeys(items)
+        existentes = set()
+        sobrantes = list()
+        consulta = (self.filter(clase=clase)
+                        .order_by('id')
+                        .values_list('id', self.campo, 'grupo'))
+        for id, elemento, grupo in consulta:
+            clave = (elemento, grupo)
+            if clave in items and clave not in existentes:
+                existentes.add(clave)
+            else:
+                sobrantes.append(id)
+        for lote in en_lotes(sobrantes):
+            self.filter(id__in=lote).delete()
+        self._crear((clase.id, elemento, grupo)
+                    for elemento, grupo in items
+                    if (elemento, grupo) not in existentes)
+
+    def agregar(self, items):
+        '''
+        Crea las relaciones pasadas que todavia no existan, sin borrar ninguna.
+        Cada item es una tupla (id de la clase, id del elemento, grupo) y
+        pueden pertenecer a distintas clases.
+        '''
+        items = OrderedDict.fromkeys(items)
+        existentes = set()
+        elementos = sorted({elemento for clase, elemento, grupo in items})
+        for lote in en_lotes(elementos):
+            consulta = (self.filter(**{self.campo + '__in': lote})
+                            .values_list('clase_id', self.campo, 'grupo'))
+            existentes.update(fila for fila in consulta if fila in items)
+        self._crear(item for item in items if item not in existentes)
+
+    def _crear(self, items):
+        insertar(self.model, ('clase_id', self.campo, 'grupo'), items,
+                 using=self._db)
+
+
+class ClaseCIDRQuerySet(ColeccionQuerySet):
+    campo = 'cidr_id'
+
+
+class ClasePuertoQuerySet(ColeccionQuerySet):
+    campo = 'puerto_id'
+
+
 class CIDR(models.Model):
-    direccion = models.GenericIPAddressField(protocol='IPv4')
+    direccion = models.GenericIPAddressField()
     prefijo = models.PositiveSmallIntegerField(default=32)
+    # primera y ultima direccion de la red como enteros
+    inicio = DireccionField()
+    fin = DireccionField()
+
+    objects = CIDRQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (('inicio', 'prefijo'),)
+        index_together = (('inicio', 'fin'),)
 
     def __str__(self):
         return "%s/%d" % (self.direccion, self.prefijo)
@@ -29,25 +382,38 @@ class CIDR(models.Model):
     def save(self, *args, **kwargs):
         '''
         Convierte el atributo direccion a una direccion de red antes de
-        guardarla en caso que se haya pasado una direccion de host.
+        guardarla en caso que se haya pasado una direccion de host y calcula
+        el rango de direcciones de la red.
         '''
-        net = ipaddress.ip_network("%s/%d" % (self.direccion, self.prefijo),
-                                   strict=False)
-        self.direccion = str(net.network_address)
+        self.inicio, self.fin = rango(ip_a_entero(self.direccion),
+                                      self.prefijo)
+        self.direccion = entero_a_ip(self.inicio)
         return super().save(*args, **kwargs)
 
 
 class Puerto(models.Model):
+    '''
+    Puerto o rango de puertos, desde numero hasta hasta inclusive.
+    '''
     numero = models.PositiveIntegerField()
+    hasta = models.PositiveIntegerField()
     protocolo = models.PositiveSmallIntegerField(default=0)
 
+    objects = PuertoQuerySet.as_manager()
+
+    class Meta:
+        index_together = (('numero', 'hasta', 'protocolo'),)
+
     def __str__(self):
-        protocolo = ''
-        if self.protocolo == 6:
-            protocolo = '/tcp'
-        elif self.protocolo == 17:
-            protocolo = '/udp'
-        return "%d%s" % (self.numero, protocolo)
+        return texto_puerto(self.numero, self.hasta, self.protocolo)
+
+    def save(self, *args, **kwargs):
+        '''
+        Si no se indica el final del rango se guarda un unico puerto.
+        '''
+        if self.hasta is None:
+            self.hasta = self.numero
+        return super().save(*args, **kwargs)
 
 
 class ClaseCIDR(models.Model):
@@ -55,6 +421,8 @@ class ClaseCIDR(models.Model):
     cidr = models.ForeignKey(CIDR, related_name="clases")
     grupo = models.CharField(max_length=1, choices=grupo_choices)
 
+    objects = ClaseCIDRQuerySet.as_manager()
+
     def __str__(self):
         return str(self.cidr)
 
@@ -68,5 +436,55 @@ class ClasePuerto(models.Model):
     puerto = models.ForeignKey(Puerto, related_name="clases")
     grupo = models.CharField(max_length=1, choices=grupo_choices)
 
+    objects = ClasePuertoQuerySet.as_manager()
+
     def __str__(self):
         return str(self.puerto)
+
+
+class ClasePublicada(models.Model):
+    '''
+    Copia desnormalizada de una clase con el contenido que se publica para los
+    agentes: sus datos y las cuatro listas de subredes y puertos ya
+    formateadas, un elemento por linea. Permite armar la descarga con una
+    unica consulta sin joins. Se actualiza junto con la huella de la clase,
+    ver firmas.actualizar_huellas.
+    '''
+    clase = models.OneToOneField(ClaseTrafico, primary_key=True,
+                                 related_name="publicada")
+    nombre = models.CharField(max_length=32)
+    descripcion = models.CharField(max_length=160, default="")
+    activa = models.BooleanField(default=True)
+    subredes_outside = models.TextField(default="")
+    subredes_inside = models.TextField(default="")
+    puertos_outside = models.TextField(default="")
+    puertos_inside = models.TextField(default="")
+
+    def __str__(self):
+        return self.nombre
+
+
+class Version(models.Model):
+    '''
+    Version publicada de la base de firmas. El id crece con cada publicacion
+    y permite ordenar las versiones.
+    '''
+    numero = models.CharField(max_length=64, unique=True)
+    fecha = models.DateTimeField(auto_now_add=True)
+    # indica que los cambios de esta version no estan registrados y los
+    # agentes deben descargar la base completa
+    completa = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.numero
+
+
+class Cambio(models.Model):
+    '''
+    Registro de las clases modificadas en cada version.
+    '''
+    version = models.ForeignKey(Version, related_name="cambios")
+    clase = models.ForeignKey(ClaseTrafico, related_name="cambios")
+
+    def __str__(self):
+        return "%s: %s" % (self.version, self.clase)
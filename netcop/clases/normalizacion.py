@@ -0,0 +1,137 @@
+'''
+Normalización de las subredes y puertos de las clases de tráfico.
+
+Las subredes de cada clase y grupo se reducen al conjunto mínimo de redes que
+cubre las mismas direcciones: se convierten a intervalos de enteros, se
+ordenan, se unen los que se superponen o son contiguos y cada intervalo se
+vuelve a dividir en la menor cantidad de redes alineadas. El costo es el del
+ordenamiento, por lo que escala a millones de redes.
+
+Los rangos de puertos de un mismo protocolo se unen de la misma forma y se
+eliminan los rangos con protocolo incluidos en un rango sin protocolo.
+'''
+import bisect
+from collections import defaultdict
+from . import binario, models
+
+SUBREDES = ('subredes_outside', 'subredes_inside')
+PUERTOS = ('puertos_outside', 'puertos_inside')
+
+
+class Resumen(object):
+    '''
+    Cantidad de subredes y puertos eliminados al normalizar.
+    '''
+
+    def __init__(self):
+        self.subredes = 0
+        self.puertos = 0
+
+    def como_dict(self):
+        return {'subredes_eliminadas': self.subredes,
+                'puertos_eliminados': self.puertos}
+
+
+def rango_a_redes(inicio, fin):
+    '''
+    Devuelve la menor lista de redes (inicio, prefijo) que cubre el rango de
+    direcciones [inicio, fin], que deben ser de la misma familia.
+    '''
+    total, primera = models.familia(inicio)
+    redes = list()
+    while inicio <= fin:
+        # bloque mas grande alineado en inicio que no se pasa de fin
+        relativo = inicio - primera
+        alineacion = (relativo & -relativo).bit_length() - 1 if relativo \
+            else total
+        bits = min(alineacion, (fin - inicio + 1).bit_length() - 1)
+        redes.append((inicio, total - bits))
+        inicio += 1 << bits
+    return redes
+
+
+def colapsar_redes(redes):
+    '''
+    Reduce la lista de redes (inicio, prefijo) al conjunto minimo de redes
+    que cubre las mismas direcciones, ordenado por direccion.
+    '''
+    intervalos = (models.rango(inicio, prefijo) for inicio, prefijo in redes)
+    resultado = list()
+    for inicio, fin in unir_intervalos(intervalos):
+        resultado.extend(rango_a_redes(inicio, fin))
+    return resultado
+
+
+def unir_intervalos(intervalos):
+    '''
+    Une los intervalos [inicio, fin] que se superponen o son contiguos y los
+    devuelve ordenados.
+    '''
+    resultado = list()
+    for inicio, fin in sorted(intervalos):
+        if resultado and inicio <= resultado[-1][1] + 1:
+            resultado[-1][1] = max(resultado[-1][1], fin)
+        else:
+            resultado.append([inicio, fin])
+    return [tuple(intervalo) for intervalo in resultado]
+
+
+def colapsar_puertos(puertos):
+    '''
+    Reduce la lista de puertos (numero, hasta, protocolo) uniendo los rangos
+    superpuestos o contiguos de cada protocolo y eliminando los rangos con
+    protocolo incluidos en un rango sin protocolo.
+    '''
+    por_protocolo = defaultdict(list)
+    for numero, hasta, protocolo in puertos:
+        por_protocolo[protocolo].append((numero, hasta))
+    cualquiera = unir_intervalos(por_protocolo.pop(0, ()))
+    inicios = [inicio for inicio, fin in cualquiera]
+    resultado = [(numero, hasta, 0) for numero, hasta in cualquiera]
+    for protocolo, rangos in por_protocolo.items():
+        for numero, hasta in unir_intervalos(rangos):
+            i = bisect.bisect_right(inicios, numero) - 1
+            if i < 0 or cualquiera[i][1] < hasta:
+                resultado.append((numero, hasta, protocolo))
+    return sorted(resultado)
+
+
+def normalizar_clase(clase, resumen=None):
+    '''
+    Devuelve una copia de la clase, con el formato de la descarga, con sus
+    subredes y puertos normalizados. Si se indica un resumen se le suman las
+    subredes y puertos eliminados.
+    '''
+    normalizada = dict(clase)
+    for campo in SUBREDES:
+        redes = list()
+        for red in clase[campo]:
+            direccion, _, prefijo = red.partition('/')
+            redes.append((models.ip_a_entero(direccion), int(prefijo)))
+        redes = colapsar_redes(redes)
+        normalizada[campo] = ["%s/%d" % (models.entero_a_ip(inicio), prefijo)
+                              for inicio, prefijo in redes]
+        if resumen is not None:
+            resumen.subredes += len(clase[campo]) - len(redes)
+    for campo in PUERTOS:
+        puertos = colapsar_puertos(binario.puerto_a_tupla(puerto)
+                                   for puerto in clase[campo])
+        normalizada[campo] = [models.texto_puerto(*puerto)
+                              for puerto in puertos]
+        if resumen is not None:
+            resumen.puertos += len(clase[campo]) - len(puertos)
+    return normalizada
+
+
+def normalizar(documento):
+    '''
+    Devuelve una copia del documento de descarga con todas sus clases
+    normalizadas y la cantidad de entradas eliminadas en la clave
+    `normalizacion`.
+    '''
+    resumen = Resumen()
+    normalizado = dict(documento)
+    normalizado['clases'] = [normalizar_clase(clase, resumen)
+                             for clase in documento['clases']]
+    normalizado['normalizacion'] = resumen.como_dict()
+    return normalizado
@@ -0,0 +1,128 @@
+'''
+Espera de nuevas versiones de la base de firmas para notificar a los agentes.
+
+Los pedidos que esperan una nueva version se bloquean en una condición
+(threading.Condition) sin usar la base de datos. La condición se despierta
+cuando este proceso publica una version, con la señal
+firmas.version_publicada, y cada INTERVALO segundos para detectar las
+versiones publicadas por otros procesos. Para eso se revisa el archivo de
+version con un stat, a lo sumo una vez por intervalo para todos los pedidos
+del proceso, y solo se lee si cambió. En la misma revision se consulta la
+version vigente en la base de datos (ver revisar_base), de modo que las
+versiones que registran otros servidores se publican en este y despiertan a
+los pedidos que esperan.
+
+Funciona con el servidor WSGI de netcop/wsgi.py: cada pedido que espera ocupa
+un hilo del servidor, por lo que conviene usar workers con hilos o
+greenlets.
+'''
+import datetime
+import logging
+import os
+import threading
+import time
+from django.db import DatabaseError
+from . import firmas, replicas
+
+# segundos entre revisiones del archivo de version y de la base de datos
+INTERVALO = 1
+
+logger = logging.getLogger(__name__)
+
+_condicion = threading.Condition()
+# ultima revision del archivo de version: ruta, marca (mtime, tamaño),
+# version leida y momento de la revision
+_ruta = None
+_marca = None
+_version = ''
+_revisado = 0
+# ultima version vigente leida de la base de datos
+_vigente = None
+
+
+def revisar_base():
+    '''
+    Consulta la version vigente en la base de datos y, si cambio desde la
+    ultima consulta, la publica en el archivo de version con
+    firmas.sincronizar, que despierta a los pedidos que esperan. Si no se
+    puede consultar la base se sigue usando el archivo de version.
+    '''
+    global _vigente
+    try:
+        with replicas.principal():
+            vigente = firmas.ultima_version()
+        if vigente != _vigente:
+            firmas.sincronizar()
+            _vigente = vigente
+    except DatabaseError:
+        logger.exception('No se pudo consultar la version vigente')
+
+
+def version_publicada(revisar=True):
+    '''
+    Devuelve la version del archivo de version. El archivo, y con `revisar`
+    la version vigente en la base de datos, se revisan a lo sumo una vez por
+    INTERVALO; debe llamarse con la condicion tomada.
+    '''
+    global _ruta, _marca, _version, _revisado
+    ruta = firmas.ruta_version()
+    ahora = time.monotonic()
+    if ruta == _ruta and ahora - _revisado < INTERVALO:
+        return _version
+    if revisar:
+        revisar_base()
+    try:
+        estado = os.stat(ruta)
+    except FileNotFoundError:
+        marca, version = None, ''
+    else:
+        marca = (estado.st_mtime_ns, estado.st_size)
+        version = _version
+        if ruta != _ruta or marca != _marca:
+            with open(ruta, 'r') as f:
+                version = f.read()
+    _ruta, _marca, _version, _revisado = ruta, marca, version, ahora
+    return version
+
+
+def estado_actual(revisar=True):
+    '''
+    Devuelve la tupla (version, fecha de publicacion) del archivo de version,
+    revisandolo a lo sumo una vez por INTERVALO. Sin `revisar` no se consulta
+    la base de datos.
+    '''
+    with _condicion:
+        version = version_publicada(revisar)
+        if _marca is None:
+            return version, None
+        fecha = datetime.datetime.fromtimestamp(_marca[0] / 1e9,
+                                                datetime.timezone.utc)
+        return version, fecha
+
+
+def notificar(sender=None, **kwargs):
+    '''
+    Despierta a los pedidos que esperan para que vuelvan a leer la version.
+    '''
+    global _marca, _revisado
+    with _condicion:
+        _marca, _revisado = None, 0
+        _condicion.notify_all()
+
+
+firmas.version_publicada.connect(notificar)
+
+
+def esperar(actual, timeout):
+    '''
+    Espera hasta que la version publicada sea distinta de `actual` o hasta
+    que pasen `timeout` segundos. Devuelve la version publicada.
+    '''
+    limite = time.monotonic() + timeout
+    with _condicion:
+        while True:
+            version = version_publicada()
+            restante = limite - time.monotonic()
+            if version != actual or restante <= 0:
+                return version
+            _condicion.wait(min(INTERVALO, restante))
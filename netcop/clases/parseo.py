@@ -0,0 +1,283 @@
+'''
+Parseo y validación en lote de las listas de subredes y puertos.
+
+Cada lista se recorre una sola vez y se convierte en arrays de enteros
+(inicio de red y prefijo, o numero, hasta y protocolo) que se pasan
+directamente al guardado en lote de models. Las subredes pueden ser IPv4 o
+IPv6 y sus inicios se representan como en models.ip_a_entero. Las lineas con
+el formato mas comun se convierten sin expresiones regulares; las demas, y
+las invalidas, se parsean con REGEX_CIDR, REGEX_CIDR_IPV6 y REGEX_PUERTO, que
+deciden si son validas y arman el mensaje de error. Al validar una lista se
+informan todos los errores, cada uno con su numero de linea.
+'''
+import re
+import socket
+from array import array
+from django.core.exceptions import ValidationError
+from . import models
+
+REGEX_CIDR = re.compile(
+    r"^\s*(?P<ip>((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}"
+    r"(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?))"
+    r"(/(?P<prefijo>\d+))?\s*$")
+# la direccion se valida luego con inet_pton
+REGEX_CIDR_IPV6 = re.compile(
+    r"^\s*(?P<ip>[0-9a-f.]*:[0-9a-f:.]*)(/(?P<prefijo>\d+))?\s*$", flags=re.I)
+REGEX_PUERTO = re.compile(
+    r"^\s*(?P<numero>\d+)(\s*-\s*(?P<hasta>\d+))?"
+    r"(/(?P<protocolo>(tcp|udp)))?\s*$", flags=re.I)
+
+PUERTO_MIN = 1
+PUERTO_MAX = 65535
+PREFIJO_MIN = 0
+PREFIJO_MAX = 32
+PREFIJO_MAX_IPV6 = 128
+PROTOCOLOS = {'': 0, 'tcp': 6, 'udp': 17}
+
+# cantidad maxima de errores que se informan de una lista
+MAX_ERRORES = 100
+
+MASCARAS = [(0xffffffff << (models.BITS - prefijo)) & 0xffffffff
+            for prefijo in range(models.BITS + 1)]
+MASCARAS_IPV6 = [(models.IPV6 - 1) ^ ((1 << (models.BITS_IPV6 - prefijo)) - 1)
+                 for prefijo in range(models.BITS_IPV6 + 1)]
+# mitad de 64 bits de una direccion IPv6
+MITAD = (1 << 64) - 1
+
+
+def numero_protocolo(string):
+    '''
+    Obtiene el numero de protocolo en base a una cadena de caracteres.
+    Retornos
+    ---------------
+      * 6 - TCP | tcp
+      * 17 - UDP | udp
+      * 0 en cualquier otro caso.
+    '''
+    return PROTOCOLOS.get(string.lower(), 0)
+
+
+def convertir_subred(linea, inet_pton=socket.inet_pton,
+                     AF_INET=socket.AF_INET, AF_INET6=socket.AF_INET6,
+                     from_bytes=int.from_bytes):
+    '''
+    Convierte sin expresiones regulares las subredes con el formato mas comun
+    o devuelve None para que se use REGEX_CIDR o REGEX_CIDR_IPV6.
+    '''
+    direccion, barra, prefijo = linea.strip().partition('/')
+    ipv6 = ':' in direccion
+    maximo = PREFIJO_MAX_IPV6 if ipv6 else PREFIJO_MAX
+    if barra:
+        if not prefijo.isdigit():
+            return None
+        prefijo = int(prefijo)
+        if prefijo > maximo:
+            return None
+    else:
+        prefijo = maximo
+    # inet_pton solo acepta cuatro octetos decimales sin ceros a la
+    # izquierda, que REGEX_CIDR tambien acepta
+    try:
+        if ipv6:
+            entero = from_bytes(inet_pton(AF_INET6, direccion), 'big')
+            return models.IPV6 + (entero & MASCARAS_IPV6[prefijo]), prefijo
+        entero = from_bytes(inet_pton(AF_INET, direccion), 'big')
+    except OSError:
+        return None
+    return entero & MASCARAS[prefijo], prefijo
+
+
+def parsear_subred(linea):
+    '''
+    Parsea una subred con el formato direccion/prefijo y devuelve la tupla de
+    enteros (inicio de la red, prefijo). Si se pasa una direccion de host se
+    devuelve el inicio de la red que la contiene.
+    '''
+    valores = convertir_subred(linea)
+    if valores is not None:
+        return valores
+    m = REGEX_CIDR.match(linea)
+    if m is None:
+        return parsear_subred_ipv6(linea)
+    direccion = m.group('ip')
+    prefijo = int(m.group('prefijo') or PREFIJO_MAX)
+    if not PREFIJO_MIN <= prefijo <= PREFIJO_MAX:
+        raise ValidationError(
+            "%s: El prefijo debe ser entre %d y %d" %
+            (direccion, PREFIJO_MIN, PREFIJO_MAX)
+        )
+    # cada octeto se toma como decimal aunque tenga ceros a la izquierda
+    entero = 0
+    for octeto in direccion.split('.'):
+        entero = entero << 8 | int(octeto)
+    return entero & MASCARAS[prefijo], prefijo
+
+
+def parsear_cidr(linea):
+    '''
+    Parsea una subred con el formato direccion/prefijo y devuelve la tupla
+    (direccion de red, prefijo). Si se pasa una direccion de host se devuelve
+    la direccion de la red que la contiene.
+    '''
+    inicio, prefijo = parsear_subred(linea)
+    return models.entero_a_ip(inicio), prefijo
+
+
+def parsear_subred_ipv6(linea):
+    '''
+    Parsea una subred IPv6 que no pudo convertirse con convertir_subred.
+    '''
+    m = REGEX_CIDR_IPV6.match(linea)
+    if m is None:
+        raise ValidationError("%s: Error de sintaxis" % linea.strip())
+    direccion = m.group('ip')
+    try:
+        entero = int.from_bytes(socket.inet_pton(socket.AF_INET6, direccion),
+                                'big')
+    except OSError:
+        raise ValidationError("%s: Error de sintaxis" % linea.strip())
+    prefijo = int(m.group('prefijo') or PREFIJO_MAX_IPV6)
+    if not PREFIJO_MIN <= prefijo <= PREFIJO_MAX_IPV6:
+        raise ValidationError(
+            "%s: El prefijo debe ser entre %d y %d" %
+            (direccion, PREFIJO_MIN, PREFIJO_MAX_IPV6)
+        )
+    return models.IPV6 + (entero & MASCARAS_IPV6[prefijo]), prefijo
+
+
+def convertir_puerto(linea):
+    '''
+    Convierte sin expresiones regulares los puertos con el formato mas comun
+    o devuelve None para que se use REGEX_PUERTO.
+    '''
+    rango, barra, protocolo = linea.strip().partition('/')
+    if barra and not protocolo:
+        return None
+    protocolo = PROTOCOLOS.get(protocolo.lower())
+    numero, guion, hasta = rango.partition('-')
+    if protocolo is None or not numero.isdigit():
+        return None
+    numero = int(numero)
+    if guion:
+        if not hasta.isdigit():
+            return None
+        hasta = int(hasta)
+    else:
+        hasta = numero
+    if not PUERTO_MIN <= numero <= hasta <= PUERTO_MAX:
+        return None
+    return numero, hasta, protocolo
+
+
+def parsear_puerto(linea):
+    '''
+    Parsea un puerto o rango de puertos con el formato numero[-hasta]/protocolo
+    y devuelve la tupla (numero, hasta, numero de protocolo). Para un unico
+    puerto hasta es igual a numero.
+    '''
+    valores = convertir_puerto(linea)
+    if valores is not None:
+        return valores
+    m = REGEX_PUERTO.match(linea)
+    if m is None:
+        raise ValidationError("%s: Error de sintaxis" % linea.strip())
+    numero = int(m.group('numero'))
+    hasta = int(m.group('hasta') or numero)
+    for valor in (numero, hasta):
+        if not PUERTO_MIN <= valor <= PUERTO_MAX:
+            raise ValidationError(
+                "%s: el número de puerto debe ser entre %d y %d" %
+                (valor, PUERTO_MIN, PUERTO_MAX)
+            )
+    if hasta < numero:
+        raise ValidationError(
+            "%s: el rango de puertos debe ser ascendente" % linea.strip())
+    protocolo = numero_protocolo(m.group('protocolo') or '')
+    return numero, hasta, protocolo
+
+
+class Lista(object):
+    '''
+    Resultado del parseo de una lista: los arrays de enteros y los errores.
+    '''
+    # nombre y tipo de cada array
+    arrays = ()
+
+    def __init__(self):
+        for nombre, tipo in self.arrays:
+            setattr(self, nombre, array(tipo))
+        self.errores = list()
+        self.cantidad_errores = 0
+
+    def __len__(self):
+        return len(getattr(self, self.arrays[0][0]))
+
+    def __iter__(self):
+        return zip(*(getattr(self, nombre) for nombre, _ in self.arrays))
+
+    def error(self, linea, error):
+        self.cantidad_errores += 1
+        if len(self.errores) < MAX_ERRORES:
+            self.errores.extend("linea %d: %s" % (linea, mensaje)
+                                for mensaje in error.messages)
+
+    def validar(self):
+        '''
+        Lanza un ValidationError con todos los errores de la lista.
+        '''
+        if self.cantidad_errores:
+            errores = list(self.errores)
+            if self.cantidad_errores > MAX_ERRORES:
+                errores.append("y %d errores mas" %
+                               (self.cantidad_errores - MAX_ERRORES))
+            raise ValidationError(errores)
+
+    def parsear(self, texto):
+        parsear_linea = self.parsear_linea
+        filas = list()
+        for numero, linea in enumerate(texto.splitlines(), 1):
+            try:
+                filas.append(parsear_linea(linea))
+            except ValidationError as e:
+                # las lineas en blanco se ignoran
+                if linea.strip():
+                    self.error(numero, e)
+        for (nombre, _), columna in zip(self.arrays, zip(*filas)):
+            getattr(self, nombre).extend(columna)
+        return self
+
+
+class Subredes(Lista):
+    # el inicio de cada red se guarda como la familia (1 si es IPv6) y las
+    # dos mitades de 64 bits de la direccion
+    arrays = (('ipv6', 'B'), ('altos', 'Q'), ('bajos', 'Q'),
+              ('prefijos', 'B'))
+
+    @staticmethod
+    def parsear_linea(linea):
+        inicio, prefijo = parsear_subred(linea)
+        return (inicio >> models.BITS_IPV6, inicio >> 64 & MITAD,
+                inicio & MITAD, prefijo)
+
+    def __iter__(self):
+        for ipv6, alto, bajo, prefijo in super().__iter__():
+            yield ipv6 << models.BITS_IPV6 | alto << 64 | bajo, prefijo
+
+
+class Puertos(Lista):
+    arrays = (('numeros', 'H'), ('hastas', 'H'), ('protocolos', 'B'))
+    parsear_linea = staticmethod(parsear_puerto)
+
+
+def subredes(texto):
+    '''
+    Parsea una lista de subredes separadas por nueva linea.
+    '''
+    return Subredes().parsear(texto)
+
+
+def puertos(texto):
+    '''
+    Parsea una lista de puertos separados por nueva linea.
+    '''
+    return Puertos().parsear(texto)
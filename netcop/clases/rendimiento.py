@@ -0,0 +1,430 @@
+'''
+Medición del rendimiento de la API que usan los agentes.
+
+Las mediciones se hacen sobre datos generados de N clases con M subredes y K
+puertos cada una, repartidos entre los grupos outside e inside. Para cada
+escenario se mide el tiempo (minimo y mediana de varias repeticiones), la
+cantidad de consultas a la base de datos y el pico de memoria con
+tracemalloc.
+
+El simulador de agentes consulta un servidor en marcha con varios hilos, cada
+uno como un agente que revisa la version cada cierto intervalo (o espera con
+long poll) y descarga las firmas cuando cambian.
+
+Los resultados son diccionarios que se pueden guardar como json y comparar
+entre commits con `comparar`.
+'''
+import datetime
+import http.client
+import io
+import json
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from . import binario, forms, lotes, models, views
+
+ESCALAS = ((10, 50, 10), (100, 50, 10), (500, 50, 10))
+REPETICIONES = 5
+PROPORCION_INSIDE = 0.3
+# diferencia relativa a partir de la cual `comparar` informa una regresion
+TOLERANCIA = 0.2
+# metricas que compara `comparar`
+METRICAS = ('tiempo_mediana', 'consultas', 'memoria_pico')
+
+
+class Deshacer(Exception):
+    '''
+    Se lanza para deshacer la transaccion con los datos generados.
+    '''
+
+
+def generar_clases(clases, subredes, puertos,
+                   proporcion_inside=PROPORCION_INSIDE, semilla=0):
+    '''
+    Genera clases en el formato de la descarga, con subredes /24 a /32 y
+    puertos tcp, udp o sin protocolo, algunos como rangos. Una proporcion de
+    las subredes y puertos de cada clase va al grupo inside.
+    '''
+    azar = random.Random(semilla)
+    for i in range(clases):
+        clase = {'nombre': 'clase %d' % i,
+                 'descripcion': 'generada para medir el rendimiento',
+                 'activa': azar.random() < 0.9}
+        for campo in lotes.CAMPOS:
+            clase[campo[0]] = list()
+        for _ in range(subredes):
+            prefijo = azar.randint(24, 32)
+            direccion = (azar.getrandbits(models.BITS) &
+                         binario.mascara(prefijo))
+            grupo = ('subredes_inside' if azar.random() < proporcion_inside
+                     else 'subredes_outside')
+            clase[grupo].append("%s/%d" % (models.entero_a_ip(direccion),
+                                           prefijo))
+        for _ in range(puertos):
+            numero = azar.randint(1, 65000)
+            hasta = numero + (azar.randint(1, 100)
+                              if azar.random() < 0.1 else 0)
+            protocolo = azar.choice((0, 6, 17))
+            grupo = ('puertos_inside' if azar.random() < proporcion_inside
+                     else 'puertos_outside')
+            clase[grupo].append(models.texto_puerto(numero, hasta, protocolo))
+        yield clase
+
+
+def cargar_clases(clases, subredes, puertos,
+                  proporcion_inside=PROPORCION_INSIDE, semilla=0):
+    '''
+    Importa las clases generadas y publica la version.
+    '''
+    archivo = io.StringIO()
+    for clase in generar_clases(clases, subredes, puertos, proporcion_inside,
+                                semilla):
+        archivo.write(json.dumps(clase) + '\n')
+    archivo.seek(0)
+    return lotes.importar(archivo)
+
+
+@contextmanager
+def aislado():
+    '''
+    Usa una base de datos de prueba, un MEDIA_ROOT temporal y una cache
+    propia para que las mediciones no modifiquen los datos ni la version
+    publicada.
+    '''
+    media = tempfile.mkdtemp()
+    caches = dict(settings.CACHES, rendimiento={
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'rendimiento',
+    })
+    nombre = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                       serialize=False)
+    try:
+        with override_settings(MEDIA_ROOT=media, CACHES=caches,
+                               FIRMAS_CACHE='rendimiento'):
+            yield
+    finally:
+        connection.creation.destroy_test_db(nombre, verbosity=0)
+        shutil.rmtree(media)
+
+
+def medir(funcion, repeticiones=REPETICIONES):
+    '''
+    Ejecuta la funcion `repeticiones` veces y devuelve un diccionario con el
+    tiempo minimo y la mediana en segundos, la cantidad de consultas y el pico
+    de memoria en bytes de una ejecucion adicional.
+    '''
+    tiempos = list()
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    # tracemalloc hace mas lenta la ejecucion, por lo que se mide aparte
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as consultas:
+            funcion()
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'tiempo_min': min(tiempos),
+        'tiempo_mediana': statistics.median(tiempos),
+        'consultas': len(consultas),
+        'memoria_pico': pico,
+    }
+
+
+def escenarios(subredes, puertos, proporcion_inside=PROPORCION_INSIDE):
+    '''
+    Devuelve un diccionario {nombre: funcion} con los escenarios a medir.
+    '''
+    fabrica = RequestFactory()
+    usuario = User(username='rendimiento')
+    version = views.VersionView.as_view()
+    descarga = views.ClaseJson.as_view()
+    listado = views.ClaseList.as_view()
+    direccion = (models.CIDR.objects.order_by('id')
+                                    .values_list('direccion', flat=True)
+                                    .first())
+    nuevas = generar_clases(10 ** 6, subredes, puertos, proporcion_inside,
+                            semilla=1)
+
+    def buscar():
+        request = fabrica.get('/', {'q': direccion or 'clase'})
+        request.user = usuario
+        listado(request).render()
+
+    def guardar():
+        clase = next(nuevas)
+        datos = {campo: "\n".join(clase[campo])
+                 for campo, _, _ in lotes.CAMPOS}
+        datos.update(nombre=clase['nombre'][:32], activa=True,
+                     descripcion=clase['descripcion'])
+        form = forms.ClaseForm(datos)
+        if not form.is_valid():
+            raise ValueError(form.errors)
+        form.save()
+
+    return {
+        'obtener_clases': lambda: views.ClaseJson().obtener_clases(),
+        'version': lambda: version(fabrica.get('/version/')),
+        'descarga': lambda: descarga(fabrica.get(
+            '/descarga/', HTTP_ACCEPT_ENCODING='gzip')),
+        'busqueda': buscar,
+        'guardar': guardar,
+    }
+
+
+def medir_escala(clases, subredes, puertos, repeticiones=REPETICIONES,
+                 proporcion_inside=PROPORCION_INSIDE):
+    '''
+    Carga los datos de la escala, mide todos los escenarios y deshace los
+    cambios en la base de datos.
+    '''
+    resultado = {'escala': {'clases': clases, 'subredes': subredes,
+                            'puertos': puertos}}
+    try:
+        with transaction.atomic():
+            inicio = time.perf_counter()
+            cargar_clases(clases, subredes, puertos, proporcion_inside)
+            resultado['carga'] = time.perf_counter() - inicio
+            resultado['escenarios'] = {
+                nombre: medir(funcion, repeticiones)
+                for nombre, funcion in sorted(escenarios(
+                    subredes, puertos, proporcion_inside).items())
+            }
+            raise Deshacer()
+    except Deshacer:
+        pass
+    return resultado
+
+
+def commit_actual():
+    try:
+        salida = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return salida.decode().strip()
+
+
+def entorno():
+    '''
+    Datos del entorno en que se hicieron las mediciones.
+    '''
+    return {
+        'fecha': datetime.datetime.utcnow().isoformat(),
+        'commit': commit_actual(),
+        'django': django.get_version(),
+    }
+
+
+def medir_escalas(escalas=ESCALAS, repeticiones=REPETICIONES,
+                  proporcion_inside=PROPORCION_INSIDE):
+    resultado = entorno()
+    resultado['base_de_datos'] = connection.vendor
+    resultado['resultados'] = [
+        medir_escala(clases, subredes, puertos, repeticiones,
+                     proporcion_inside)
+        for clases, subredes, puertos in escalas
+    ]
+    return resultado
+
+
+def comparar(anterior, actual, tolerancia=TOLERANCIA):
+    '''
+    Compara dos resultados de `medir_escalas` y devuelve una lista de tuplas
+    (escala, escenario, metrica, valor anterior, valor actual) con las
+    metricas que empeoraron mas que la tolerancia relativa.
+    '''
+    def por_escenario(resultado):
+        valores = dict()
+        for medicion in resultado['resultados']:
+            escala = "%(clases)dx%(subredes)dx%(puertos)d" % \
+                medicion['escala']
+            for escenario, metricas in medicion['escenarios'].items():
+                valores[escala, escenario] = metricas
+        return valores
+
+    previos = por_escenario(anterior)
+    regresiones = list()
+    for (escala, escenario), metricas in sorted(por_escenario(actual).items()):
+        for metrica in METRICAS:
+            antes = previos.get((escala, escenario), {}).get(metrica)
+            ahora = metricas.get(metrica)
+            if antes is None or ahora is None:
+                continue
+            if ahora > antes * (1 + tolerancia) and ahora != antes:
+                regresiones.append((escala, escenario, metrica, antes, ahora))
+    return regresiones
+
+
+def percentiles(latencias):
+    if not latencias:
+        return {}
+    latencias = sorted(latencias)
+
+    def percentil(p):
+        return latencias[min(len(latencias) - 1, int(len(latencias) * p))]
+
+    return {'p50': percentil(0.5), 'p90': percentil(0.9),
+            'p99': percentil(0.99), 'max': latencias[-1]}
+
+
+class Agente(threading.Thread):
+    '''
+    Agente simulado: consulta la version con If-None-Match cada `intervalo`
+    segundos, o esperando el cambio con long poll, y descarga las firmas
+    comprimidas cada vez que la version cambia.
+    '''
+
+    def __init__(self, url, hasta, intervalo, esperar, estadisticas):
+        super().__init__(daemon=True)
+        partes = urllib.parse.urlsplit(url)
+        self.host = partes.netloc
+        self.prefijo = partes.path.rstrip('/')
+        self.seguro = partes.scheme == 'https'
+        self.hasta = hasta
+        self.intervalo = intervalo
+        self.esperar = esperar
+        self.estadisticas = estadisticas
+        self.version = None
+        self.etag_version = None
+        self.etag_descarga = None
+        self.conexion = None
+
+    def pedir(self, nombre, path, encabezados):
+        if self.conexion is None:
+            clase = (http.client.HTTPSConnection if self.seguro
+                     else http.client.HTTPConnection)
+            self.conexion = clase(self.host, timeout=120)
+        inicio = time.perf_counter()
+        try:
+            self.conexion.request('GET', self.prefijo + path,
+                                  headers=encabezados)
+            respuesta = self.conexion.getresponse()
+            cuerpo = respuesta.read()
+        except (OSError, http.client.HTTPException):
+            self.conexion.close()
+            self.conexion = None
+            self.estadisticas.registrar(nombre, None, 0, 0)
+            return None, None
+        self.estadisticas.registrar(nombre, respuesta.status, len(cuerpo),
+                                    time.perf_counter() - inicio)
+        return respuesta, cuerpo
+
+    def run(self):
+        # los agentes no se conectan todos a la vez
+        time.sleep(random.uniform(0, self.intervalo))
+        while time.monotonic() < self.hasta:
+            self.ciclo()
+            if not self.esperar:
+                time.sleep(self.intervalo * random.uniform(0.8, 1.2))
+        if self.conexion is not None:
+            self.conexion.close()
+
+    def ciclo(self):
+        path = '/version/'
+        encabezados = {}
+        if self.esperar and self.version:
+            restante = max(0, int(self.hasta - time.monotonic()))
+            path += '?' + urllib.parse.urlencode(
+                {'esperar': self.version, 'timeout': min(restante, 30)})
+        if self.etag_version:
+            encabezados['If-None-Match'] = self.etag_version
+        respuesta, cuerpo = self.pedir('version', path, encabezados)
+        if respuesta is None or respuesta.status != 200:
+            if respuesta is None and self.esperar:
+                time.sleep(self.intervalo)
+            return
+        self.etag_version = respuesta.getheader('ETag')
+        try:
+            version = json.loads(cuerpo.decode())['version']
+        except (ValueError, KeyError, TypeError):
+            self.estadisticas.registrar('version', None, 0, 0)
+            return
+        if version == self.version:
+            return
+        encabezados = {'Accept-Encoding': 'gzip'}
+        if self.etag_descarga:
+            encabezados['If-None-Match'] = self.etag_descarga
+        respuesta, _ = self.pedir('descarga', '/descarga/', encabezados)
+        if respuesta is not None and respuesta.status in (200, 304):
+            self.version = version
+            self.etag_descarga = respuesta.getheader('ETag')
+
+
+class Estadisticas(object):
+    '''
+    Acumula los pedidos de todos los agentes por endpoint.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencias = defaultdict(list)
+        self.estados = defaultdict(Counter)
+        self.bytes = Counter()
+
+    def registrar(self, nombre, estado, largo, latencia):
+        with self.lock:
+            self.estados[nombre][str(estado or 'error')] += 1
+            if estado is not None:
+                self.latencias[nombre].append(latencia)
+                self.bytes[nombre] += largo
+
+    def como_dict(self, duracion):
+        resultado = dict()
+        for nombre, estados in self.estados.items():
+            pedidos = sum(estados.values())
+            resultado[nombre] = {
+                'pedidos': pedidos,
+                'pedidos_por_segundo': pedidos / duracion,
+                'estados': dict(estados),
+                'bytes': self.bytes[nombre],
+                'latencia': percentiles(self.latencias[nombre]),
+            }
+        return resultado
+
+
+def simular_agentes(url, agentes=100, duracion=30, intervalo=5,
+                    esperar=False):
+    '''
+    Simula `agentes` agentes consultando el servidor de `url` durante
+    `duracion` segundos y devuelve las estadisticas de los pedidos.
+    '''
+    estadisticas = Estadisticas()
+    inicio = time.monotonic()
+    hilos = [Agente(url, inicio + duracion, intervalo, esperar, estadisticas)
+             for _ in range(agentes)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    transcurrido = time.monotonic() - inicio
+    resultado = entorno()
+    resultado.update({
+        'url': url,
+        'agentes': agentes,
+        'duracion': transcurrido,
+        'intervalo': intervalo,
+        'esperar': esperar,
+        'actualizados': sum(1 for hilo in hilos if hilo.version),
+        'endpoints': estadisticas.como_dict(transcurrido),
+    })
+    return resultado
@@ -0,0 +1,121 @@
+'''
+Lectura desde replicas de la base de datos.
+
+Las vistas de solo lectura que consultan los agentes y el listado de clases
+se ejecutan con `lectura_en_replica`: mientras dura, ReplicasRouter manda las
+lecturas de los modelos de clases a una de las bases de REPLICAS en settings,
+elegida al azar una vez por pedido. Las demas lecturas, las de otras
+aplicaciones como las sesiones y todas las escrituras usan la base principal.
+
+Para que una lectura posterior a una escritura vea lo escrito aunque la
+replica este atrasada, el pedido que escribe sigue leyendo de la principal y
+ReplicasMiddleware responde con una cookie que fija a la principal los
+pedidos del mismo cliente durante REPLICAS_RETRASO segundos.
+'''
+import random
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+
+COOKIE = 'netcop_principal'
+# aplicacion cuyos modelos se leen de las replicas
+APLICACION = 'clases'
+
+_estado = threading.local()
+
+
+def replicas():
+    return getattr(settings, 'REPLICAS', ())
+
+
+def reiniciar():
+    '''
+    Olvida las escrituras y la replica elegida. Se llama al empezar cada
+    pedido porque los hilos se reutilizan.
+    '''
+    _estado.replica = None
+    _estado.escribio = False
+    _estado.fijado = False
+    _estado.principal = False
+
+
+def escribio():
+    return getattr(_estado, 'escribio', False)
+
+
+def replica_actual():
+    '''
+    Devuelve el alias de la replica de la que se leen los modelos de clases
+    o None si se leen de la base principal.
+    '''
+    if (escribio() or getattr(_estado, 'fijado', False) or
+            getattr(_estado, 'principal', False)):
+        return None
+    return getattr(_estado, 'replica', None)
+
+
+@contextmanager
+def lectura_en_replica():
+    '''
+    Lee de una replica, si hay, los modelos de clases.
+    '''
+    anterior = getattr(_estado, 'replica', None)
+    if anterior is None and replicas():
+        _estado.replica = random.choice(replicas())
+    try:
+        yield
+    finally:
+        _estado.replica = anterior
+
+
+@contextmanager
+def principal():
+    '''
+    Lee de la base principal aunque se este dentro de lectura_en_replica.
+    '''
+    anterior = getattr(_estado, 'principal', False)
+    _estado.principal = True
+    try:
+        yield
+    finally:
+        _estado.principal = anterior
+
+
+class ReplicasRouter(object):
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == APLICACION:
+            return replica_actual()
+        return None
+
+    def db_for_write(self, model, **hints):
+        # las lecturas que siguen deben ver la escritura
+        _estado.escribio = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # las replicas tienen los mismos datos que la principal
+        return True
+
+    def allow_migrate(self, db, app_label, model=None, **hints):
+        if db in replicas():
+            return False
+        return None
+
+
+class ReplicasMiddleware(object):
+    '''
+    Fija a la base principal los pedidos con la cookie de una escritura
+    reciente y la envia cuando el pedido escribe.
+    '''
+
+    def process_request(self, request):
+        reiniciar()
+        _estado.fijado = bool(request.COOKIES.get(COOKIE))
+
+    def process_response(self, request, response):
+        if replicas() and escribio():
+            response.set_cookie(COOKIE, '1', httponly=True,
+                                max_age=getattr(settings, 'REPLICAS_RETRASO',
+                                                5))
+        return response
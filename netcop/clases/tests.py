@@ -1,15 +1,65 @@
-import unittest
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import ipaddress
+import json
+import os
+import random
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import zlib
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, connections
+from django.http import QueryDict
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 
-from . import forms, models
+from . import (asincronico, binario, busqueda, cache, clasificador, firmas,
+               forms, lotes, metricas, models, normalizacion,
+               notificaciones, parseo, rendimiento, replicas, views)
 
 
-class TestCreate(TestCase):
+def leer_json(response):
+    '''
+    Decodifica el json de una respuesta, sea o no una respuesta en streaming.
+    '''
+    if response.streaming:
+        contenido = b''.join(response.streaming_content)
+    else:
+        contenido = response.content
+    return json.loads(contenido.decode())
+
+
+class MediaTemporalMixin(object):
+    '''
+    Usa un MEDIA_ROOT temporal para que las pruebas no escriban la version ni
+    los snapshots en el proyecto, y vacia la cache de las firmas.
+    '''
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        configuracion = self.settings(MEDIA_ROOT=media)
+        configuracion.enable()
+        self.addCleanup(configuracion.disable)
+        cache.obtener_cache().clear()
+
+
+class TestCreate(MediaTemporalMixin, TestCase):
 
     def setUp(self):
         '''
         Inicializa datos.
         '''
+        super().setUp()
         self.data = {
             'nombre': 'foo',
             'descripcion': 'bar',
@@ -131,6 +181,55 @@ class TestCreate(TestCase):
                                    grupo=models.INSIDE)
                            .exists())
 
+    def test_update_diferencial(self):
+        '''
+        Prueba que al actualizar una clase solo se borren e inserten las
+        relaciones que cambiaron.
+        '''
+        self.data["subredes_outside"] = "1.1.1.0/24\n2.2.2.0/24\n3.3.3.0/24"
+        self.data["puertos_outside"] = "80/tcp\n443/tcp"
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        clase = form.save()
+        conservadas = set(clase.redes.filter(cidr__direccion__in=[
+            '1.1.1.0', '3.3.3.0']).values_list('id', flat=True))
+        puerto = clase.puertos.get(puerto__numero=443).id
+        # quito una red, agrego otra y muevo un puerto a inside
+        self.data["subredes_outside"] = "3.3.3.0/24\n1.1.1.0/24\n4.4.4.4"
+        self.data["puertos_outside"] = "443/tcp"
+        self.data["puertos_inside"] = "80/tcp"
+        form = forms.ClaseForm(self.data, instance=clase)
+        assert form.is_valid()
+        form.save()
+        self.assertEqual(
+            sorted(str(item) for item in clase.redes.all()),
+            ['1.1.1.0/24', '3.3.3.0/24', '4.4.4.4/32'])
+        assert conservadas <= set(clase.redes.values_list('id', flat=True))
+        self.assertEqual(clase.puertos.get(grupo=models.OUTSIDE).id, puerto)
+        assert clase.puertos.filter(puerto__numero=80,
+                                    grupo=models.INSIDE).exists()
+        # las subredes existentes se reutilizan
+        self.assertEqual(models.CIDR.objects.count(), 4)
+
+    def test_save_consultas(self):
+        '''
+        Prueba que la cantidad de consultas al guardar una clase no crezca con
+        la cantidad de subredes y puertos.
+        '''
+        def guardar(cantidad):
+            data = dict(self.data)
+            data["subredes_outside"] = "\n".join(
+                "10.0.%d.0/24" % i for i in range(cantidad))
+            data["puertos_inside"] = "\n".join(
+                "%d/udp" % (i + 1) for i in range(cantidad))
+            form = forms.ClaseForm(data)
+            assert form.is_valid()
+            with CaptureQueriesContext(connection) as consultas:
+                form.save()
+            return len(consultas)
+
+        self.assertEqual(guardar(5), guardar(200))
+
     def test_load_subnet(self):
         '''
         Prueba la carga de subredes al actualizar una clase de trafico.
@@ -261,23 +360,1988 @@ class TestCreate(TestCase):
         form = forms.ClaseForm(self.data)
         assert not form.is_valid()
 
-    @unittest.skip("No implementado")
+    def test_rango_puertos(self):
+        '''
+        Prueba guardar, validar, buscar y clasificar rangos de puertos.
+        '''
+        self.data["puertos_outside"] = "49152-65535/udp\n1000 - 2000"
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        clase = form.save()
+        self.assertEqual(models.Puerto.objects.count(), 2)
+        puerto = models.Puerto.objects.get(protocolo=17)
+        self.assertEqual((puerto.numero, puerto.hasta), (49152, 65535))
+        self.assertEqual(str(puerto), '49152-65535/udp')
+        documento = leer_json(self.client.get(reverse('json')))
+        self.assertEqual(documento['clases'][0]['puertos_outside'],
+                         ['49152-65535/udp', '1000-2000'])
+        # busqueda por un puerto o rango incluido en el rango
+        for q in ('50000', '60000/udp', '1500-3000/tcp'):
+            response = self.client.get(reverse('index'), {'q': q})
+            self.assertEqual(list(response.context['object_list']), [clase],
+                             q)
+        for q in ('50000/tcp', '2001-3000'):
+            response = self.client.get(reverse('index'), {'q': q})
+            self.assertEqual(list(response.context['object_list']), [], q)
+        # clasificacion
+        indice = clasificador.obtener_indice()
+        for puerto, protocolo, clases in ((49152, 17, [clase.id]),
+                                          (65535, None, [clase.id]),
+                                          (49152, 6, []),
+                                          (2000, 6, [clase.id]),
+                                          (2001, None, [])):
+            resultado = indice.clasificar(puerto=puerto, protocolo=protocolo)
+            self.assertEqual(resultado['outside']['clases'], clases)
+        # rangos invalidos
+        for rango in ("2000-1000", "1-65536", "0-10/tcp", "1-2-3"):
+            self.data["puertos_outside"] = rango
+            form = forms.ClaseForm(self.data)
+            assert not form.is_valid(), rango
+
     def test_list(self):
         '''
         Prueba obtener la lista de clases de trafico instaladas.
         '''
-        pass
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        activa = form.save()
+        form = forms.ClaseForm(dict(self.data, nombre='otra', activa=False))
+        assert form.is_valid()
+        inactiva = form.save()
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['object_list']),
+                         [activa, inactiva])
+
+    def test_list_paginas(self):
+        '''
+        Prueba paginar el listado por clave y que la cantidad de consultas no
+        crezca con la cantidad de clases.
+        '''
+        clases = list()
+        for i in range(7):
+            data = dict(self.data, nombre='clase%d' % i, activa=i % 2 == 0)
+            data["subredes_outside"] = "10.%d.0.0/16\n1.1.1.1" % i
+            data["puertos_inside"] = "%d" % (i + 1)
+            form = forms.ClaseForm(data)
+            assert form.is_valid()
+            clases.append(form.save())
+        esperado = ([c for c in clases if c.activa] +
+                    [c for c in clases if not c.activa])
+
+        obtenido = list()
+        parametros = {'cantidad': 3}
+        while True:
+            with self.assertNumQueries(1):
+                response = self.client.get(reverse('index'), parametros)
+                response.render()
+            obtenido.extend(response.context['object_list'])
+            self.assertEqual(response.context['clasetrafico_list'],
+                             response.context['object_list'])
+            if 'siguiente' not in response.context:
+                break
+            parametros = QueryDict(response.context['siguiente'][1:])
+        self.assertEqual(obtenido, esperado)
+        clase = obtenido[0]
+        self.assertEqual((clase.redes_outside, clase.redes_inside,
+                          clase.puertos_outside, clase.puertos_inside),
+                         (2, 0, 0, 1))
+
+    def test_search(self):
+        '''
+        Prueba buscar clases por direccion, subred, puerto, id y texto.
+        '''
+        def buscar(q):
+            response = self.client.get(reverse('index'), {'q': q})
+            return [clase.nombre for clase in response.context['object_list']]
+
+        def crear(nombre, descripcion, **campos):
+            form = forms.ClaseForm(dict(campos, nombre=nombre,
+                                        descripcion=descripcion,
+                                        activa=True))
+            assert form.is_valid()
+            return form.save()
+
+        web = crear('web', 'Navegacion', subredes_outside="203.0.113.0/24",
+                    puertos_outside="443/tcp\n80/tcp")
+        crear('dns', 'Resolucion de nombres', subredes_outside="8.8.8.8",
+              puertos_outside="53")
+        crear('lan', 'Red local', subredes_inside="10.0.0.0/8")
+
+        self.assertEqual(buscar('203.0.113.7'), ['web'])
+        self.assertEqual(buscar('10.200.1.1'), ['lan'])
+        self.assertEqual(buscar('10.200.0.0/16'), ['lan'])
+        self.assertEqual(buscar('0.0.0.0/0'), ['web', 'dns', 'lan'])
+        self.assertEqual(buscar('203.0'), ['web'])
+        self.assertEqual(buscar('443/tcp'), ['web'])
+        self.assertEqual(buscar('53/udp'), ['dns'])
+        self.assertEqual(buscar('53'), ['dns'])
+        self.assertEqual(buscar(str(web.id)), ['web'])
+        self.assertEqual(buscar('NOMBRES'), ['dns'])
+        self.assertEqual(buscar('red LOCAL'), ['lan'])
+        self.assertEqual(buscar('red 8.8.8.8'), [])
+        self.assertEqual(buscar('nada'), [])
+        # los terminos que parecen direcciones o puertos tambien se buscan
+        # como texto
+        crear('vpn', 'Tunel 1.5 a 172.16.0.0/12')
+        self.assertEqual(buscar('1.5'), ['vpn'])
+        self.assertEqual(buscar('172.16.0.0/12'), ['vpn'])
+        self.assertEqual(buscar('tunel 1.5'), ['vpn'])
+
+    def test_parsear_busqueda(self):
+        '''
+        Prueba la clasificacion de los terminos de busqueda.
+        '''
+        self.assertEqual(
+            busqueda.parsear('1.2.3.4 1.2.3.0/24 10.20 443/tcp 1000-2000 22 '
+                             'foo 1.2/x'),
+            [(busqueda.IP, ('1.2.3.4', 32)),
+             (busqueda.SUBRED, ('1.2.3.0', 24)),
+             (busqueda.SUBRED, ('10.20.0.0', 16)),
+             (busqueda.PUERTO, (443, 443, 6)),
+             (busqueda.PUERTO, (1000, 2000, 0)),
+             (busqueda.NUMERO, 22),
+             (busqueda.TEXTO, 'foo'),
+             (busqueda.TEXTO, '1.2/x')])
 
-    @unittest.skip("No implementado")
     def test_json(self):
         '''
         Prueba obtener la lista de clases de trafico instaladas en formato JSON
         '''
-        pass
+        # preparo datos
+        self.data["subredes_outside"] = "191.50.15.0/24\n5.5.0.1"
+        self.data["subredes_inside"] = "192.168.1.0/24"
+        self.data["puertos_outside"] = "80/tcp\n53/udp"
+        self.data["puertos_inside"] = "22"
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        obj = form.save()
+        # obtengo el json
+        response = self.client.get(reverse('json'))
+        self.assertEqual(response.status_code, 200)
+        clases = leer_json(response)['clases']
+        self.assertEqual(len(clases), 1)
+        self.assertEqual(clases[0]['id'], obj.id)
+        self.assertEqual(clases[0]['nombre'], 'foo')
+        self.assertEqual(clases[0]['descripcion'], 'bar')
+        assert clases[0]['activa']
+        self.assertEqual(clases[0]['subredes_outside'],
+                         ['191.50.15.0/24', '5.5.0.1/32'])
+        self.assertEqual(clases[0]['subredes_inside'], ['192.168.1.0/24'])
+        self.assertEqual(clases[0]['puertos_outside'], ['80/tcp', '53/udp'])
+        self.assertEqual(clases[0]['puertos_inside'], ['22'])
+
+    def test_json_consultas(self):
+        '''
+        Prueba que la cantidad de consultas para generar el json no crezca con
+        la cantidad de clases.
+        '''
+        def crear_clases(cantidad):
+            for i in range(cantidad):
+                data = dict(self.data)
+                data["subredes_outside"] = "10.%d.0.0/16" % i
+                data["subredes_inside"] = "192.168.%d.0/24" % i
+                data["puertos_outside"] = "%d/tcp" % (i + 1)
+                data["puertos_inside"] = "%d/udp" % (i + 1)
+                form = forms.ClaseForm(data)
+                assert form.is_valid()
+                form.save()
+
+        vista = views.ClaseJson()
+        crear_clases(1)
+        with CaptureQueriesContext(connection) as pocas:
+            vista.obtener_clases()
+        crear_clases(10)
+        with CaptureQueriesContext(connection) as muchas:
+            self.assertEqual(len(vista.obtener_clases()), 11)
+        self.assertEqual(len(pocas), len(muchas))
+
+    def test_clase_publicada(self):
+        '''
+        Prueba que la copia publicada de cada clase se actualice al guardarla
+        y que la descarga se arme solo a partir de ella.
+        '''
+        self.data["subredes_outside"] = "10.0.0.0/8\n2001:db8::/32"
+        self.data["puertos_inside"] = "22\n1000-2000/udp"
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        clase = form.save()
+        self.assertEqual(firmas.clases_publicadas(), firmas.obtener_clases())
+        publicada = models.ClasePublicada.objects.get(clase=clase)
+        self.assertEqual(publicada.subredes_outside,
+                         "10.0.0.0/8\n2001:db8::/32")
+        self.assertEqual(publicada.puertos_outside, "")
+        # al modificar la clase se actualiza su copia
+        self.data["nombre"] = "otro"
+        self.data["subredes_outside"] = ""
+        form = forms.ClaseForm(self.data, instance=clase)
+        assert form.is_valid()
+        form.save()
+        self.assertEqual(firmas.clases_publicadas(), firmas.obtener_clases())
+        self.assertEqual(firmas.clases_publicadas()[0]['nombre'], 'otro')
+        with CaptureQueriesContext(connection) as consultas:
+            firmas.documento(firmas.leer_version())
+        self.assertEqual(len(consultas), 1)
+        self.assertNotIn('JOIN', consultas[0]['sql'])
 
-    @unittest.skip("No implementado")
     def test_version(self):
         '''
         Prueba obtener el numero de version de las clases instaladas.
         '''
-        pass
+        # sin version publicada
+        response = self.client.get(reverse('version'))
+        self.assertEqual(response.status_code, 404)
+        # guardo una clase
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        form.save()
+        response = self.client.get(reverse('version'))
+        self.assertEqual(response.status_code, 200)
+        version = leer_json(response)['version']
+        self.assertEqual(version, firmas.leer_version())
+        # una nueva modificacion cambia la version
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        form.save()
+        self.assertNotEqual(version, firmas.leer_version())
+
+    def test_version_contenido(self):
+        '''
+        Prueba que la version dependa solo del contenido: guardar sin cambios
+        no genera una nueva version y volver al contenido anterior vuelve a
+        la version anterior.
+        '''
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        clase = form.save()
+        v1 = firmas.leer_version()
+        self.assertEqual(v1, firmas.ultima_version())
+        self.assertEqual(len(v1), 64)
+        # guardar sin cambios
+        form = forms.ClaseForm(self.data, instance=clase)
+        assert form.is_valid()
+        form.save()
+        self.assertEqual(firmas.leer_version(), v1)
+        self.assertEqual(models.Version.objects.count(), 1)
+        # el orden de las subredes no cambia el contenido
+        form = forms.ClaseForm(dict(self.data,
+                                    subredes_outside="10.0.0.0/8\n1.0.0.0/8"),
+                               instance=clase)
+        assert form.is_valid()
+        form.save()
+        v2 = firmas.leer_version()
+        self.assertNotEqual(v2, v1)
+        form = forms.ClaseForm(dict(self.data,
+                                    subredes_outside="1.0.0.0/8\n10.0.0.0/8"),
+                               instance=clase)
+        assert form.is_valid()
+        form.save()
+        self.assertEqual(firmas.leer_version(), v2)
+        # volver al contenido original vuelve a la primera version
+        form = forms.ClaseForm(self.data, instance=clase)
+        assert form.is_valid()
+        form.save()
+        self.assertEqual(firmas.leer_version(), v1)
+        self.assertEqual(firmas.ultima_version(), v1)
+        self.assertEqual(
+            [c['id'] for c in firmas.obtener_delta(v2)['clases']], [clase.id])
+        # recalcular todas las huellas da la misma version
+        models.ClaseTrafico.objects.update(huella='')
+        self.assertEqual(firmas.publicar(), v1)
+
+    def test_version_desde_base_de_datos(self):
+        '''
+        Prueba que un servidor sin archivo de version o con una version
+        vieja materialice la version registrada en la base de datos.
+        '''
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        form.save()
+        version = firmas.leer_version()
+        shutil.rmtree(os.path.dirname(firmas.ruta_snapshot(version)))
+        os.unlink(firmas.ruta_version())
+        cache.obtener_cache().clear()
+        response = self.client.get(reverse('version'))
+        self.assertEqual(leer_json(response)['version'], version)
+        assert os.path.exists(firmas.ruta_snapshot(version))
+        # otro servidor registra una version: al vencer la cache se publica
+        # tambien en este
+        models.ClaseTrafico.objects.create(nombre='otra')
+        nueva = firmas.registrar_cambios()
+        self.assertNotEqual(nueva, version)
+        self.assertEqual(firmas.leer_version(), version)
+        cache.obtener_cache().clear()
+        response = self.client.get(reverse('version'))
+        self.assertEqual(leer_json(response)['version'], nueva)
+        assert os.path.exists(firmas.ruta_snapshot(nueva))
+
+    def test_version_inicial(self):
+        '''
+        Prueba que al actualizar una base con clases y sin versiones
+        registradas se publique la version del contenido actual.
+        '''
+        clase = models.ClaseTrafico.objects.create(nombre='foo',
+                                                   descripcion='bar')
+        self.assertFalse(models.Version.objects.exists())
+        self.assertFalse(models.ClasePublicada.objects.exists())
+        response = self.client.get(reverse('version'))
+        self.assertEqual(response.status_code, 200)
+        version = leer_json(response)['version']
+        self.assertEqual(firmas.ultima_version(), version)
+        assert os.path.exists(firmas.ruta_snapshot(version))
+        response = self.client.get(reverse('json'))
+        self.assertEqual([c['id'] for c in leer_json(response)['clases']],
+                         [clase.id])
+
+    def test_snapshot(self):
+        '''
+        Prueba que al guardar una clase se publique el snapshot y que la
+        descarga lo sirva sin consultar la base de datos.
+        '''
+        self.data["subredes_outside"] = "191.50.15.0/24"
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        form.save()
+        version = firmas.leer_version()
+        assert os.path.exists(firmas.ruta_snapshot(version))
+        # los archivos publicados tienen los permisos de la umask
+        for path in (firmas.ruta_snapshot(version), firmas.ruta_version()):
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode),
+                             firmas.PERMISOS)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('json'))
+            documento = leer_json(response)
+        self.assertEqual(documento['version'], version)
+        self.assertEqual(documento['clases'][0]['subredes_outside'],
+                         ['191.50.15.0/24'])
+
+    def test_descarga_binaria(self):
+        '''
+        Prueba descargar la base de firmas en el formato binario, pidiendola
+        por parametro o por el encabezado Accept.
+        '''
+        self.data["subredes_outside"] = "191.50.15.0/24"
+        self.data["puertos_inside"] = "443/tcp"
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        form.save()
+        version = firmas.leer_version()
+        assert os.path.exists(firmas.ruta_snapshot(version, firmas.BINARIO))
+        for parametros, encabezados in (
+                ({'formato': 'binario'}, {}),
+                ({}, {'HTTP_ACCEPT': binario.CONTENT_TYPE})):
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('json'), parametros,
+                                           **encabezados)
+                contenido = response.content
+            self.assertEqual(response['Content-Type'], binario.CONTENT_TYPE)
+            self.assertIn('Accept', response['Vary'])
+            self.assertEqual(response['ETag'], '"%s-bin"' % version)
+            documento = binario.leer(contenido)
+            self.assertEqual(documento['version'], version)
+            clase = documento['clases'][0]
+            self.assertEqual(clase['subredes_outside'],
+                             [(models.ip_a_entero('191.50.15.0'),
+                               0xffffff00)])
+            self.assertEqual(clase['puertos_inside'], [(443, 443, 6)])
+        # sin snapshot se genera desde la base de datos
+        os.unlink(firmas.ruta_snapshot(version, firmas.BINARIO))
+        cache.obtener_cache().clear()
+        response = self.client.get(reverse('json'), {'formato': 'binario'})
+        self.assertEqual(binario.leer(response.content)['version'], version)
+        # la descarga json sigue siendo la de siempre
+        response = self.client.get(reverse('json'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn('Accept', response['Vary'])
+
+    def test_descarga_comprimida(self):
+        '''
+        Prueba que la descarga se comprima segun el encabezado Accept-Encoding
+        sirviendo las variantes generadas al publicar.
+        '''
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        form.save()
+        version = firmas.leer_version()
+        for codificacion in firmas.COMPRESORES:
+            for formato in firmas.FORMATOS:
+                assert os.path.exists(
+                    firmas.ruta_snapshot(version, formato, codificacion))
+        descomprimir = {
+            'gzip': gzip.decompress,
+            'deflate': zlib.decompress,
+        }
+        for codificacion, funcion in descomprimir.items():
+            # las codificaciones preferidas se desactivan con q=0
+            preferidas = ", ".join("%s;q=0" % c for c in firmas.COMPRESORES
+                                   if c != codificacion)
+            encabezado = "%s, %s" % (codificacion, preferidas)
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('json'),
+                                           HTTP_ACCEPT_ENCODING=encabezado)
+                contenido = response.content
+            self.assertEqual(response['Content-Encoding'], codificacion)
+            self.assertEqual(int(response['Content-Length']), len(contenido))
+            self.assertIn('Accept-Encoding', response['Vary'])
+            self.assertEqual(response['ETag'],
+                             '"%s-%s"' % (version, codificacion))
+            documento = json.loads(funcion(contenido).decode())
+            self.assertEqual(documento['version'], version)
+        # sin Accept-Encoding se descarga sin comprimir
+        response = self.client.get(reverse('json'))
+        assert not response.has_header('Content-Encoding')
+        self.assertEqual(int(response['Content-Length']),
+                         os.path.getsize(firmas.ruta_snapshot(version)))
+        # el delta se comprime en el momento
+        response = self.client.get(reverse('json'), {'desde': version},
+                                   HTTP_ACCEPT_ENCODING='gzip;q=1, *;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        documento = json.loads(gzip.decompress(response.content).decode())
+        self.assertEqual(documento['clases'], [])
+
+    def test_descarga_continua(self):
+        '''
+        Prueba la descarga de a bloques desde el snapshot y, si no existe,
+        desde las clases publicadas leidas por lotes.
+        '''
+        for i in range(3):
+            data = dict(self.data, nombre='clase %d' % i,
+                        subredes_outside='10.%d.0.0/16' % i)
+            form = forms.ClaseForm(data)
+            assert form.is_valid()
+            form.save()
+        version = firmas.leer_version()
+        esperado = firmas.serializar(firmas.documento(version))
+        self.assertEqual([len(lote) for lote in firmas.lotes_publicados(
+            tamanio=2)], [2, 1])
+        self.assertEqual(b''.join(firmas.iterar_json(version)), esperado)
+
+        def descargar(**encabezados):
+            with self.settings(FIRMAS_STREAMING=True):
+                response = self.client.get(reverse('json'), **encabezados)
+            assert response.streaming
+            self.assertTrue(response['ETag'].startswith('"%s' % version))
+            return response, b''.join(response.streaming_content)
+
+        response, contenido = descargar()
+        self.assertEqual(contenido, esperado)
+        self.assertEqual(int(response['Content-Length']), len(esperado))
+        # sin snapshot se genera y se comprime a medida que se envia
+        for codificacion in (None, 'gzip'):
+            os.unlink(firmas.ruta_snapshot(version, firmas.JSON,
+                                           codificacion))
+        response, contenido = descargar()
+        self.assertEqual(contenido, esperado)
+        assert not response.has_header('Content-Length')
+        response, contenido = descargar(
+            HTTP_ACCEPT_ENCODING='gzip;q=1, *;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(contenido), esperado)
+
+    def test_limpiar_snapshots(self):
+        '''
+        Prueba que solo se conserven los archivos de las ultimas versiones.
+        '''
+        versiones = list()
+        for i in range(firmas.SNAPSHOTS_A_CONSERVAR + 2):
+            models.ClaseTrafico.objects.create(nombre='clase %d' % i)
+            versiones.append(firmas.publicar())
+        for i, version in enumerate(versiones):
+            conservada = i >= 2
+            for formato in firmas.FORMATOS:
+                self.assertEqual(
+                    os.path.exists(firmas.ruta_snapshot(version, formato)),
+                    conservada)
+                for codificacion in firmas.COMPRESORES:
+                    self.assertEqual(os.path.exists(firmas.ruta_snapshot(
+                        version, formato, codificacion)), conservada)
+
+    def test_get_condicional(self):
+        '''
+        Prueba que la descarga y la version respondan 304 sin consultar la base
+        de datos cuando el agente ya tiene la version publicada.
+        '''
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        form.save()
+        version = firmas.leer_version()
+        for nombre in ('json', 'version'):
+            response = self.client.get(reverse(nombre))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['ETag'], '"%s"' % version)
+            assert response.has_header('Last-Modified')
+            assert 'no-cache' in response['Cache-Control']
+            with self.assertNumQueries(0):
+                response = self.client.get(
+                    reverse(nombre), HTTP_IF_NONE_MATCH='"%s"' % version)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+            assert 'no-cache' in response['Cache-Control']
+            # con una version vieja se descarga todo
+            response = self.client.get(reverse(nombre),
+                                       HTTP_IF_NONE_MATCH='"vieja"')
+            self.assertEqual(response.status_code, 200)
+        # la version no tiene variantes comprimidas ni binarias
+        response = self.client.get(reverse('version'), {'formato': 'binario'},
+                                   HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH='"%s"' % version)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], '"%s"' % version)
+
+    def test_delta(self):
+        '''
+        Prueba descargar solo las clases que cambiaron desde una version.
+        '''
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        clase_a = form.save()
+        v1 = firmas.leer_version()
+        form = forms.ClaseForm(dict(self.data, nombre='otra'))
+        assert form.is_valid()
+        clase_b = form.save()
+        v2 = firmas.leer_version()
+        # desactivo la primera clase
+        form = forms.ClaseForm(dict(self.data, activa=False),
+                               instance=clase_a)
+        assert form.is_valid()
+        form.save()
+        v3 = firmas.leer_version()
+        # desde la primera version
+        response = self.client.get(reverse('json'), {'desde': v1})
+        documento = leer_json(response)
+        self.assertEqual(documento['version'], v3)
+        self.assertEqual(documento['desde'], v1)
+        self.assertEqual([c['id'] for c in documento['clases']],
+                         [clase_a.id, clase_b.id])
+        assert not documento['clases'][0]['activa']
+        # desde la segunda version
+        documento = leer_json(self.client.get(reverse('json'), {'desde': v2}))
+        self.assertEqual([c['id'] for c in documento['clases']], [clase_a.id])
+        # una version desconocida devuelve la base completa
+        documento = leer_json(self.client.get(reverse('json'),
+                                              {'desde': 'desconocida'}))
+        self.assertEqual(documento['version'], v3)
+        assert 'desde' not in documento
+        self.assertEqual(len(documento['clases']), 2)
+
+    def test_delta_version_repetida(self):
+        '''
+        Prueba que al volver al contenido de una version anterior el delta
+        desde versiones previas a ella siga incluyendo sus cambios.
+        '''
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        clase_a = form.save()
+        form = forms.ClaseForm(dict(self.data, nombre='otra'))
+        assert form.is_valid()
+        clase_b = form.save()
+        va = firmas.leer_version()
+        # X: modifico a
+        form = forms.ClaseForm(dict(self.data, descripcion='cambio'),
+                               instance=clase_a)
+        assert form.is_valid()
+        form.save()
+        vx = firmas.leer_version()
+        # B: modifico b
+        form = forms.ClaseForm(dict(self.data, nombre='otra',
+                                    descripcion='cambio'),
+                               instance=clase_b)
+        assert form.is_valid()
+        form.save()
+        vb = firmas.leer_version()
+        # deshago el cambio de b y vuelvo a X
+        form = forms.ClaseForm(dict(self.data, nombre='otra'),
+                               instance=clase_b)
+        assert form.is_valid()
+        form.save()
+        self.assertEqual(firmas.leer_version(), vx)
+        delta = firmas.obtener_delta(va)
+        self.assertEqual(delta['version'], vx)
+        self.assertEqual([c['id'] for c in delta['clases']],
+                         [clase_a.id, clase_b.id])
+        self.assertEqual(delta['clases'][0]['descripcion'], 'cambio')
+        self.assertEqual([c['id'] for c in firmas.obtener_delta(vb)['clases']],
+                         [clase_a.id, clase_b.id])
+
+    def test_delta_sin_cambios_registrados(self):
+        '''
+        Prueba que se devuelva la base completa si una version posterior no
+        tiene cambios registrados o si la version pedida es muy vieja.
+        '''
+        form = forms.ClaseForm(self.data)
+        assert form.is_valid()
+        form.save()
+        v1 = firmas.leer_version()
+        # una clase creada sin el formulario se publica con el comando
+        models.ClaseTrafico.objects.create(nombre='otra')
+        call_command('publicar_firmas', stdout=open(os.devnull, 'w'))
+        assert firmas.obtener_delta(v1) is None
+        v2 = firmas.leer_version()
+        assert firmas.obtener_delta(v2) is not None
+        for i in range(firmas.DELTA_MAX_VERSIONES + 1):
+            firmas.registrar_version('v%d' % i, clases=[])
+        assert firmas.obtener_delta(v2) is None
+
+    def test_publicar_firmas(self):
+        '''
+        Prueba el comando que publica una nueva version de la base de firmas.
+        '''
+        models.ClaseTrafico.objects.create(nombre='foo', descripcion='bar')
+        call_command('publicar_firmas', stdout=open(os.devnull, 'w'))
+        version = firmas.leer_version()
+        assert version
+        with open(firmas.ruta_snapshot(version)) as f:
+            documento = json.load(f)
+        self.assertEqual(documento['clases'][0]['nombre'], 'foo')
+
+
+class TestBinario(TestCase):
+
+    def setUp(self):
+        '''
+        Inicializa datos.
+        '''
+        self.clases = [
+            {
+                'id': 7,
+                'nombre': 'ñandú',
+                'descripcion': 'descripción',
+                'activa': True,
+                'subredes_outside': ['10.0.0.0/8', '2001:db8::/32',
+                                     '0.0.0.0/0', '192.168.1.1/32',
+                                     '::1/128'],
+                'subredes_inside': [],
+                'puertos_outside': ['53/udp', '22', '443/tcp',
+                                    '49152-65535/udp'],
+                'puertos_inside': ['8080/tcp'],
+            },
+            {
+                'id': 3,
+                'nombre': 'foo',
+                'descripcion': '',
+                'activa': False,
+                'subredes_outside': [],
+                'subredes_inside': ['172.16.0.0/12'],
+                'puertos_outside': [],
+                'puertos_inside': [],
+            },
+        ]
+
+    def test_ida_y_vuelta(self):
+        '''
+        Prueba que leer un documento escrito devuelva las mismas clases, con
+        las redes y puertos ordenados.
+        '''
+        documento = binario.leer(binario.escribir('abc123', self.clases))
+        self.assertEqual(documento['version'], 'abc123')
+        self.assertEqual([c['id'] for c in documento['clases']], [3, 7])
+        clase = documento['clases'][1]
+        self.assertEqual(clase['nombre'], 'ñandú')
+        self.assertEqual(clase['descripcion'], 'descripción')
+        assert clase['activa']
+        assert not documento['clases'][0]['activa']
+        self.assertEqual(clase['subredes_outside'], [
+            (0, 0),
+            (models.ip_a_entero('10.0.0.0'), 0xff000000),
+            (models.ip_a_entero('192.168.1.1'), 0xffffffff),
+        ])
+        self.assertEqual(clase['subredes_ipv6_outside'], [
+            (1, 2 ** 128 - 1),
+            (0x20010db8 << 96, (2 ** 32 - 1) << 96),
+        ])
+        self.assertEqual(clase['subredes_inside'], [])
+        self.assertEqual(clase['subredes_ipv6_inside'], [])
+        self.assertEqual(clase['puertos_outside'],
+                         [(22, 22, 0), (53, 53, 17), (443, 443, 6),
+                          (49152, 65535, 17)])
+        self.assertEqual(clase['puertos_inside'], [(8080, 8080, 6)])
+        self.assertEqual(documento['clases'][0]['subredes_inside'],
+                         [(models.ip_a_entero('172.16.0.0'), 0xfff00000)])
+
+    def test_tamanio(self):
+        '''
+        Prueba que el formato binario sea mas chico que el json.
+        '''
+        clases = [dict(self.clases[0], id=i) for i in range(100)]
+        tamanio_json = len(json.dumps({'version': 'abc123',
+                                       'clases': clases}).encode())
+        self.assertLess(len(binario.escribir('abc123', clases)),
+                        tamanio_json / 2)
+
+    def test_errores(self):
+        '''
+        Prueba que se rechacen documentos corruptos o de otro formato.
+        '''
+        datos = binario.escribir('abc123', self.clases)
+        corrupto = bytearray(datos)
+        corrupto[-1] ^= 0xff
+        for invalido in (datos[:10], datos[:-1], bytes(corrupto),
+                         b'XXXX' + datos[4:]):
+            with self.assertRaises(binario.ErrorFormato):
+                binario.leer(invalido)
+
+
+class TestParseo(TestCase):
+
+    def test_subredes(self):
+        '''
+        Prueba que las subredes se conviertan en arrays de enteros con la
+        direccion de red, ignorando las lineas en blanco.
+        '''
+        lista = parseo.subredes("10.0.0.1/8\n\n  192.168.1.7  \r\n"
+                                "010.001.000.000/16\n172.16.0.0/012")
+        self.assertEqual(lista.cantidad_errores, 0)
+        self.assertEqual(list(lista), [
+            (models.ip_a_entero('10.0.0.0'), 8),
+            (models.ip_a_entero('192.168.1.7'), 32),
+            # los ceros a la izquierda se aceptan como decimales
+            (models.ip_a_entero('10.1.0.0'), 16),
+            (models.ip_a_entero('172.16.0.0'), 12),
+        ])
+        self.assertEqual(lista.bajos.typecode, 'Q')
+        self.assertEqual(len(lista), 4)
+
+    def test_subredes_ipv6(self):
+        '''
+        Prueba parsear subredes IPv6 junto con IPv4.
+        '''
+        lista = parseo.subredes("2001:DB8::1/32\n10.0.0.0/8\n::1\n"
+                                "::ffff:10.0.0.0/104\n::/0\n"
+                                "2001:db8::/129\n2001:db8:::1\n1::2::3")
+        self.assertEqual(list(lista), [
+            (models.ip_a_entero('2001:db8::'), 32),
+            (models.ip_a_entero('10.0.0.0'), 8),
+            (models.IPV6 + 1, 128),
+            (models.ip_a_entero('::ffff:10.0.0.0'), 104),
+            (models.IPV6, 0),
+        ])
+        with self.assertRaises(ValidationError) as contexto:
+            lista.validar()
+        self.assertEqual(contexto.exception.messages, [
+            'linea 6: 2001:db8::: El prefijo debe ser entre 0 y 128',
+            'linea 7: 2001:db8:::1: Error de sintaxis',
+            'linea 8: 1::2::3: Error de sintaxis',
+        ])
+        self.assertEqual(parseo.parsear_cidr('2001:0db8:0:0::7/64'),
+                         ('2001:db8::', 64))
+
+    def test_puertos(self):
+        '''
+        Prueba que los puertos se conviertan en arrays de enteros.
+        '''
+        lista = parseo.puertos("80\n443/tcp\n 53/UDP \n1000 - 2000/tcp\n"
+                               "49152-65535")
+        self.assertEqual(lista.cantidad_errores, 0)
+        self.assertEqual(list(lista), [(80, 80, 0), (443, 443, 6),
+                                       (53, 53, 17), (1000, 2000, 6),
+                                       (49152, 65535, 0)])
+
+    def test_errores(self):
+        '''
+        Prueba que se informen todos los errores con su numero de linea.
+        '''
+        lista = parseo.subredes("1.2.3.4\n1.2.3.400\n\nbasura\n"
+                                "1.2.3.0/33")
+        self.assertEqual(list(lista), [(models.ip_a_entero('1.2.3.4'), 32)])
+        with self.assertRaises(ValidationError) as contexto:
+            lista.validar()
+        self.assertEqual(contexto.exception.messages, [
+            'linea 2: 1.2.3.400: Error de sintaxis',
+            'linea 4: basura: Error de sintaxis',
+            'linea 5: 1.2.3.0: El prefijo debe ser entre 0 y 32',
+        ])
+        lista = parseo.puertos("0\n70000/tcp\n90-80\n80/icmp")
+        self.assertEqual(lista.cantidad_errores, 4)
+        # una barra sin prefijo o sin protocolo es un error de sintaxis
+        lista = parseo.subredes("1.2.3.4/\n::/")
+        self.assertEqual(lista.errores, [
+            'linea 1: 1.2.3.4/: Error de sintaxis',
+            'linea 2: ::/: Error de sintaxis',
+        ])
+        lista = parseo.puertos("80/")
+        self.assertEqual(lista.errores, ['linea 1: 80/: Error de sintaxis'])
+        with mock.patch.object(parseo, 'MAX_ERRORES', 2):
+            lista = parseo.puertos("a\nb\nc\nd\n22")
+            with self.assertRaises(ValidationError) as contexto:
+                lista.validar()
+        self.assertEqual(contexto.exception.messages, [
+            'linea 1: a: Error de sintaxis', 'linea 2: b: Error de sintaxis',
+            'y 2 errores mas'])
+
+    def test_formulario(self):
+        '''
+        Prueba que el formulario informe todos los errores de cada lista.
+        '''
+        form = forms.ClaseForm({'nombre': 'foo', 'descripcion': 'bar',
+                                'activa': True,
+                                'subredes_outside': "1.1.1.1\nx\ny",
+                                'puertos_inside': "22\n0"})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['subredes_outside'],
+                         ['linea 2: x: Error de sintaxis',
+                          'linea 3: y: Error de sintaxis'])
+        self.assertEqual(len(form.errors['puertos_inside']), 1)
+
+
+class TestNormalizacion(MediaTemporalMixin, TestCase):
+
+    def test_colapsar_redes(self):
+        '''
+        Prueba colapsar redes contra ipaddress.collapse_addresses.
+        '''
+        random.seed(3)
+        for i in range(50):
+            redes = [ipaddress.IPv4Network((random.getrandbits(32) &
+                                            random.choice((0xff000000,
+                                                           0xffff0000,
+                                                           0xffffff80)),
+                                            random.randint(6, 32)),
+                                           strict=False)
+                     for j in range(random.randint(1, 40))]
+            esperado = [(int(red.network_address), red.prefixlen)
+                        for red in ipaddress.collapse_addresses(redes)]
+            obtenido = normalizacion.colapsar_redes(
+                (int(red.network_address), red.prefixlen) for red in redes)
+            self.assertEqual(obtenido, esperado)
+        self.assertEqual(normalizacion.colapsar_redes([(0, 0), (0, 1)]),
+                         [(0, 0)])
+        # las redes IPv6 se colapsan sin mezclarse con las IPv4
+        redes = [ipaddress.ip_network(red) for red in (
+            '::/1', '8000::/1', '2001:db8::/33', '2001:db8:8000::/33',
+            '2001:db8::1/128', '0.0.0.0/1', '128.0.0.0/1')]
+        self.assertEqual(
+            normalizacion.colapsar_redes(
+                (models.ip_a_entero(str(red.network_address)), red.prefixlen)
+                for red in redes),
+            [(0, 0), (models.IPV6, 0)])
+        redes = [ipaddress.IPv6Network(('2001:db8::%x' % i, 128))
+                 for i in range(256)]
+        self.assertEqual(
+            normalizacion.colapsar_redes(
+                (models.ip_a_entero(str(red.network_address)), red.prefixlen)
+                for red in redes),
+            [(models.ip_a_entero('2001:db8::'), 120)])
+        self.assertEqual(normalizacion.colapsar_redes([]), [])
+
+    def test_normalizar_clase(self):
+        '''
+        Prueba normalizar las subredes y puertos de una clase.
+        '''
+        clase = {
+            'id': 1,
+            'subredes_outside': ['10.0.0.0/8', '10.200.0.0/16',
+                                 '192.168.1.0/25', '192.168.1.128/25'],
+            'subredes_inside': ['172.16.0.1/32'],
+            'puertos_outside': ['53', '53/udp', '443/tcp', '443/tcp'],
+            'puertos_inside': ['1000-2000/tcp', '2001-3000/tcp', '1500/udp',
+                               '10-20', '15/tcp', '5-30/udp'],
+        }
+        resumen = normalizacion.Resumen()
+        normalizada = normalizacion.normalizar_clase(clase, resumen)
+        self.assertEqual(normalizada['subredes_outside'],
+                         ['10.0.0.0/8', '192.168.1.0/24'])
+        self.assertEqual(normalizada['subredes_inside'], ['172.16.0.1/32'])
+        self.assertEqual(normalizada['puertos_outside'], ['53', '443/tcp'])
+        self.assertEqual(normalizada['puertos_inside'],
+                         ['5-30/udp', '10-20', '1000-3000/tcp', '1500/udp'])
+        self.assertEqual(resumen.como_dict(),
+                         {'subredes_eliminadas': 2, 'puertos_eliminados': 4})
+        # la clase original no se modifica
+        self.assertEqual(len(clase['subredes_outside']), 4)
+
+    def test_descarga_normalizada(self):
+        '''
+        Prueba la descarga normalizada a partir del snapshot publicado.
+        '''
+        form = forms.ClaseForm({
+            'nombre': 'foo',
+            'descripcion': 'bar',
+            'activa': True,
+            'subredes_outside': "10.0.0.0/8\n10.200.0.0/16",
+        })
+        assert form.is_valid()
+        form.save()
+        version = firmas.leer_version()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('json'), {'normalizar': 1})
+        documento = leer_json(response)
+        self.assertEqual(documento['clases'][0]['subredes_outside'],
+                         ['10.0.0.0/8'])
+        self.assertEqual(documento['normalizacion']['subredes_eliminadas'], 1)
+        self.assertEqual(response['X-Subredes-Eliminadas'], '1')
+        self.assertEqual(response['ETag'], '"%s-normalizado"' % version)
+        response = self.client.get(reverse('json'),
+                                   {'normalizar': 1, 'formato': 'binario'})
+        clase = binario.leer(response.content)['clases'][0]
+        self.assertEqual(clase['subredes_outside'],
+                         [(models.ip_a_entero('10.0.0.0'), 0xff000000)])
+        # exportacion normalizada
+        salida = io.StringIO()
+        resumen = normalizacion.Resumen()
+        lotes.exportar(salida, lotes.JSONL, resumen)
+        clase = json.loads(salida.getvalue())
+        self.assertEqual(clase['subredes_outside'], ['10.0.0.0/8'])
+        self.assertEqual(resumen.subredes, 1)
+
+
+class TestCache(MediaTemporalMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.reiniciar_estadisticas()
+        self.calculos = list()
+
+    def calcular(self, valor):
+        def calcular():
+            self.calculos.append(valor)
+            return valor
+        return calcular
+
+    def test_obtener(self):
+        '''
+        Prueba que el valor se calcule una vez por version.
+        '''
+        self.assertEqual(cache.obtener('x', 'v1', self.calcular('a')),
+                         ('v1', 'a'))
+        self.assertEqual(cache.obtener('x', 'v1', self.calcular('b')),
+                         ('v1', 'a'))
+        self.assertEqual(cache.obtener('x', 'v2', self.calcular('c')),
+                         ('v2', 'c'))
+        self.assertEqual(self.calculos, ['a', 'c'])
+        self.assertEqual(cache.estadisticas(),
+                         {'x': {cache.ACIERTOS: 1, cache.FALLOS: 2}})
+
+    def test_estampida(self):
+        '''
+        Prueba que mientras otro proceso recalcula se devuelva el valor de la
+        version anterior o se espere el nuevo si no hay uno anterior.
+        '''
+        cache.obtener('x', 'v1', self.calcular('a'))
+        # otro proceso tiene el lock
+        cache.obtener_cache().add('x:lock', True)
+        self.assertEqual(cache.obtener('x', 'v2', self.calcular('b')),
+                         ('v1', 'a'))
+        self.assertEqual(self.calculos, ['a'])
+        self.assertEqual(cache.estadisticas()['x'][cache.ANTERIORES], 1)
+        # sin valor anterior se espera al otro proceso y, si no termina, se
+        # calcula
+        with mock.patch.object(cache, 'ESPERA_MAXIMA', 0.1):
+            self.assertEqual(cache.obtener('y', 'v1', self.calcular('c')),
+                             ('v1', 'c'))
+        cache.obtener_cache().add('y:lock', True)
+        cache.guardar('y', 'v2', 'd')
+        self.assertEqual(cache.obtener('y', 'v2', self.calcular('e')),
+                         ('v2', 'd'))
+
+    def test_descarga(self):
+        '''
+        Prueba que la version y la descarga se sirvan desde la cache y que
+        guardar una clase publique la nueva version en la cache.
+        '''
+        data = {'nombre': 'foo', 'descripcion': 'bar', 'activa': True}
+        form = forms.ClaseForm(data)
+        assert form.is_valid()
+        clase = form.save()
+        version = firmas.leer_version()
+        documento = leer_json(self.client.get(reverse('json')))
+        self.assertEqual(documento['version'], version)
+        # los archivos no se vuelven a leer
+        shutil.rmtree(os.path.dirname(firmas.ruta_snapshot(version)))
+        with self.assertNumQueries(0):
+            documento = leer_json(self.client.get(reverse('json')))
+        self.assertEqual(documento['version'], version)
+        estadisticas = cache.estadisticas()
+        self.assertEqual(estadisticas['descarga'],
+                         {cache.ACIERTOS: 1, cache.FALLOS: 1})
+        assert estadisticas['version'][cache.ACIERTOS] > 0
+        # al guardar se invalida la version
+        form = forms.ClaseForm(dict(data, nombre='otro'), instance=clase)
+        assert form.is_valid()
+        form.save()
+        nueva = leer_json(self.client.get(reverse('version')))['version']
+        self.assertNotEqual(nueva, version)
+        documento = leer_json(self.client.get(reverse('json')))
+        self.assertEqual(documento['version'], nueva)
+        self.assertEqual(documento['clases'][0]['nombre'], 'otro')
+
+
+class TestNotificaciones(MediaTemporalMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        form = forms.ClaseForm({'nombre': 'foo', 'descripcion': 'bar',
+                                'activa': True})
+        assert form.is_valid()
+        form.save()
+        self.version = firmas.leer_version()
+        notificaciones.revisar_base()
+
+    def publicar_despues(self, segundos, version, notificar=True):
+        '''
+        Escribe una nueva version en otro hilo, sin usar la base de datos,
+        como lo haria otro proceso.
+        '''
+        def publicar():
+            time.sleep(segundos)
+            firmas.escribir_archivo(firmas.ruta_version(),
+                                    version.encode('ascii'))
+            if notificar:
+                firmas.version_publicada.send(sender=None, version=version)
+        hilo = threading.Thread(target=publicar)
+        hilo.start()
+        self.addCleanup(hilo.join)
+
+    def test_esperar_timeout(self):
+        '''
+        Prueba que sin cambios se responda la misma version al terminar el
+        timeout, y que con otra version se responda sin esperar.
+        '''
+        inicio = time.monotonic()
+        # solo se consulta la version vigente una vez por INTERVALO
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('version'),
+                                       {'esperar': self.version,
+                                        'timeout': '0.3'})
+        self.assertGreaterEqual(time.monotonic() - inicio, 0.3)
+        self.assertEqual(leer_json(response)['version'], self.version)
+        inicio = time.monotonic()
+        response = self.client.get(reverse('version'),
+                                   {'esperar': 'vieja', 'timeout': '10'})
+        self.assertLess(time.monotonic() - inicio, 1)
+        self.assertEqual(leer_json(response)['version'], self.version)
+
+    def test_esperar_cambio(self):
+        '''
+        Prueba que el pedido responda en cuanto se publica una nueva version,
+        en este proceso o en otro.
+        '''
+        for nueva, notificar in (('a' * 64, True), ('b' * 64, False)):
+            actual = firmas.leer_version()
+            self.publicar_despues(0.2, nueva, notificar)
+            inicio = time.monotonic()
+            with mock.patch.object(notificaciones, 'INTERVALO', 0.05):
+                response = self.client.get(
+                    reverse('version'), {'esperar': actual, 'timeout': '10'},
+                    HTTP_IF_NONE_MATCH='"%s"' % actual)
+            self.assertLess(time.monotonic() - inicio, 5)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(leer_json(response)['version'], nueva)
+            self.assertEqual(firmas.leer_version(), nueva)
+
+    def test_esperar_cambio_en_base(self):
+        '''
+        Prueba que la espera termine cuando otro servidor registra una version
+        en la base de datos sin escribir el archivo de version de este.
+        '''
+        models.ClaseTrafico.objects.create(nombre='otra')
+        nueva = firmas.registrar_cambios()
+        self.assertEqual(notificaciones.estado_actual(revisar=False)[0],
+                         self.version)
+        inicio = time.monotonic()
+        with mock.patch.object(notificaciones, 'INTERVALO', 0.05):
+            response = self.client.get(
+                reverse('version'), {'esperar': self.version,
+                                     'timeout': '10'})
+        self.assertLess(time.monotonic() - inicio, 5)
+        self.assertEqual(leer_json(response)['version'], nueva)
+        assert os.path.exists(firmas.ruta_snapshot(nueva))
+        with mock.patch.object(views.VersionEventos, 'DURACION_MAXIMA', 0.2):
+            response = self.client.get(reverse('version_eventos'),
+                                       HTTP_LAST_EVENT_ID=self.version)
+            eventos = b''.join(response.streaming_content).decode()
+        self.assertIn('id: %s\n' % nueva, eventos)
+
+    def test_eventos(self):
+        '''
+        Prueba el stream de Server-Sent Events.
+        '''
+        self.publicar_despues(0.2, 'a' * 64)
+        with mock.patch.object(views.VersionEventos, 'DURACION_MAXIMA', 0.6), \
+                mock.patch.object(views.VersionEventos, 'INTERVALO_PING', 0.1):
+            response = self.client.get(reverse('version_eventos'))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            eventos = b''.join(response.streaming_content).decode()
+        self.assertEqual(eventos.count('event: version'), 2)
+        self.assertIn('id: %s\nevent: version\ndata: {"version": "%s"}\n\n'
+                      % (self.version, self.version), eventos)
+        self.assertIn('id: %s\n' % ('a' * 64), eventos)
+        self.assertIn(': ping\n\n', eventos)
+        # al reconectarse con la ultima version no se repite el evento
+        with mock.patch.object(views.VersionEventos, 'DURACION_MAXIMA', 0.2):
+            response = self.client.get(reverse('version_eventos'),
+                                       HTTP_LAST_EVENT_ID='a' * 64)
+            eventos = b''.join(response.streaming_content).decode()
+        self.assertNotIn('event: version', eventos)
+
+
+# la version vigente se consulta en el pool de hilos, que solo ve los datos
+# confirmados
+class TestAsincronico(MediaTemporalMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        form = forms.ClaseForm({'nombre': 'foo', 'descripcion': 'bar',
+                                'activa': True})
+        assert form.is_valid()
+        form.save()
+        self.version = firmas.leer_version()
+        self.wsgi = mock.Mock(side_effect=self.responder_wsgi)
+        self.aplicacion = asincronico.Aplicacion(self.wsgi)
+        self.addCleanup(self.aplicacion.hilos.shutdown)
+        metricas.reiniciar()
+        self.addCleanup(metricas.reiniciar)
+
+    def responder_wsgi(self, entorno, start_response):
+        start_response('418 I\'m a teapot', [('Content-Type', 'text/plain')])
+        return [b'wsgi ', entorno['PATH_INFO'].encode()]
+
+    def pedir(self, path, query='', metodo='GET', headers=(), cuerpo=b''):
+        '''
+        Ejecuta un pedido en la aplicacion ASGI y devuelve la tupla
+        (estado, encabezados, cuerpo).
+        '''
+        scope = {'type': 'http', 'method': metodo, 'path': path,
+                 'query_string': query.encode(),
+                 'headers': [(nombre.lower().encode(), valor.encode())
+                             for nombre, valor in headers]}
+        mensajes = list()
+        recibidos = [{'type': 'http.request', 'body': cuerpo}]
+
+        async def receive():
+            if recibidos:
+                return recibidos.pop()
+            # el cliente sigue conectado
+            await asyncio.sleep(3600)
+
+        async def send(mensaje):
+            mensajes.append(mensaje)
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.mensajes = mensajes
+        loop.run_until_complete(self.aplicacion(scope, receive, send))
+        inicio = mensajes[0]
+        encabezados = {nombre.decode(): valor.decode()
+                       for nombre, valor in inicio['headers']}
+        contenido = b''.join(mensaje['body'] for mensaje in mensajes[1:])
+        return inicio['status'], encabezados, contenido
+
+    def test_version(self):
+        '''
+        Prueba /version/ sin base de datos, con ETag y espera.
+        '''
+        with self.assertNumQueries(0):
+            estado, encabezados, contenido = self.pedir('/version/')
+        self.assertEqual(estado, 200)
+        self.assertEqual(json.loads(contenido.decode()),
+                         {'version': self.version})
+        self.assertEqual(encabezados['etag'], '"%s"' % self.version)
+        self.assertIn('last-modified', encabezados)
+        _, encabezados, _ = self.pedir(
+            '/version/', headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual(encabezados['etag'], '"%s"' % self.version)
+        estado, _, contenido = self.pedir(
+            '/version/', headers=[('If-None-Match', '"%s"' % self.version)])
+        self.assertEqual((estado, contenido), (304, b''))
+        self.assertIn('netcop_http_pedidos_total'
+                      '{estado="304",metodo="GET",vista="version"} 1.0',
+                      metricas.exportar())
+        inicio = time.monotonic()
+        estado, _, contenido = self.pedir(
+            '/version/', 'esperar=%s&timeout=0.3' % self.version)
+        self.assertGreaterEqual(time.monotonic() - inicio, 0.3)
+        self.assertEqual(json.loads(contenido.decode()),
+                         {'version': self.version})
+
+    def test_version_esperar_cambio(self):
+        '''
+        Prueba que la espera termine al publicarse otra version en otro
+        proceso.
+        '''
+        nueva = 'a' * 64
+
+        def publicar():
+            time.sleep(0.2)
+            firmas.escribir_archivo(firmas.ruta_version(), nueva.encode())
+        hilo = threading.Thread(target=publicar)
+        hilo.start()
+        self.addCleanup(hilo.join)
+        inicio = time.monotonic()
+        with mock.patch.object(notificaciones, 'INTERVALO', 0.05):
+            _, _, contenido = self.pedir(
+                '/version/', 'esperar=%s&timeout=10' % self.version)
+        self.assertLess(time.monotonic() - inicio, 5)
+        self.assertEqual(json.loads(contenido.decode()), {'version': nueva})
+
+    def test_version_desde_base_de_datos(self):
+        '''
+        Prueba que se publique la version que otro servidor registra en la
+        base de datos sin escribir el archivo de version de este.
+        '''
+        models.ClaseTrafico.objects.create(nombre='otra')
+        nueva = firmas.registrar_cambios()
+        estado, _, contenido = self.pedir('/version/')
+        self.assertEqual(json.loads(contenido.decode()), {'version': nueva})
+        estado, _, contenido = self.pedir('/descarga/')
+        self.assertEqual(estado, 200)
+        self.assertEqual(json.loads(contenido.decode()),
+                         firmas.documento(nueva))
+        self.wsgi.assert_not_called()
+        # las siguientes consultas esperan a que venza TTL_VERSION
+        otra = models.ClaseTrafico.objects.create(nombre='ultima')
+        firmas.registrar_cambios([otra.id])
+        _, _, contenido = self.pedir('/version/')
+        self.assertEqual(json.loads(contenido.decode()), {'version': nueva})
+
+    def test_descarga(self):
+        '''
+        Prueba que la descarga se sirva desde el snapshot, igual que en la
+        vista de Django, sin consultar la base de datos.
+        '''
+        esperado = self.client.get(reverse('json'),
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        with self.assertNumQueries(0):
+            estado, encabezados, contenido = self.pedir(
+                '/descarga/', headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual(estado, 200)
+        self.assertEqual(contenido, esperado.content)
+        self.assertEqual(encabezados['content-encoding'], 'gzip')
+        self.assertEqual(encabezados['etag'], esperado['ETag'])
+        self.assertEqual(encabezados['content-length'], str(len(contenido)))
+        estado, encabezados, contenido = self.pedir('/descarga/',
+                                                    'formato=binario')
+        self.assertEqual(encabezados['content-type'], binario.CONTENT_TYPE)
+        self.assertEqual(binario.leer(contenido)['version'], self.version)
+        estado, _, contenido = self.pedir(
+            '/descarga/', 'formato=binario', 'HEAD',
+            headers=[('If-None-Match', encabezados['etag'])])
+        self.assertEqual((estado, contenido), (304, b''))
+        self.wsgi.assert_not_called()
+
+    def test_delegar(self):
+        '''
+        Prueba que los demas pedidos se atiendan con la aplicacion WSGI.
+        '''
+        for path, query, metodo in (('/', '', 'GET'),
+                                    ('/clasificar/', '', 'POST'),
+                                    ('/descarga/', 'desde=abc', 'GET'),
+                                    ('/descarga/', 'normalizar=1', 'GET'),
+                                    ('/no/existe/', '', 'GET')):
+            estado, encabezados, contenido = self.pedir(
+                path, query, metodo, [('Content-Type', 'application/json')],
+                b'{}')
+            self.assertEqual(estado, 418)
+            self.assertEqual(contenido, b'wsgi ' + path.encode())
+            entorno = self.wsgi.call_args[0][0]
+            self.assertEqual(entorno['REQUEST_METHOD'], metodo)
+            self.assertEqual(entorno['QUERY_STRING'], query)
+            self.assertEqual(entorno['CONTENT_TYPE'], 'application/json')
+            self.assertEqual(entorno['wsgi.input'].read(), b'{}')
+        # los pedidos delegados los registra el middleware de la aplicacion
+        self.assertNotIn('vista="json"', metricas.exportar())
+
+    def test_delegar_por_bloques(self):
+        '''
+        Prueba que el cuerpo de una respuesta WSGI se envie de a bloques.
+        '''
+        def bloques():
+            for i in range(3):
+                # al generar cada bloque ya se enviaron los anteriores salvo
+                # el ultimo, que espera para saber si hay mas
+                self.assertEqual(len(self.mensajes), i)
+                yield b'bloque %d ' % i
+
+        def responder(entorno, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return bloques()
+
+        self.wsgi.side_effect = responder
+        estado, encabezados, contenido = self.pedir('/')
+        self.assertEqual(estado, 200)
+        self.assertEqual(contenido, b'bloque 0 bloque 1 bloque 2 ')
+        self.assertEqual([m.get('more_body', False)
+                          for m in self.mensajes[1:]], [True, True, False])
+
+    def test_eventos(self):
+        '''
+        Prueba el stream de Server-Sent Events.
+        '''
+        with mock.patch.object(views.VersionEventos, 'DURACION_MAXIMA', 0.3):
+            estado, encabezados, contenido = self.pedir('/version/eventos/')
+        self.assertEqual(encabezados['content-type'], 'text/event-stream')
+        eventos = contenido.decode()
+        self.assertTrue(eventos.startswith('retry: '))
+        self.assertIn('id: %s\nevent: version\n' % self.version, eventos)
+        with mock.patch.object(views.VersionEventos, 'DURACION_MAXIMA', 0.2):
+            _, _, contenido = self.pedir(
+                '/version/eventos/', headers=[('Last-Event-ID', self.version)])
+        self.assertNotIn('event: version', contenido.decode())
+
+
+class TestCIDR(TestCase):
+
+    def setUp(self):
+        '''
+        Inicializa datos.
+        '''
+        self.redes = {
+            str(red): red for red in (
+                models.CIDR.objects.create(direccion='0.0.0.0', prefijo=0),
+                models.CIDR.objects.create(direccion='10.0.0.1', prefijo=8),
+                models.CIDR.objects.create(direccion='10.200.0.0',
+                                           prefijo=16),
+                models.CIDR.objects.create(direccion='10.200.1.0',
+                                           prefijo=24),
+                models.CIDR.objects.create(direccion='192.168.0.0',
+                                           prefijo=16),
+                models.CIDR.objects.create(direccion='192.168.1.1',
+                                           prefijo=32),
+            )
+        }
+
+    def test_rango(self):
+        '''
+        Prueba que al guardar se calcule el rango de la red.
+        '''
+        red = self.redes['10.0.0.0/8']
+        self.assertEqual(red.inicio, 10 << 24)
+        self.assertEqual(red.fin, (11 << 24) - 1)
+        red = self.redes['0.0.0.0/0']
+        self.assertEqual((red.inicio, red.fin), (0, 2 ** 32 - 1))
+
+    def test_contienen(self):
+        '''
+        Prueba buscar las redes que contienen una direccion.
+        '''
+        def contienen(direccion):
+            return sorted(str(red) for red in
+                          models.CIDR.objects.contienen(direccion))
+
+        self.assertEqual(contienen('10.200.1.7'),
+                         ['0.0.0.0/0', '10.0.0.0/8', '10.200.0.0/16',
+                          '10.200.1.0/24'])
+        self.assertEqual(contienen('192.168.1.1'),
+                         ['0.0.0.0/0', '192.168.0.0/16', '192.168.1.1/32'])
+        self.assertEqual(contienen('8.8.8.8'), ['0.0.0.0/0'])
+
+    def test_solapan(self):
+        '''
+        Prueba buscar las redes que se superponen con una red.
+        '''
+        def solapan(direccion, prefijo):
+            return sorted(str(red) for red in
+                          models.CIDR.objects.solapan(direccion, prefijo))
+
+        self.assertEqual(solapan('10.200.0.0', 15),
+                         ['0.0.0.0/0', '10.0.0.0/8', '10.200.0.0/16',
+                          '10.200.1.0/24'])
+        self.assertEqual(solapan('192.168.1.0', 24),
+                         ['0.0.0.0/0', '192.168.0.0/16', '192.168.1.1/32'])
+        self.assertEqual(solapan('0.0.0.0', 0), sorted(self.redes))
+
+    def test_ipv6(self):
+        '''
+        Prueba guardar y buscar redes IPv6, que no se mezclan con las IPv4.
+        '''
+        for direccion, prefijo in (('::', 0), ('2001:db8::1', 32),
+                                   ('2001:db8:1::', 48), ('::1', 128),
+                                   ('::ffff:10.0.0.0', 104)):
+            models.CIDR.objects.create(direccion=direccion, prefijo=prefijo)
+        red = models.CIDR.objects.get(prefijo=32, direccion='2001:db8::')
+        self.assertEqual(red.inicio, models.IPV6 + (0x20010db8 << 96))
+        self.assertEqual(red.fin, red.inicio + 2 ** 96 - 1)
+
+        def contienen(direccion):
+            return sorted(str(red) for red in
+                          models.CIDR.objects.contienen(direccion))
+
+        def solapan(direccion, prefijo=None):
+            return sorted(str(red) for red in
+                          models.CIDR.objects.solapan(direccion, prefijo))
+
+        self.assertEqual(contienen('2001:db8:1::7'),
+                         ['2001:db8:1::/48', '2001:db8::/32', '::/0'])
+        self.assertEqual(contienen('::ffff:10.1.2.3'),
+                         ['::/0', '::ffff:10.0.0.0/104'])
+        self.assertEqual(contienen('10.1.2.3'),
+                         ['0.0.0.0/0', '10.0.0.0/8'])
+        self.assertEqual(solapan('2001:db8::', 31),
+                         ['2001:db8:1::/48', '2001:db8::/32', '::/0'])
+        self.assertEqual(solapan('::1'), ['::/0', '::1/128'])
+        self.assertEqual(len(solapan('::', 0)), 5)
+        self.assertEqual(solapan('0.0.0.0', 0), sorted(self.redes))
+        # las IPv4 ordenan antes que las IPv6 en el indice
+        self.assertEqual(
+            [str(red) for red in models.CIDR.objects.order_by('inicio')][-5:],
+            ['::/0', '::1/128', '::ffff:10.0.0.0/104', '2001:db8::/32',
+             '2001:db8:1::/48'])
+
+
+class TestLotes(MediaTemporalMixin, TestCase):
+
+    def setUp(self):
+        '''
+        Inicializa datos.
+        '''
+        super().setUp()
+        self.lineas = [
+            {
+                'nombre': 'foo',
+                'descripcion': 'bar',
+                'subredes_outside': ['10.0.0.1/8', '191.50.15.0/24'],
+                'puertos_outside': ['80/tcp', '53/udp'],
+            },
+            {
+                'nombre': 'baz',
+                'activa': False,
+                'subredes_inside': ['192.168.0.0/16'],
+                'puertos_inside': ['22'],
+            },
+            {
+                'nombre': 'foo',
+                'subredes_outside': ['5.5.5.5'],
+            },
+        ]
+
+    def importar(self, lineas, **kwargs):
+        archivo = io.StringIO("".join(json.dumps(linea) + "\n"
+                                      for linea in lineas))
+        return lotes.importar(archivo, lotes.JSONL, **kwargs)
+
+    def test_importar_jsonl(self):
+        '''
+        Prueba importar clases desde un archivo JSON Lines en varios lotes
+        publicando una unica version.
+        '''
+        with mock.patch.object(lotes, 'ENTRADAS_POR_LOTE', 2):
+            self.assertEqual(self.importar(self.lineas), 2)
+        self.assertEqual(models.Version.objects.count(), 1)
+        foo = models.ClaseTrafico.objects.get(nombre='foo')
+        self.assertEqual(foo.descripcion, 'bar')
+        self.assertEqual(
+            sorted(str(item) for item in foo.redes.filter(
+                grupo=models.OUTSIDE)),
+            ['10.0.0.0/8', '191.50.15.0/24', '5.5.5.5/32'])
+        self.assertEqual(foo.puertos.count(), 2)
+        baz = models.ClaseTrafico.objects.get(nombre='baz')
+        assert not baz.activa
+        assert baz.puertos.filter(puerto__numero=22, puerto__protocolo=0,
+                                  grupo=models.INSIDE).exists()
+        # importar de nuevo no duplica nada
+        self.importar(self.lineas)
+        self.assertEqual(foo.redes.count(), 3)
+        self.assertEqual(models.CIDR.objects.count(), 4)
+        # reemplazando quedan solo las subredes del archivo
+        self.importar([{'nombre': 'foo', 'subredes_outside': ['1.1.1.1']}],
+                      reemplazar=True)
+        self.assertEqual([str(item) for item in foo.redes.all()],
+                         ['1.1.1.1/32'])
+        self.assertEqual(foo.puertos.count(), 0)
+
+    def test_importar_errores(self):
+        '''
+        Prueba que un error en el archivo no importe nada e indique la linea.
+        '''
+        self.lineas[1]['subredes_inside'] = ['192.168.0.0/33']
+        with self.assertRaisesRegex(ValueError, '^linea 2: '):
+            self.importar(self.lineas)
+        assert not models.ClaseTrafico.objects.exists()
+        assert not models.Version.objects.exists()
+
+    def test_importar_tipos_invalidos(self):
+        '''
+        Prueba que los campos con tipos invalidos se informen con su linea.
+        '''
+        for campos, mensaje in (
+                ({'subredes_outside': 5},
+                 'linea 2: subredes_outside: Debe ser una lista'),
+                ({'subredes_outside': '10.0.0.0/8'},
+                 'linea 2: subredes_outside: Debe ser una lista'),
+                ({'puertos_inside': [22]},
+                 'linea 2: 22: Debe ser una cadena'),
+                ({'subredes_inside': [['10.0.0.0/8']]},
+                 'linea 2: \\["10.0.0.0/8"\\]: Debe ser una cadena'),
+                ({'nombre': 5}, 'linea 2: nombre: Tipo invalido'),
+                ({'activa': 'no'}, 'linea 2: activa: Tipo invalido'),
+                ({'id': [1]}, 'linea 2: \\[1\\]: Id invalido')):
+            lineas = [self.lineas[0], dict(self.lineas[1], **campos)]
+            with self.assertRaisesRegex(ValueError, '^%s$' % mensaje):
+                self.importar(lineas)
+        with self.assertRaisesRegex(ValueError,
+                                    '^linea 1: La clase debe ser un objeto$'):
+            lotes.importar(io.StringIO('["foo"]\n'), lotes.JSONL)
+        assert not models.ClaseTrafico.objects.exists()
+
+    def test_exportar_importar_csv(self):
+        '''
+        Prueba exportar las clases en CSV y volver a importarlas.
+        '''
+        self.importar(self.lineas)
+        esperado = firmas.obtener_clases()
+        salida = io.StringIO()
+        with mock.patch.object(lotes, 'CLASES_POR_LOTE', 1):
+            self.assertEqual(lotes.exportar(salida, lotes.CSV), 2)
+        # borro todo y vuelvo a importar
+        models.ClaseTrafico.objects.all().delete()
+        archivo = io.StringIO(salida.getvalue())
+        self.assertEqual(lotes.importar(archivo, lotes.CSV), 2)
+        obtenido = firmas.obtener_clases()
+        for clase in esperado + obtenido:
+            del clase['id'], clase['descripcion'], clase['activa']
+        self.assertEqual(obtenido, esperado)
+
+    def test_comandos(self):
+        '''
+        Prueba los comandos de importacion y exportacion.
+        '''
+        directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directorio)
+        entrada = os.path.join(directorio, 'entrada.jsonl')
+        salida = os.path.join(directorio, 'salida.jsonl')
+        with open(entrada, 'w') as f:
+            f.writelines(json.dumps(linea) + "\n" for linea in self.lineas)
+        call_command('importar_clases', entrada, stdout=io.StringIO())
+        call_command('exportar_clases', salida=salida, stdout=io.StringIO())
+        with open(salida) as f:
+            clases = [json.loads(linea) for linea in f]
+        self.assertEqual(clases, firmas.obtener_clases())
+
+
+class TestClasificar(MediaTemporalMixin, TestCase):
+
+    def crear_clase(self, **campos):
+        data = {'nombre': 'foo', 'descripcion': 'bar', 'activa': True}
+        data.update(campos)
+        form = forms.ClaseForm(data)
+        assert form.is_valid()
+        return form.save()
+
+    def test_trie(self):
+        '''
+        Prueba la busqueda de prefijo mas largo contra una busqueda lineal.
+        '''
+        azar = random.Random(0)
+        redes = set()
+        for i in range(300):
+            prefijo = azar.randint(0, 32)
+            red = ipaddress.ip_network(
+                (azar.getrandbits(32), prefijo), strict=False)
+            redes.add(red)
+        # agrego redes anidadas
+        redes.update(ipaddress.ip_network('10.0.0.0/%d' % p)
+                     for p in (8, 9, 16, 24, 32))
+        trie = clasificador.Trie()
+        for red in redes:
+            trie.insertar(int(red.network_address), red.prefixlen, str(red))
+        ips = [azar.getrandbits(32) for i in range(2000)]
+        ips += [int(ipaddress.IPv4Address(ip))
+                for ip in ('10.0.0.0', '10.0.0.1', '10.0.1.1', '10.1.0.0',
+                           '10.128.0.0', '11.0.0.0')]
+        for ip in ips:
+            direccion = ipaddress.IPv4Address(ip)
+            candidatas = [red for red in redes if direccion in red]
+            nodo = trie.buscar(ip)
+            if candidatas:
+                esperada = max(candidatas, key=lambda red: red.prefixlen)
+                self.assertEqual(nodo[clasificador.VALOR], str(esperada))
+            else:
+                assert nodo is None
+
+    def test_clasificar(self):
+        '''
+        Prueba clasificar ips y puertos por GET y por POST.
+        '''
+        web = self.crear_clase(subredes_outside="203.0.113.0/24",
+                               puertos_outside="443/tcp\n80/tcp")
+        cdn = self.crear_clase(subredes_outside="203.0.113.0/28\n10.0.0.0/8")
+        dns = self.crear_clase(puertos_outside="53")
+        self.crear_clase(subredes_outside="203.0.113.7", activa=False)
+        lan = self.crear_clase(subredes_inside="192.168.0.0/16")
+
+        response = self.client.get(reverse('clasificar'),
+                                   {'ip': '203.0.113.7'})
+        self.assertEqual(response.status_code, 200)
+        documento = json.loads(response.content.decode())
+        self.assertEqual(documento['version'], firmas.leer_version())
+        self.assertEqual(documento['resultados'][0]['outside'],
+                         {'subred': '203.0.113.0/28', 'clases': [cdn.id]})
+        self.assertEqual(documento['resultados'][0]['inside'],
+                         {'subred': None, 'clases': []})
+
+        consultas = [
+            {'ip': '203.0.113.200', 'puerto': 443, 'protocolo': 'tcp'},
+            {'ip': '203.0.113.200', 'puerto': 22},
+            {'puerto': 53, 'protocolo': 'udp'},
+            {'ip': '192.168.10.1'},
+        ]
+        response = self.client.post(reverse('clasificar'),
+                                    json.dumps({'consultas': consultas}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        resultados = json.loads(response.content.decode())['resultados']
+        self.assertEqual(resultados[0]['outside']['clases'], [web.id])
+        self.assertEqual(resultados[1]['outside'],
+                         {'subred': '203.0.113.0/24', 'clases': []})
+        self.assertEqual(resultados[2]['outside']['clases'], [dns.id])
+        self.assertEqual(resultados[3]['inside'],
+                         {'subred': '192.168.0.0/16', 'clases': [lan.id]})
+
+        # si las clases de la subred mas especifica no tienen el puerto se
+        # busca en las subredes que la contienen
+        amplia = self.crear_clase(subredes_outside="10.0.0.0/8",
+                                  puertos_outside="443/tcp")
+        self.crear_clase(subredes_outside="10.1.0.0/16",
+                         puertos_outside="80/tcp")
+        response = self.client.get(reverse('clasificar'), {
+            'ip': '10.1.2.3', 'puerto': 443, 'protocolo': 'tcp'})
+        documento = json.loads(response.content.decode())
+        self.assertEqual(documento['resultados'][0]['outside'],
+                         {'subred': '10.0.0.0/8',
+                          'clases': [cdn.id, amplia.id]})
+
+        # el indice se reconstruye al cambiar la version
+        otra = self.crear_clase(subredes_outside="203.0.113.7")
+        response = self.client.get(reverse('clasificar'),
+                                   {'ip': '203.0.113.7'})
+        documento = json.loads(response.content.decode())
+        self.assertEqual(documento['resultados'][0]['outside']['clases'],
+                         [otra.id])
+
+    def test_clasificar_ipv6(self):
+        '''
+        Prueba clasificar direcciones IPv6 sin que coincidan con redes IPv4.
+        '''
+        v6 = self.crear_clase(subredes_outside="2001:db8::/32\n::/0")
+        v4 = self.crear_clase(subredes_outside="0.0.0.0/0")
+        doc = self.crear_clase(subredes_outside="2001:db8:1::/48",
+                               puertos_outside="443/tcp")
+        indice = clasificador.obtener_indice()
+        self.assertEqual(
+            indice.clasificar(clasificador.parsear_consulta(
+                {'ip': '2001:db8:1::5', 'puerto': 443})[0], 443, 6)['outside'],
+            {'subred': '2001:db8:1::/48', 'clases': [doc.id]})
+        response = self.client.get(reverse('clasificar'),
+                                   {'ip': '2001:db8:2::1'})
+        self.assertEqual(
+            json.loads(response.content.decode())['resultados'][0]['outside'],
+            {'subred': '2001:db8::/32', 'clases': [v6.id]})
+        for ip, subred, clases in (('fe80::1', '::/0', [v6.id]),
+                                   ('10.0.0.1', '0.0.0.0/0', [v4.id])):
+            response = self.client.get(reverse('clasificar'), {'ip': ip})
+            self.assertEqual(
+                json.loads(response.content.decode())
+                ['resultados'][0]['outside'],
+                {'subred': subred, 'clases': clases})
+
+    def test_clasificar_errores(self):
+        '''
+        Prueba que las consultas invalidas devuelvan 400.
+        '''
+        for consulta, error in (
+                ({'ip': '256.0.0.1'}, '256.0.0.1: Direccion invalida'),
+                ({'ip': 'abc'}, 'abc: Direccion invalida'),
+                ({'puerto': 0}, '0: Puerto invalido'),
+                ({'puerto': 'abc'}, 'abc: Puerto invalido'),
+                ({'puerto': 22, 'protocolo': 'icmp'},
+                 'icmp: Protocolo desconocido'),
+                ({}, 'La consulta debe tener ip o puerto')):
+            response = self.client.get(reverse('clasificar'), consulta)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(leer_json(response), {'error': error})
+        response = self.client.post(reverse('clasificar'), 'basura',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        for consulta, error in (({'puerto': {}}, '{}: Puerto invalido'),
+                                ({'puerto': [80]}, '[80]: Puerto invalido'),
+                                ({'ip': ['10.0.0.1']},
+                                 "['10.0.0.1']: Direccion invalida"),
+                                ({'ip': {}}, '{}: Direccion invalida')):
+            response = self.client.post(
+                reverse('clasificar'), json.dumps({'consultas': [consulta]}),
+                content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(leer_json(response), {'error': error})
+
+
+class TestRendimiento(MediaTemporalMixin, TestCase):
+
+    def test_generar_clases(self):
+        '''
+        Prueba que las clases generadas tengan la cantidad pedida de subredes
+        y puertos validos, repartidos entre outside e inside.
+        '''
+        clases = list(rendimiento.generar_clases(20, 10, 5,
+                                                 proporcion_inside=0.5))
+        self.assertEqual(len(clases), 20)
+        for clase in clases:
+            self.assertEqual(len(clase['subredes_outside']) +
+                             len(clase['subredes_inside']), 10)
+            self.assertEqual(len(clase['puertos_outside']) +
+                             len(clase['puertos_inside']), 5)
+        self.assertTrue(any(clase['subredes_inside'] for clase in clases))
+        self.assertTrue(any(clase['subredes_outside'] for clase in clases))
+        self.assertEqual(clases, list(rendimiento.generar_clases(
+            20, 10, 5, proporcion_inside=0.5)))
+        self.assertEqual(rendimiento.cargar_clases(20, 10, 5), 20)
+        self.assertEqual(models.ClaseTrafico.objects.count(), 20)
+
+    def test_medir_escala(self):
+        '''
+        Prueba que se midan todos los escenarios y se deshagan los datos.
+        '''
+        resultado = rendimiento.medir_escala(5, 10, 5, repeticiones=1)
+        self.assertEqual(set(resultado['escenarios']),
+                         {'obtener_clases', 'version', 'descarga', 'busqueda',
+                          'guardar'})
+        obtener = resultado['escenarios']['obtener_clases']
+        self.assertEqual(obtener['consultas'], 1)
+        self.assertGreater(obtener['memoria_pico'], 0)
+        self.assertEqual(resultado['escenarios']['version']['consultas'], 0)
+        self.assertEqual(models.ClaseTrafico.objects.count(), 0)
+        json.dumps(resultado)
+
+    def test_comparar(self):
+        '''
+        Prueba que solo se informen las metricas que empeoraron mas que la
+        tolerancia.
+        '''
+        def resultado(tiempo, consultas):
+            return {'resultados': [{
+                'escala': {'clases': 1, 'subredes': 2, 'puertos': 3},
+                'escenarios': {'version': {'tiempo_mediana': tiempo,
+                                           'consultas': consultas}},
+            }]}
+        anterior = resultado(1.0, 3)
+        self.assertEqual(rendimiento.comparar(anterior, resultado(1.1, 3)),
+                         [])
+        self.assertEqual(rendimiento.comparar(anterior, resultado(0.5, 4)),
+                         [('1x2x3', 'version', 'consultas', 3, 4)])
+
+
+# sin MEDIA_URL el servidor de prueba sirve el archivo de version como /version
+@override_settings(MEDIA_URL='/media/')
+class TestSimularAgentes(MediaTemporalMixin, LiveServerTestCase):
+
+    def test_simular_agentes(self):
+        '''
+        Prueba que los agentes simulados descarguen la version publicada y
+        luego solo la consulten.
+        '''
+        form = forms.ClaseForm({'nombre': 'foo', 'descripcion': 'bar',
+                                'activa': True})
+        assert form.is_valid()
+        form.save()
+        resultado = rendimiento.simular_agentes(self.live_server_url,
+                                                agentes=3, duracion=1,
+                                                intervalo=0.1)
+        self.assertEqual(resultado['actualizados'], 3)
+        endpoints = resultado['endpoints']
+        self.assertEqual(endpoints['descarga']['estados'], {'200': 3})
+        self.assertEqual(endpoints['version']['estados']['200'], 3)
+        self.assertGreater(endpoints['version']['estados']['304'], 0)
+        self.assertIn('p99', endpoints['version']['latencia'])
+
+
+class TestMetricas(MediaTemporalMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        metricas.reiniciar()
+        self.addCleanup(metricas.reiniciar)
+        form = forms.ClaseForm({'nombre': 'foo', 'descripcion': 'bar',
+                                'activa': True})
+        assert form.is_valid()
+        form.save()
+
+    def test_metricas(self):
+        '''
+        Prueba que se exporten la latencia, los pedidos, las consultas y los
+        bytes por vista, y los eventos de la cache.
+        '''
+        cache.obtener_cache().clear()
+        # la version vigente se compara con la base al vencer la cache
+        firmas.leer_version()
+        cache.reiniciar_estadisticas()
+        descarga = self.client.get(reverse('json'))
+        self.client.get(reverse('json'))
+        self.client.get('/no/existe/')
+        response = self.client.get(reverse('metricas'))
+        self.assertEqual(response['Content-Type'], metricas.CONTENT_TYPE)
+        texto = response.content.decode()
+        self.assertIn('# TYPE netcop_http_duracion_segundos histogram', texto)
+        self.assertIn('netcop_http_duracion_segundos_bucket'
+                      '{le="+Inf",vista="json"} 2.0', texto)
+        self.assertIn('netcop_http_duracion_segundos_count{vista="json"} 2.0',
+                      texto)
+        self.assertIn('netcop_http_pedidos_total'
+                      '{estado="200",metodo="GET",vista="json"} 2.0', texto)
+        self.assertIn('netcop_http_pedidos_total'
+                      '{estado="404",metodo="GET",vista="sin_ruta"} 1.0',
+                      texto)
+        self.assertIn('netcop_http_respuesta_bytes_total{vista="json"} %r'
+                      % float(2 * len(descarga.content)), texto)
+        # la descarga se sirve del snapshot sin consultar la base de datos
+        self.assertIn('netcop_db_consultas_total{vista="json"} 0.0', texto)
+        self.assertIn('netcop_cache_eventos_total'
+                      '{evento="aciertos",nombre="descarga"} 1.0', texto)
+
+    def test_metricas_acceso(self):
+        '''
+        Prueba que solo lean las metricas las redes de METRICAS_REDES y los
+        usuarios staff.
+        '''
+        with self.settings(METRICAS_REDES=['10.0.0.0/8']):
+            response = self.client.get(reverse('metricas'))
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get(reverse('metricas'),
+                                       REMOTE_ADDR='10.1.2.3')
+            self.assertEqual(response.status_code, 200)
+            usuario = User.objects.create_user('admin', password='secreto')
+            self.client.login(username='admin', password='secreto')
+            response = self.client.get(reverse('metricas'))
+            self.assertEqual(response.status_code, 403)
+            usuario.is_staff = True
+            usuario.save()
+            response = self.client.get(reverse('metricas'))
+            self.assertEqual(response.status_code, 200)
+
+    def test_consultas(self):
+        '''
+        Prueba que se cuenten las consultas aunque DEBUG sea False, sin
+        dejar activo el registro de consultas.
+        '''
+        with self.assertNumQueries(0):
+            self.client.get(reverse('version'))
+        self.client.get(reverse('index'), {'q': 'foo'})
+        self.assertFalse(connection.force_debug_cursor)
+        texto = metricas.exportar()
+        self.assertIn('netcop_db_consultas_total{vista="version"} 0.0', texto)
+        self.assertRegex(texto, r'netcop_db_consultas_total\{vista="index"\} '
+                                r'[1-9]')
+
+    def test_pedido_lento(self):
+        '''
+        Prueba que solo se registren los pedidos que superan el limite.
+        '''
+        with self.settings(METRICAS_PEDIDO_LENTO=0), \
+                self.assertLogs('clases.metricas', 'WARNING') as logs:
+            self.client.get(reverse('index'), {'q': 'foo'})
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Pedido lento: GET /?q=foo (index)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+        with self.settings(METRICAS_PEDIDO_LENTO=60), \
+                mock.patch.object(metricas.logger, 'warning') as warning:
+            self.client.get(reverse('index'))
+        warning.assert_not_called()
+
+
+class TestReplicas(MediaTemporalMixin, TestCase):
+    '''
+    Usa como replica una segunda base sqlite con clases distintas de las de
+    la principal para saber de que base lee cada pedido.
+    '''
+    REPLICA = 'replica'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directorio = tempfile.mkdtemp()
+        connections.databases[cls.REPLICA] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.directorio, 'replica.sqlite3'),
+        }
+        call_command('migrate', database=cls.REPLICA, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections[cls.REPLICA].close()
+        delattr(connections._connections, cls.REPLICA)
+        del connections.databases[cls.REPLICA]
+        shutil.rmtree(cls.directorio)
+        super().tearDownClass()
+
+    def setUp(self):
+        '''
+        Inicializa datos.
+        '''
+        super().setUp()
+        configuracion = self.settings(REPLICAS=[self.REPLICA])
+        configuracion.enable()
+        self.addCleanup(configuracion.disable)
+        self.addCleanup(self.vaciar_replica)
+        models.ClaseTrafico.objects.create(nombre='principal')
+        clase = models.ClaseTrafico.objects.using(self.REPLICA).create(
+            nombre='replica')
+        models.ClasePublicada.objects.using(self.REPLICA).create(
+            clase=clase, nombre=clase.nombre)
+        replicas.reiniciar()
+
+    def vaciar_replica(self):
+        for modelo in (models.Cambio, models.Version, models.ClaseTrafico):
+            modelo.objects.using(self.REPLICA).all().delete()
+
+    def listar(self):
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+        return [clase.nombre for clase in response.context['object_list']]
+
+    def test_router(self):
+        '''
+        Prueba que solo se lean de la replica los modelos de clases dentro de
+        lectura_en_replica y antes de escribir.
+        '''
+        router = replicas.ReplicasRouter()
+        self.assertIsNone(router.db_for_read(models.ClaseTrafico))
+        with replicas.lectura_en_replica():
+            self.assertEqual(router.db_for_read(models.ClaseTrafico),
+                             self.REPLICA)
+            self.assertIsNone(router.db_for_read(User))
+            with replicas.principal():
+                self.assertIsNone(router.db_for_read(models.CIDR))
+            self.assertEqual(router.db_for_read(models.CIDR), self.REPLICA)
+            router.db_for_write(models.ClaseTrafico)
+            self.assertIsNone(router.db_for_read(models.ClaseTrafico))
+        self.assertFalse(router.allow_migrate(self.REPLICA, 'clases'))
+        self.assertIsNone(router.allow_migrate('default', 'clases'))
+        with self.settings(REPLICAS=[]):
+            replicas.reiniciar()
+            with replicas.lectura_en_replica():
+                self.assertIsNone(router.db_for_read(models.ClaseTrafico))
+
+    def test_leer_despues_de_escribir(self):
+        '''
+        Prueba que el listado lea de la replica salvo en los pedidos que
+        siguen a una escritura del mismo cliente.
+        '''
+        self.assertEqual(self.listar(), ['replica'])
+        User.objects.create_user('admin', password='secreto')
+        self.client.login(username='admin', password='secreto')
+        response = self.client.post(reverse('create'), {
+            'nombre': 'nueva',
+            'descripcion': 'recien creada',
+            'activa': True,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.cookies[replicas.COOKIE]['max-age'], 5)
+        self.assertEqual(self.listar(), ['principal', 'nueva'])
+        # al vencer la cookie se vuelve a leer de la replica
+        del self.client.cookies[replicas.COOKIE]
+        self.assertEqual(self.listar(), ['replica'])
+
+    def test_descarga_replica_atrasada(self):
+        '''
+        Prueba que la descarga sin snapshot solo lea de la replica si ya
+        tiene la version publicada.
+        '''
+        version = firmas.publicar()
+        os.remove(firmas.ruta_snapshot(version))
+
+        def nombres():
+            cache.obtener_cache().clear()
+            response = self.client.get(reverse('json'))
+            self.assertEqual(response.status_code, 200)
+            return [clase['nombre'] for clase in leer_json(response)['clases']]
+
+        self.assertEqual(nombres(), ['principal'])
+        models.Version.objects.using(self.REPLICA).create(numero=version)
+        self.assertEqual(nombres(), ['replica'])
@@ -28,4 +28,19 @@ urlpatterns = [
         views.VersionView.as_view(),
         name='version'
     ),
+    url(
+        r'^version/eventos/$',
+        views.VersionEventos.as_view(),
+        name='version_eventos'
+    ),
+    url(
+        r'^clasificar/$',
+        views.ClasificarView.as_view(),
+        name='clasificar'
+    ),
+    url(
+        r'^metrics/$',
+        views.MetricasView.as_view(),
+        name='metricas'
+    ),
 ]
@@ -1,12 +1,21 @@
-import os
+import json
 import re
+import time
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse_lazy
 from django.views import generic
-from django.http import JsonResponse, Http404
-from django.conf import settings
+from django.http import (HttpResponse, JsonResponse, Http404,
+                         StreamingHttpResponse)
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
-from . import models, forms
+from django.utils.decorators import method_decorator
+from django.utils.cache import patch_vary_headers
+from django.utils.http import quote_etag
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from . import (models, forms, firmas, binario, busqueda, clasificador,
+               metricas, notificaciones, replicas)
 
 
 class LoginRequiredMixin(object):
@@ -17,22 +26,150 @@ class LoginRequiredMixin(object):
         return login_required(view)
 
 
-class ClaseList(generic.ListView):
+def formato_pedido(request):
+    '''
+    Devuelve el formato de descarga pedido por el agente con el parametro
+    `formato` o con el encabezado Accept.
+    '''
+    if (request.GET.get('formato') == 'binario' or
+            binario.CONTENT_TYPE in request.META.get('HTTP_ACCEPT', '')):
+        return firmas.BINARIO
+    return firmas.JSON
+
+
+def codificacion_pedida(request):
+    '''
+    Devuelve la codificacion de Content-Encoding a usar segun el encabezado
+    Accept-Encoding, o None si el agente no acepta ninguna de las soportadas.
+    Entre las aceptadas se elige la de mayor compresion.
+    '''
+    aceptadas = dict()
+    for parte in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        nombre, _, parametros = parte.partition(';')
+        m = re.search(r"q=([\d.]+)", parametros)
+        try:
+            q = float(m.group(1)) if m else 1
+        except ValueError:
+            q = 0
+        aceptadas[nombre.strip().lower()] = q
+    for codificacion in firmas.COMPRESORES:
+        if aceptadas.get(codificacion, aceptadas.get('*', 0)) > 0:
+            return codificacion
+    return None
+
+
+def etag(request, version, variantes=True):
+    '''
+    Devuelve el ETag de la version. Con `variantes` se agregan el formato, la
+    normalizacion y la codificacion pedidos, que cambian el contenido de la
+    descarga.
+    '''
+    if not variantes:
+        return version
+    partes = [version]
+    if formato_pedido(request) == firmas.BINARIO:
+        partes.append(firmas.BINARIO)
+    if request.GET.get('normalizar'):
+        partes.append('normalizado')
+    codificacion = codificacion_pedida(request)
+    if codificacion:
+        partes.append(codificacion)
+    return '-'.join(partes)
+
+
+def fecha_version(request, *args, **kwargs):
+    return firmas.fecha_version()
+
+
+class LecturaReplicaMixin(object):
+    '''
+    Lee las clases de una replica de la base de datos (ver el modulo
+    replicas). Las respuestas con template se generan dentro del pedido para
+    que sus consultas tambien vayan a la replica.
+    '''
+
+    def dispatch(self, *args, **kwargs):
+        with replicas.lectura_en_replica():
+            response = super().dispatch(*args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        return response
+
+
+class VersionCondicionalMixin(object):
+    '''
+    Agrega ETag, Last-Modified y Cache-Control en base a la version publicada
+    y responde 304 sin cuerpo cuando el cliente ya tiene esa version. Las
+    vistas sin variantes por formato o codificacion usan la version como
+    ETag.
+    '''
+    variantes = True
+
+    @method_decorator(cache_control(public=True, no_cache=True))
+    def dispatch(self, *args, **kwargs):
+        condicional = condition(etag_func=self.etag_version,
+                                last_modified_func=fecha_version)
+        return condicional(super().dispatch)(*args, **kwargs)
+
+    def etag_version(self, request, *args, **kwargs):
+        version = firmas.leer_version()
+        if not version:
+            return None
+        return etag(request, version, self.variantes)
+
+
+class ClaseList(LecturaReplicaMixin, generic.ListView):
+    '''
+    Lista las clases de trafico paginando por clave: el parametro `despues`
+    indica la ultima clase de la pagina anterior con el formato activa-id y
+    `cantidad` la cantidad de clases por pagina.
+    '''
     model = models.ClaseTrafico
     ordering = ('-activa', 'id')
+    CANTIDAD_POR_DEFECTO = 50
+    CANTIDAD_MAXIMA = 500
+
+    def get_cantidad(self):
+        try:
+            cantidad = int(self.request.GET.get('cantidad'))
+        except (TypeError, ValueError):
+            return self.CANTIDAD_POR_DEFECTO
+        return max(1, min(cantidad, self.CANTIDAD_MAXIMA))
+
+    def get_despues(self):
+        m = re.match(r"^([01])-(\d+)$", self.request.GET.get('despues', ''))
+        if m is None:
+            return None
+        return bool(int(m.group(1))), int(m.group(2))
 
     def get_queryset(self, *args, **kwargs):
-        qs = super().get_queryset(*args, **kwargs)
+        qs = super().get_queryset(*args, **kwargs).con_cantidades()
         q = self.request.GET.get('q')
         if q:
-            filters = (Q(nombre__icontains=q) |
-                       Q(descripcion__icontains=q) |
-                       Q(redes__cidr__direccion__contains=q))
-            if re.match("^\d+$", q):
-                filters |= Q(puertos__puerto__numero=q)
-                filters |= Q(pk=q)
-            qs = qs.filter(filters).distinct()
-        return qs
+            qs = busqueda.buscar(qs, q)
+        despues = self.get_despues()
+        if despues:
+            qs = qs.despues_de(*despues)
+        # se pide una clase de mas para saber si hay una pagina siguiente
+        return qs[:self.get_cantidad() + 1]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        clases = list(context['object_list'])
+        cantidad = self.get_cantidad()
+        if len(clases) > cantidad:
+            clases = clases[:cantidad]
+            parametros = self.request.GET.copy()
+            parametros['despues'] = "%d-%d" % (clases[-1].activa,
+                                               clases[-1].id)
+            context['siguiente'] = '?' + parametros.urlencode()
+        if self.get_despues():
+            parametros = self.request.GET.copy()
+            del parametros['despues']
+            context['primera'] = '?' + parametros.urlencode()
+        context['object_list'] = clases
+        context[self.get_context_object_name(self.object_list)] = clases
+        return context
 
 
 class ClaseCreate(LoginRequiredMixin, generic.CreateView):
@@ -47,37 +184,91 @@ class ClaseUpdate(LoginRequiredMixin, generic.UpdateView):
     success_url = reverse_lazy('index')
 
 
-class ClaseJson(generic.View):
+class ClaseJson(LecturaReplicaMixin, VersionCondicionalMixin,
+                generic.View):
     '''
-    Devuelve las clases en formato json.
+    Devuelve las clases en formato json o, si se pide con el parametro
+    `formato=binario` o con el encabezado Accept, en el formato binario
+    compacto del modulo binario.
+
+    Sirve el snapshot publicado para la version actual, guardado en la cache,
+    y solo consulta la base de datos, leyendo la copia publicada de las
+    clases (ver models.ClasePublicada), si el snapshot todavia no existe. Con
+    el parametro `desde` se devuelven solo las clases que cambiaron desde esa
+    version, o la base completa si no es posible calcular el delta. Los
+    deltas solo se entregan en json.
+
+    Con el parametro `normalizar` las subredes y puertos de cada clase se
+    reducen al conjunto minimo equivalente (ver el modulo normalizacion). Se
+    calcula a partir del snapshot publicado, sin consultar la base de datos.
+
+    La respuesta se comprime segun el encabezado Accept-Encoding usando las
+    variantes comprimidas que se generan al publicar cada version.
+
+    Con FIRMAS_STREAMING en settings la descarga completa en json se envia de
+    a bloques, sin pasar por la cache, para que la memoria de cada proceso no
+    dependa de la cantidad de clases (ver firmas.descarga_continua).
     '''
+    CONTENT_TYPES = {
+        firmas.JSON: 'application/json',
+        firmas.BINARIO: binario.CONTENT_TYPE,
+    }
 
-    def get(self, *args, **kwargs):
-        return JsonResponse({'clases': self.obtener_clases()})
+    def get(self, request, *args, **kwargs):
+        response = self.descargar(request, formato_pedido(request),
+                                  codificacion_pedida(request))
+        patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+        return response
+
+    def descargar(self, request, formato, codificacion):
+        desde = request.GET.get('desde')
+        if desde and formato == firmas.JSON:
+            version, datos = firmas.descarga_delta(desde, codificacion)
+            if datos is not None:
+                return self.responder(request, version, datos, formato,
+                                      codificacion)
+        if request.GET.get('normalizar'):
+            version, (datos, resumen) = firmas.descarga_normalizada(
+                formato, codificacion)
+            response = self.responder(request, version, datos, formato,
+                                      codificacion)
+            response['X-Subredes-Eliminadas'] = resumen['subredes_eliminadas']
+            response['X-Puertos-Eliminados'] = resumen['puertos_eliminados']
+            return response
+        if formato == firmas.JSON and getattr(settings, 'FIRMAS_STREAMING',
+                                              False):
+            version, bloques, largo = firmas.descarga_continua(codificacion)
+            response = StreamingHttpResponse(
+                bloques, content_type=self.CONTENT_TYPES[formato])
+            if largo is not None:
+                response['Content-Length'] = largo
+            return self.completar(request, response, version, codificacion)
+        version, datos = firmas.descarga(formato, codificacion)
+        return self.responder(request, version, datos, formato, codificacion)
+
+    def responder(self, request, version, datos, formato, codificacion):
+        '''
+        Responde con los datos ya serializados y comprimidos.
+        '''
+        response = HttpResponse(datos,
+                                content_type=self.CONTENT_TYPES[formato])
+        response['Content-Length'] = len(datos)
+        return self.completar(request, response, version, codificacion)
+
+    def completar(self, request, response, version, codificacion):
+        '''
+        Agrega los encabezados de la codificacion y la version. Si la cache
+        devolvio los datos de la version anterior porque la nueva se esta
+        calculando, el ETag corresponde a la version de los datos.
+        '''
+        if codificacion:
+            response['Content-Encoding'] = codificacion
+        if version and version != firmas.leer_version():
+            response['ETag'] = quote_etag(etag(request, version))
+        return response
 
     def obtener_clases(self):
-        lista = list()
-        for clase in models.ClaseTrafico.objects.all().order_by('id'):
-            r = dict()
-            r['id'] = clase.id
-            r['nombre'] = clase.nombre
-            r['descripcion'] = clase.descripcion
-            r['activa'] = clase.activa
-            r['subredes_outside'] = [
-                str(item) for item in clase.redes.filter(grupo=models.OUTSIDE)
-            ]
-            r['subredes_inside'] = [
-                str(item) for item in clase.redes.filter(grupo=models.INSIDE)
-            ]
-            r['puertos_outside'] = [
-                str(item) for item in clase.puertos.filter(
-                    grupo=models.OUTSIDE)
-            ]
-            r['puertos_inside'] = [
-                str(item) for item in clase.puertos.filter(grupo=models.INSIDE)
-            ]
-            lista.append(r)
-        return lista
+        return firmas.clases_publicadas()
 
 
 class VersionView(ClaseJson):
@@ -85,11 +276,139 @@ class VersionView(ClaseJson):
     Devuelve numero de version de la base de datos de firmas.
 
     Lo obtiene haciendo una suma SHA256 del json de las clases.
+
+    Con el parametro `esperar` el pedido se mantiene abierto hasta que la
+    version publicada sea distinta de la indicada o pasen `timeout` segundos,
+    y recien entonces se responde con la version publicada.
     '''
+    TIMEOUT_POR_DEFECTO = 30
+    TIMEOUT_MAXIMO = 60
+    # la respuesta es la misma para cualquier formato o codificacion
+    variantes = False
+
+    def get_timeout(self):
+        try:
+            timeout = float(self.request.GET.get('timeout'))
+        except (TypeError, ValueError):
+            return self.TIMEOUT_POR_DEFECTO
+        return max(0, min(timeout, self.TIMEOUT_MAXIMO))
+
+    def dispatch(self, request, *args, **kwargs):
+        esperar = request.GET.get('esperar')
+        if esperar is not None:
+            self.request = request
+            version = notificaciones.esperar(esperar, self.get_timeout())
+            if version and version != firmas.leer_version():
+                # la version la publico otro proceso
+                firmas.guardar_estado(version)
+        return super().dispatch(request, *args, **kwargs)
+
     def get(self, *args, **kwargs):
-        path = os.path.join(settings.MEDIA_ROOT, 'version')
-        with open(path, 'r') as f:
-            version = f.read()
+        version = firmas.leer_version()
         if not version:
             raise Http404()
         return JsonResponse({"version": str(version)})
+
+
+class VersionEventos(generic.View):
+    '''
+    Notifica las nuevas versiones con Server-Sent Events.
+
+    Envia un evento `version` con la version publicada al conectarse y cada
+    vez que cambia, y un comentario cada INTERVALO_PING segundos para mantener
+    viva la conexion. Despues de DURACION_MAXIMA segundos se cierra el stream
+    y el agente se reconecta enviando el encabezado Last-Event-ID, con el que
+    solo se le notifica si la version cambio.
+    '''
+    INTERVALO_PING = 15
+    DURACION_MAXIMA = 300
+    # milisegundos que espera el agente antes de reconectarse
+    RECONEXION = 1000
+
+    def get(self, request, *args, **kwargs):
+        ultima = request.META.get('HTTP_LAST_EVENT_ID')
+        response = StreamingHttpResponse(self.eventos(ultima),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # evita que nginx acumule los eventos
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def eventos(self, ultima):
+        limite = time.monotonic() + self.DURACION_MAXIMA
+        yield "retry: %d\n\n" % self.RECONEXION
+        while True:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return
+            version = notificaciones.esperar(
+                ultima, min(self.INTERVALO_PING, restante))
+            if version != ultima:
+                ultima = version
+                if version:
+                    yield "id: %s\nevent: version\ndata: %s\n\n" % (
+                        version, json.dumps({'version': version}))
+                    continue
+            yield ": ping\n\n"
+
+
+class ClasificarView(generic.View):
+    '''
+    Clasifica direcciones IP y puertos en las clases de trafico activas.
+
+    Por GET se clasifica una unica consulta con los parametros ip, puerto y
+    protocolo. Por POST se recibe un json {"consultas": [...]} con una lista
+    de consultas con esos mismos campos. La respuesta tiene la version usada y
+    un resultado por consulta, en el mismo orden.
+    '''
+    MAX_CONSULTAS = 10000
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, *args, **kwargs):
+        return super().dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        return self.responder([request.GET.dict()])
+
+    def post(self, request, *args, **kwargs):
+        try:
+            consultas = json.loads(request.body.decode())['consultas']
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({'error': 'Se esperaba {"consultas": [...]}'},
+                                status=400)
+        if not isinstance(consultas, list):
+            return JsonResponse({'error': 'Las consultas deben ser una lista'},
+                                status=400)
+        if len(consultas) > self.MAX_CONSULTAS:
+            return JsonResponse(
+                {'error': 'No se admiten mas de %d consultas' %
+                          self.MAX_CONSULTAS},
+                status=400)
+        return self.responder(consultas)
+
+    def responder(self, consultas):
+        try:
+            consultas = [clasificador.parsear_consulta(consulta)
+                         for consulta in consultas]
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        indice = clasificador.obtener_indice()
+        resultados = [indice.clasificar(*consulta) for consulta in consultas]
+        return JsonResponse({'version': indice.version,
+                             'resultados': resultados})
+
+
+class MetricasView(generic.View):
+    '''
+    Exporta las metricas del proceso en el formato de texto de Prometheus.
+    Solo responde a los pedidos que permite metricas.acceso_permitido.
+    '''
+
+    def dispatch(self, request, *args, **kwargs):
+        if not metricas.acceso_permitido(request):
+            raise PermissionDenied()
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metricas.exportar(),
+                            content_type=metricas.CONTENT_TYPE)
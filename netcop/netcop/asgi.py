@@ -0,0 +1,24 @@
+"""
+ASGI config for netcop project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+Django 1.8 has no ASGI support: the read-only endpoints used by the agents
+are served by the coroutines in ``clases.asincronico`` and every other
+request is handed to the WSGI application in a thread pool. Run it with any
+ASGI server, for example::
+
+    uvicorn netcop.asgi:application
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "netcop.settings")
+
+wsgi_application = get_wsgi_application()
+
+from clases import asincronico  # noqa: E402
+
+application = asincronico.Aplicacion(wsgi_application)
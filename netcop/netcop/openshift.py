@@ -24,6 +24,18 @@ POSTGRE_DB = os.environ.get('PGDATABASE', '')
 
 SECRET_KEY = os.environ.get('OPENSHIFT_SECRET_TOKEN', '')
 
+# segundos que cada hilo reutiliza su conexion a la base de datos
+CONN_MAX_AGE = int(os.environ.get('NETCOP_CONN_MAX_AGE', 60))
+# hosts de las replicas de lectura, separados por coma
+REPLICAS_HOSTS = os.environ.get('NETCOP_REPLICAS', '')
+# enviar la descarga de las firmas de a bloques
+FIRMAS_STREAMING = os.environ.get('NETCOP_FIRMAS_STREAMING', '') == '1'
+# redes de Prometheus que pueden leer /metrics/, separadas por coma
+METRICAS_REDES = [red.strip()
+                  for red in os.environ.get('NETCOP_METRICAS_REDES',
+                                            '127.0.0.1/32').split(',')
+                  if red.strip()]
+
 
 # base de datos productiva
 DATABASES = {
@@ -34,9 +46,19 @@ DATABASES = {
         'PASSWORD': POSTGRE_PASSWORD,
         'HOST': POSTGRE_HOST,
         'PORT': POSTGRE_PORT,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
     }
 }
 
+# las replicas usan el mismo usuario y base que la principal
+REPLICAS = []
+for numero, host in enumerate(REPLICAS_HOSTS.split(','), 1):
+    if host.strip():
+        alias = 'replica%d' % numero
+        DATABASES[alias] = dict(DATABASES['default'], HOST=host.strip(),
+                                TEST={'MIRROR': 'default'})
+        REPLICAS.append(alias)
+
 
 # lugar fisico donde se copiaran los archivos estaticos
 STATIC_ROOT = os.path.join(REPO_DIR, 'wsgi', 'static')
@@ -41,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'clases.metricas.MetricasMiddleware',
+    'clases.replicas.ReplicasMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,9 +81,48 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # segundos que cada hilo reutiliza su conexion; 0 abre una conexion
+        # por pedido y None no las cierra nunca. Para un pool compartido
+        # entre procesos se puede apuntar HOST a pgbouncer.
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# Replicas de lectura
+#
+# Alias de DATABASES con replicas de solo lectura de default. La descarga, la
+# version y el listado de clases leen de ellas (ver clases.replicas). Para
+# que las pruebas no creen sus bases, cada replica debe declarar
+# 'TEST': {'MIRROR': 'default'}.
+
+DATABASE_ROUTERS = ['clases.replicas.ReplicasRouter']
+REPLICAS = []
+# segundos que un cliente lee de la base principal despues de escribir, para
+# que vea sus cambios aunque las replicas esten atrasadas
+REPLICAS_RETRASO = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+#
+# Por defecto cada proceso tiene su propia cache en memoria. Con varios
+# procesos o servidores conviene un backend compartido, por ejemplo
+# 'django.core.cache.backends.filebased.FileBasedCache' o memcached, para que
+# la version publicada y las descargas se calculen una sola vez.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'netcop',
+    }
+}
+
+# alias de CACHES que se usa para la version y las descargas de las firmas
+FIRMAS_CACHE = 'default'
+# enviar la descarga completa en json de a bloques, leyendo el snapshot o las
+# clases por lotes, en lugar de guardarla entera en la cache
+FIRMAS_STREAMING = False
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -124,8 +165,44 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "static"),
 ]
 
+# Archivos generados (version y snapshots de la base de firmas)
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
 LOGIN_REDIRECT_URL = '/'
 
+
+# Logging
+# https://docs.djangoproject.com/en/1.9/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'simple',
+        },
+    },
+    'loggers': {
+        'clases': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
+# segundos a partir de los cuales un pedido se registra con sus consultas en
+# el log clases.metricas; None no registra ningun pedido
+METRICAS_PEDIDO_LENTO = None
+# redes desde las que se pueden leer las metricas en /metrics/, ademas de los
+# usuarios staff; detras de un proxy se compara la direccion del proxy
+METRICAS_REDES = ['127.0.0.1/32', '::1/128']
+
 # openshift is our PAAS for now.
 if 'OPENSHIFT_REPO_DIR' in os.environ:
     try: